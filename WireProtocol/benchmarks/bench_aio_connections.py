@@ -0,0 +1,168 @@
+"""
+Load test for the asyncio server mode. Starts the asyncio server in a separate process
+pinned to one core, opens `--idle` registered connections that stay silent, and
+`--active` registered connections that each send direct messages to another active user
+at `--rate` messages per second. Reports the chat throughput, the latency from sending a
+ChatMessage to receiving its ChatResponse, the server's memory usage, and whether every
+idle connection is still open at the end.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_aio_connections`.
+The process needs a file descriptor limit above the number of connections.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import time
+from multiprocessing import Process
+
+from src.aio_server import run_asyncio
+from src.app import AppState
+from src.protocol import *
+
+
+HOST = "127.0.0.1"
+
+
+def raise_fd_limit():
+    """Raise the soft limit on open file descriptors to the hard limit."""
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def run_server(port, backlog):
+    """Run the asyncio server on one core, used as the target of the server process."""
+    logging.disable(logging.CRITICAL)
+    raise_fd_limit()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    run_asyncio(HOST, port, AppState(set(), {}, {}), backlog=backlog)
+
+
+def server_rss(pid):
+    """Return the resident memory of the process in MiB, or None if it is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+async def connect(port, username, semaphore):
+    """Open a connection and register `username`, returning the stream reader, writer and decoder."""
+    async with semaphore:
+        reader, writer = await asyncio.open_connection(HOST, port)
+        writer.write(RegisterMessage(username=username, wire_format=BINARY_FORMAT).encode_())
+        decoder = StreamDecoder(deserialize_server_message, size=2 * MAX_BUFFER_SIZE)
+        while True:
+            msgs = decoder.feed(await reader.read(4096))
+            if any(isinstance(msg, RegisterResponse) for msg in msgs):
+                return reader, writer, decoder
+
+
+async def active_client(conn, username, recipient, rate, duration, latencies):
+    """Send direct messages at `rate` per second for `duration` seconds, recording each response latency."""
+    reader, writer, decoder = conn
+    sent_times = []
+    received = latencies[username] = []
+    done = asyncio.Event() # Set when every response has been received
+
+    async def read_responses():
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            for msg in decoder.feed(data):
+                if isinstance(msg, ChatResponse):
+                    received.append(time.perf_counter() - sent_times[len(received)])
+            if len(received) == len(sent_times) and finished_sending:
+                done.set()
+
+    finished_sending = False
+    reader_task = asyncio.create_task(read_responses())
+    msg = ChatMessage(sender=username, recipient=recipient, text="A" * 100).encode_(BINARY_FORMAT)
+    start = time.perf_counter()
+    # Start at a random offset so the clients don't send at the same time
+    await asyncio.sleep((hash(username) % 1000) / 1000 / rate)
+    while time.perf_counter() - start < duration:
+        sent_times.append(time.perf_counter())
+        writer.write(msg)
+        await asyncio.sleep(1 / rate)
+    finished_sending = True
+    if len(received) < len(sent_times):
+        try:
+            await asyncio.wait_for(done.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            pass
+    reader_task.cancel()
+    return len(sent_times)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of the values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float("nan")
+
+
+async def run_load(port, args):
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    start = time.perf_counter()
+    idle = await asyncio.gather(*[connect(port, f"idle{i}", semaphore) for i in range(args.idle)])
+    active = await asyncio.gather(*[connect(port, f"active{i}", semaphore) for i in range(args.active)])
+    print(f"Connected {args.idle} idle and {args.active} active clients in {time.perf_counter() - start:.1f}s")
+
+    latencies = {}
+    start = time.perf_counter()
+    sent = await asyncio.gather(*[
+        active_client(conn, f"active{i}", f"active{(i + 1) % args.active}", args.rate, args.duration, latencies)
+        for i, conn in enumerate(active)
+    ])
+    elapsed = time.perf_counter() - start
+    all_latencies = [latency for values in latencies.values() for latency in values]
+
+    print(f"Sent {sum(sent)} chats, received {len(all_latencies)} responses in {elapsed:.1f}s "
+          f"({len(all_latencies) / elapsed:,.0f} chats/sec)")
+    print(f"Response latency: p50 {percentile(all_latencies, 50) * 1000:.1f} ms, "
+          f"p99 {percentile(all_latencies, 99) * 1000:.1f} ms")
+
+    # Every idle connection should still be open
+    open_idle = sum(not reader.at_eof() for reader, _, _ in idle)
+    print(f"Idle connections still open: {open_idle}/{args.idle}")
+
+    for _, writer, _ in idle + active:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--idle", type=int, default=10000, help="Number of idle connections.")
+    parser.add_argument("--active", type=int, default=1000, help="Number of active connections.")
+    parser.add_argument("--rate", type=float, default=1, help="Messages per second sent by each active client.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds that active clients send for.")
+    parser.add_argument("--port", type=int, default=5102, help="Port for the benchmark server.")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="Maximum concurrent connection attempts.")
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    if limit < args.idle + args.active + 100:
+        print(f"Warning: file descriptor limit {limit} is too low for {args.idle + args.active} connections.")
+
+    server = Process(target=run_server, args=(args.port, 4096), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        asyncio.run(run_load(args.port, args))
+        rss = server_rss(server.pid)
+        if rss is not None:
+            print(f"Server memory: {rss:.0f} MiB")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Allocation benchmark for encoding and decoding messages, measured with `tracemalloc`.
+For each message type and wire format, reports:
+
+- encode: the peak bytes allocated while encoding one message, including the result
+- decode: the peak bytes allocated while decoding one frame, including the result
+- retained: the bytes kept alive by each decoded message object
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_allocations`.
+"""
+import argparse
+import tracemalloc
+
+from src.protocol import *
+
+
+MESSAGES = [
+    BroadcastMessage(sender="John", direct="Bob", text="Hello Bob, are you coming to the meeting?"),
+    BroadcastMessage(sender="John", text="Hello all!"),
+    ChatMessage(sender="John", recipient="Bob", text="Hello Bob, are you coming to the meeting?"),
+    ChatResponse(success=True),
+    ListResponse(success=True, users=[f"user{i}" for i in range(30)]),
+]
+
+
+def peak_per_call(fn, arg, num_iters):
+    """Return the average peak bytes allocated by `fn(arg)`, including its result."""
+    total = 0
+    for _ in range(num_iters):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        result = fn(arg)
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - start
+        del result
+    return total / num_iters
+
+
+def retained_per_result(fn, arg, num_iters):
+    """Return the average bytes kept alive by each result of `fn(arg)`."""
+    start, _ = tracemalloc.get_traced_memory()
+    results = [fn(arg) for _ in range(num_iters)]
+    current, _ = tracemalloc.get_traced_memory()
+    # The list holding the results is not counted
+    return (current - start - results.__sizeof__()) / num_iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iters", type=int, default=2000, help="Number of calls to average over.")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    print(f"{'message':>17} {'format':>7} {'encode':>8} {'decode':>8} {'retained':>9}  (bytes/msg)")
+    for msg in MESSAGES:
+        deserialize = deserialize_server_message if isinstance(msg, (BroadcastMessage, Response)) else deserialize_client_message
+        for wire_format in WIRE_FORMATS:
+            frame = msg.encode_(wire_format)
+            # Text frames are decoded without the EOM token
+            if wire_format == TEXT_FORMAT:
+                frame = frame.decode()[:-len(Message.EOM_token)]
+            encode = peak_per_call(msg.encode_, wire_format, args.iters)
+            decode = peak_per_call(deserialize, frame, args.iters)
+            retained = retained_per_result(deserialize, frame, args.iters)
+            print(f"{type(msg).__name__:>17} {wire_format:>7} {encode:8.0f} {decode:8.0f} {retained:9.0f}")
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Contention benchmark for the app state. Runs `--threads` threads that each register their
+own users, connect and disconnect them, and queue messages for them, and compares the
+operations per second of:
+
+- unsafe: the AppState without locks
+- global: a SafeAppState with one lock for every user
+- striped: a SafeAppState with `LOCK_STRIPES` locks
+
+Every thread also queues messages for one shared user. The number of rounds that failed
+and of shared messages lost by racing updates is reported for each state.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_app_locking`.
+"""
+import argparse
+import time
+from threading import Barrier, Thread
+
+from src.app import AppState, SafeAppState
+from src.config import config
+
+
+SHARED_USER = "shared"
+
+
+def run_thread(app, thread_id, num_ops, barrier, errors):
+    """Run `num_ops` rounds of operations on the thread's own users and the shared user."""
+    barrier.wait()
+    for i in range(num_ops):
+        username = f"t{thread_id}u{i % 100}"
+        socket = (thread_id, i)
+        try:
+            app.register_user(username)
+            app.add_connection(username, socket)
+            app.queue_message(username, i)
+            app.get_queued_messages(username)
+            app.remove_connection(socket)
+        except Exception:
+            # Races in the unsafe state, e.g. a dict changing size while iterating
+            errors.append(thread_id)
+        app.queue_message(SHARED_USER, i)
+
+
+def run_benchmark(app, num_threads, num_ops):
+    """Return the operations per second, the number of failed rounds and the number of lost shared messages."""
+    app.register_user(SHARED_USER)
+    barrier = Barrier(num_threads + 1)
+    errors = []
+    threads = [Thread(target=run_thread, args=(app, i, num_ops, barrier, errors)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Each round is 6 operations
+    ops_per_sec = num_threads * num_ops * 6 / elapsed
+    lost = num_threads * num_ops - len(app.get_queued_messages(SHARED_USER))
+    return ops_per_sec, len(errors), lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=64, help="Number of threads.")
+    parser.add_argument("--ops", type=int, default=2000, help="Rounds of operations for each thread.")
+    args = parser.parse_args()
+
+    states = {
+        "unsafe": lambda: AppState(),
+        "global": lambda: SafeAppState(num_stripes=1),
+        "striped": lambda: SafeAppState(num_stripes=config["LOCK_STRIPES"]),
+    }
+    for name, make_state in states.items():
+        ops_per_sec, errors, lost = run_benchmark(make_state(), args.threads, args.ops)
+        print(f"{name:>8}: {ops_per_sec:12,.0f} ops/sec, {errors} failed rounds, {lost} lost messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Benchmark for write coalescing and TCP_NODELAY. For each server mode in `--modes`, starts
+the server on a free localhost port with every combination of `COALESCE_WRITES` and
+`TCP_NODELAY`. Then `--num-clients` client processes each send `--num-chats` direct
+messages to the next client, waiting for the ChatResponse of each one before sending
+the next. Reports:
+
+- sends/chat: the number of send syscalls the server made for each chat, which covers
+  the echo and the response to the sender, and the message to the recipient
+- p50 and p99: the latency from sending a chat to receiving its response
+
+Without coalescing, the echo and the response are written separately, and without
+TCP_NODELAY the response can wait for the client to acknowledge the echo. The writer
+threads of the threaded mode already send everything that is queued when they wake up,
+so coalescing saves the most in the modes that write immediately.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_coalescing`.
+"""
+import argparse
+import asyncio
+import logging
+import socket
+import time
+from multiprocessing import get_context
+from threading import Lock, Thread
+
+from src import server
+from src.aio_server import serve_asyncio
+from src.app import AppState, SafeAppState
+from src.protocol import *
+from src.reactor import Reactor
+
+
+MODES = ("threaded", "reactor", "asyncio")
+
+
+class SendCounter:
+    """Counts the send calls of every socket in the process, by wrapping the socket methods."""
+    def __init__(self):
+        self.count = 0
+        self._lock = Lock()
+
+    def install(self):
+        for name in ("send", "sendall", "sendmsg"):
+            setattr(socket.socket, name, self._wrap(getattr(socket.socket, name)))
+
+    def _wrap(self, method):
+        def counted(sock, *args):
+            with self._lock:
+                self.count += 1
+            return method(sock, *args)
+        return counted
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port):
+    """Start a server in the mode on a daemon thread."""
+    if mode == "threaded":
+        target, args = server.serve_threaded, ("127.0.0.1", port, SafeAppState())
+    elif mode == "reactor":
+        reactor = Reactor(SafeAppState())
+        reactor.listen("127.0.0.1", port)
+        target, args = reactor.serve_forever, ()
+    else:
+        async def run():
+            await serve_asyncio("127.0.0.1", port, AppState())
+            await asyncio.Event().wait()
+        target, args = asyncio.run, (run(),)
+    Thread(target=target, args=args, daemon=True).start()
+
+
+def receive_until(sock, decoder, response_cls):
+    """Receive messages until one of the response type arrives."""
+    while True:
+        msgs = decoder.recv(sock)
+        if msgs is None:
+            raise ConnectionError("Server disconnected.")
+        for msg in msgs:
+            if isinstance(msg, response_cls):
+                return msg
+
+
+def run_client(port, username, recipient, num_chats, barrier, results):
+    """Client process that registers, then sends chats to the recipient one at a time."""
+    for _ in range(100):
+        try:
+            sock = socket.create_connection(("127.0.0.1", port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    with sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = StreamDecoder(deserialize_server_message)
+        sock.sendall(RegisterMessage(username=username, wire_format=BINARY_FORMAT).encode_())
+        assert receive_until(sock, decoder, RegisterResponse).success
+        barrier.wait()
+        barrier.wait()
+        latencies = []
+        for i in range(num_chats):
+            data = ChatMessage(sender=username, recipient=recipient, text=f"Hello {i}").encode_(BINARY_FORMAT)
+            start = time.perf_counter()
+            sock.sendall(data)
+            assert receive_until(sock, decoder, ChatResponse).success
+            latencies.append(time.perf_counter() - start)
+        results.put(latencies)
+        barrier.wait()
+
+
+def bench(mode, counter, num_clients, num_chats):
+    """Return the sends per chat, and the sorted latencies in seconds, for one configuration."""
+    port = free_port()
+    start_server(mode, port)
+
+    ctx = get_context("spawn")
+    barrier = ctx.Barrier(num_clients + 1)
+    results = ctx.Queue()
+    clients = [ctx.Process(target=run_client, args=(port, f"user{i}", f"user{(i + 1) % num_clients}",
+                                                    num_chats, barrier, results))
+               for i in range(num_clients)]
+    for client in clients:
+        client.start()
+    # Only count the sends for the chats, after every client registered
+    barrier.wait()
+    counter.count = 0
+    barrier.wait()
+    latencies = [latency for _ in clients for latency in results.get()]
+    barrier.wait()
+    sends = counter.count
+    for client in clients:
+        client.join()
+    return sends / (num_clients * num_chats), sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES), help="Server modes to run.")
+    parser.add_argument("--num-clients", type=int, default=4, help="Number of client processes.")
+    parser.add_argument("--num-chats", type=int, default=2000, help="Number of chats sent by each client.")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    counter = SendCounter()
+    counter.install()
+
+    print(f"{args.num_clients} clients, {args.num_chats:,} chats each")
+    for mode in args.modes:
+        for coalesce in (False, True):
+            for nodelay in (False, True):
+                server.COALESCE_WRITES = coalesce
+                server.TCP_NODELAY = nodelay
+                sends, latencies = bench(mode, counter, args.num_clients, args.num_chats)
+                p50 = latencies[len(latencies) // 2] * 1e6
+                p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+                name = f"{mode}, coalesce={'on' if coalesce else 'off'}, nodelay={'on' if nodelay else 'off'}"
+                print(f"  {name:>38}: {sends:5.2f} sends/chat, p50 {p50:6.0f} us, p99 {p99:6.0f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark for the CPU-vs-bytes tradeoff of zlib compression. For full ListResponses
+and for queue backlogs of direct messages, compares the binary wire format with and
+without compression, and reports the bytes sent, the number of `MAX_BUFFER_SIZE`
+bounded sends, and the time spent encoding and decoding.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_compression`.
+"""
+import argparse
+import time
+
+from src.protocol import *
+
+
+def list_responses(num_responses):
+    """Return full ListResponses of realistic usernames."""
+    return [ListResponse(success=True, users=[f"user_{i}_{j:04d}" for j in range(ListResponse.max_num_users)],
+                         limit_exceeded=True) for i in range(num_responses)]
+
+
+def backlog(num_msgs):
+    """Return a backlog of direct messages from a few senders."""
+    texts = ["Are you coming to the meeting?", "Sounds good, see you then!", "Can you send me the notes from today?"]
+    return [BroadcastMessage(sender=f"user{i % 5}", direct="Bob", text=f"{texts[i % 3]} ({i})") for i in range(num_msgs)]
+
+
+def encode_responses(msgs, wire_format):
+    """Return each response encoded as its own batch."""
+    return [[msg.encode_(wire_format)] for msg in msgs]
+
+
+def bench(encode_fn, msgs, wire_format, repeat):
+    """Return the number of batches, bytes, and best encode and decode times in milliseconds."""
+    best_encode = best_decode = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        batches = encode_fn(msgs, wire_format)
+        best_encode = min(best_encode, time.perf_counter() - start)
+
+        buffers = [b"".join(batch) for batch in batches]
+        start = time.perf_counter()
+        decoded = sum(len(decode_server_buffer(buffer)) for buffer in buffers)
+        best_decode = min(best_decode, time.perf_counter() - start)
+        assert decoded == len(msgs)
+    return len(batches), sum(len(buffer) for buffer in buffers), best_encode * 1000, best_decode * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-msgs", type=int, default=10000, help="Number of messages in the backlog.")
+    parser.add_argument("--num-lists", type=int, default=1000, help="Number of ListResponses.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best is reported.")
+    args = parser.parse_args()
+
+    workloads = [
+        ("list responses", encode_responses, list_responses(args.num_lists)),
+        ("queue backlog", encode_msg_batches, backlog(args.num_msgs)),
+    ]
+    for name, encode_fn, msgs in workloads:
+        print(f"{name} ({len(msgs):,} messages)")
+        for wire_format in [BINARY_FORMAT, COMPRESSED_FORMAT]:
+            num_sends, num_bytes, encode_ms, decode_ms = bench(encode_fn, msgs, wire_format, args.repeat)
+            print(f"  {wire_format:>12}: {num_bytes:12,} bytes, {num_sends:8,} sends, "
+                  f"encode {encode_ms:8.1f} ms, decode {decode_ms:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
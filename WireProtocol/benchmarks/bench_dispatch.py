@@ -0,0 +1,98 @@
+"""
+Micro-benchmark for the per-message dispatch overhead. For each client message type,
+reports the nanoseconds per message spent finding the message class for a decoded
+header and the service for a decoded message, with:
+
+- chain: the if/elif chains of header compares and `isinstance` checks that were
+  used before the registries
+- registry: the dict lookups in `CLIENT_MESSAGES` and `SERVICES`
+
+It also reports the time of a full `deserialize_client_message` call with each wire
+format, for comparison.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_dispatch`.
+"""
+import argparse
+import time
+
+from src.protocol import *
+from src.server import SERVICES
+
+
+MESSAGES = [
+    RegisterMessage(username="John"),
+    ChatMessage(sender="John", text="Hello"),
+    ListMessage(wildcard="Jo*"),
+    DeleteMessage(username="John"),
+    QueueMessage(username="John"),
+]
+
+
+def chain_class(header):
+    """Return the message class for the header with an if/elif chain of header compares."""
+    if header == RegisterMessage.enc_header:
+        return RegisterMessage
+    elif header == ChatMessage.enc_header:
+        return ChatMessage
+    elif header == ListMessage.enc_header:
+        return ListMessage
+    elif header == DeleteMessage.enc_header:
+        return DeleteMessage
+    elif header == QueueMessage.enc_header:
+        return QueueMessage
+    raise ValueError("Unknown message type header received from client.")
+
+
+def chain_service(msg):
+    """Return the service for the message with an if/elif chain of `isinstance` checks."""
+    if isinstance(msg, RegisterMessage):
+        return SERVICES["REG"][0]
+    elif isinstance(msg, ChatMessage):
+        return SERVICES["MSG"][0]
+    elif isinstance(msg, ListMessage):
+        return SERVICES["LST"][0]
+    elif isinstance(msg, DeleteMessage):
+        return SERVICES["DEL"][0]
+    elif isinstance(msg, QueueMessage):
+        return SERVICES["QUE"][0]
+    raise NotImplementedError
+
+
+def chain_dispatch(msg):
+    return chain_class(msg.enc_header), chain_service(msg)
+
+
+def registry_dispatch(msg):
+    return CLIENT_MESSAGES[msg.enc_header], SERVICES[msg.enc_header][0]
+
+
+def bench(fn, arg, num_iters, repeat):
+    """Return the best time in nanoseconds of one call of `fn(arg)` over `repeat` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(num_iters):
+            fn(arg)
+        best = min(best, time.perf_counter_ns() - start)
+    return best / num_iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iters", type=int, default=200000, help="Number of calls in each run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best is reported.")
+    args = parser.parse_args()
+
+    print(f"{'message':>15} {'chain':>9} {'registry':>9} {'decode text':>12} {'decode binary':>14}  (ns/msg)")
+    for msg in MESSAGES:
+        chain = bench(chain_dispatch, msg, args.iters, args.repeat)
+        registry = bench(registry_dispatch, msg, args.iters, args.repeat)
+        # Text frames are decoded without the EOM token
+        text = msg.encode_(TEXT_FORMAT).decode()[:-len(Message.EOM_token)]
+        decode_text = bench(deserialize_client_message, text, args.iters, args.repeat)
+        decode_binary = bench(deserialize_client_message, msg.encode_(BINARY_FORMAT), args.iters, args.repeat)
+        print(f"{type(msg).__name__:>15} {chain:9.1f} {registry:9.1f} {decode_text:12.1f} {decode_binary:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark for the cost of logging on the message path. Handles `--num-msgs` messages, a mix
+of direct chats between two users and list requests, with `handle_messages` in batches of
+`--batch-size`, and reports the best messages handled per second over `--repeat` runs with
+logging at INFO and DEBUG:
+
+- sync: a StreamHandler on the root logger that formats and writes each record on the
+  thread that logs it, as `logging.basicConfig` sets up
+- queue: the pipeline of `configure_logging`, which writes the records on a background
+  thread, and only logs one in `LOG_SAMPLE_RATES` of the events logged for every message
+
+Records are written to a temporary file.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_logging`.
+"""
+import argparse
+import logging
+import tempfile
+import time
+
+from src import server
+from src.app import AppState
+from src.log import configure_logging, stop_logging
+from src.protocol import *
+
+
+LEVELS = ("INFO", "DEBUG")
+FORMAT = "(%(threadName)-9s) %(message)s"
+
+
+class StubSocket:
+    """Socket that discards the bytes sent to it."""
+    def sendall(self, data):
+        pass
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+    def getsockname(self):
+        return ("127.0.0.1", 5002)
+
+
+def bench(num_msgs, batch_size):
+    """Return the messages handled per second."""
+    app = AppState()
+    socks = {}
+    for username in ("John", "Jane"):
+        socks[username] = StubSocket()
+        server.handle_messages([RegisterMessage(username=username, wire_format=BINARY_FORMAT)], app, socks[username])
+    batch = [ChatMessage(sender="John", recipient="Jane", text=f"Hello {i}") for i in range(batch_size - 1)]
+    batch.append(ListMessage())
+
+    start = time.perf_counter()
+    for _ in range(num_msgs // batch_size):
+        server.handle_messages(batch, app, socks["John"])
+    return num_msgs // batch_size * batch_size / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-msgs", type=int, default=200_000, help="Number of messages handled for each setup.")
+    parser.add_argument("--batch-size", type=int, default=10, help="Number of messages handled together.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best is reported.")
+    args = parser.parse_args()
+    # The messages are sent faster than the rate limits allow
+    server.rate_limiter.limits = {}
+
+    root = logging.getLogger()
+    with tempfile.TemporaryFile("w") as output:
+        for pipeline in ("sync", "queue"):
+            for level in LEVELS:
+                if pipeline == "sync":
+                    handler = logging.StreamHandler(output)
+                    handler.setFormatter(logging.Formatter(FORMAT))
+                    root.addHandler(handler)
+                    root.setLevel(level)
+                else:
+                    configure_logging(level=level, fmt=FORMAT, stream=output)
+                msgs_per_s = max(bench(args.num_msgs, args.batch_size) for _ in range(args.repeat))
+                if pipeline == "sync":
+                    root.removeHandler(handler)
+                else:
+                    stop_logging()
+                print(f"  {pipeline:>5} {level:>5}: {msgs_per_s:10,.0f} msgs/s")
+
+
+if __name__ == "__main__":
+    main()
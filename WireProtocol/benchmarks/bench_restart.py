@@ -0,0 +1,80 @@
+"""
+Benchmark for restarting a persisted server. Fills a journal directory with a snapshot
+of `--num-users` registered users, a fraction of them with queued messages, and a log
+of `--num-records` changes made after the snapshot. Then reports the time to:
+
+- snapshot: write the snapshot of the app state
+- log: write the log records, in batches as the journal's thread does
+- recover: read the snapshot and replay the log, and restore a new SafeAppState from them
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_restart`.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from src.app import SafeAppState
+from src.persistence import Journal
+from src.protocol import *
+from src.queue_store import QueueStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-users", type=int, default=1_000_000, help="Number of users in the snapshot.")
+    parser.add_argument("--num-records", type=int, default=200_000, help="Number of log records after the snapshot.")
+    parser.add_argument("--queued-fraction", type=float, default=0.1, help="Fraction of users with queued messages.")
+    parser.add_argument("--msgs-per-user", type=int, default=5, help="Number of messages queued for those users.")
+    parser.add_argument("--no-fsync", action="store_true", help="Don't fsync the log.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench-restart-")
+    store = QueueStore()
+    try:
+        users = [f"user{i}" for i in range(args.num_users)]
+        num_queued = int(args.num_users * args.queued_fraction)
+        msgs = [BroadcastMessage(sender="John", direct="user", text=f"Are you coming to the meeting? ({i})")
+                for i in range(args.msgs_per_user)]
+        journal = Journal(directory, flush_interval=3600, fsync=not args.no_fsync)
+        app = journal.attach(SafeAppState(queue_store=store))
+        app.restore(users, [(username, 1, msgs) for username in users[:num_queued]])
+        start = time.perf_counter()
+        journal.snapshot()
+        snapshot_s = time.perf_counter() - start
+
+        # Half of the records register new users, and half queue messages for them
+        start = time.perf_counter()
+        for i in range(args.num_records // 2):
+            username = f"zz{i}" # Sorted after the other users
+            app.register_user(username)
+            app.queue_message(username, msgs[0])
+            if i % 1000 == 999:
+                journal.flush()
+        journal.close()
+        log_s = time.perf_counter() - start
+        sizes = {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)}
+        store.close()
+
+        store = QueueStore()
+        start = time.perf_counter()
+        journal = Journal(directory, flush_interval=3600)
+        restarted = journal.attach(SafeAppState(queue_store=store))
+        recover_s = time.perf_counter() - start
+        journal.close()
+        assert restarted.is_valid_user(users[-1]) and restarted.is_valid_user(f"zz{args.num_records // 2 - 1}")
+    finally:
+        store.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{args.num_users:,} users, {num_queued * args.msgs_per_user:,} queued messages, {args.num_records:,} log records")
+    for name, size in sorted(sizes.items()):
+        print(f"  {name:>16}: {size:14,} bytes")
+    print(f"  snapshot {snapshot_s * 1000:8.0f} ms")
+    print(f"  log      {log_s * 1000:8.0f} ms ({log_s / args.num_records * 1e6:.1f} us/record, including the services)")
+    print(f"  recover  {recover_s * 1000:8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
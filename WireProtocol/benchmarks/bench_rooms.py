@@ -0,0 +1,65 @@
+"""
+Benchmark for the fan-out cost of room messages. With `--num-users` active users, each
+with a stub socket that discards what is sent to it, reports the microseconds per chat
+handled by `chat_service` for:
+
+- broadcast: a "^" broadcast to every active user
+- room: a message to a room with `--room-size` members, for each room size
+
+The cost of a room message depends on the room's size, and not on the number of users.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_rooms`.
+"""
+import argparse
+import time
+
+from src.app import SafeAppState
+from src.protocol import *
+from src.server import chat_service
+
+
+class StubSocket:
+    """Socket that discards the bytes sent to it."""
+    def sendall(self, data):
+        pass
+
+
+def bench(msg, app, repeat):
+    """Return the best time in microseconds to handle the message over `repeat` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = chat_service(msg, app)
+        best = min(best, time.perf_counter() - start)
+        assert res.success
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-users", type=int, default=100000, help="Number of active users.")
+    parser.add_argument("--room-size", type=int, nargs="+", default=[10, 100, 1000], help="Number of members of each room.")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of runs, the best is reported.")
+    args = parser.parse_args()
+
+    app = SafeAppState()
+    for i in range(args.num_users):
+        username = f"user{i}"
+        app.register_user(username)
+        app.add_connection(username, StubSocket())
+        app.set_wire_format(app.get_user_connection(username), BINARY_FORMAT)
+    for room_size in args.room_size:
+        for i in range(room_size):
+            app.join_room(f"user{i}", f"room{room_size}")
+
+    print(f"{args.num_users:,} active users")
+    broadcast_us = bench(ChatMessage(sender="user0", text="Hello all!"), app, args.repeat)
+    print(f"  {'broadcast':>16}: {broadcast_us:10.1f} us/chat")
+    for room_size in args.room_size:
+        msg = ChatMessage(sender="user0", recipient=f"{ROOM_PREFIX}room{room_size}", text="Hello room!")
+        room_us = bench(msg, app, args.repeat)
+        print(f"  {f'room of {room_size:,}':>16}: {room_us:10.1f} us/chat")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Throughput benchmark for the sharded server mode. For each number of workers in
+`--workers`, starts the sharded server, then runs `--clients` client processes that each
+register a user and send direct messages to another client's user for `--duration`
+seconds, keeping up to `--window` messages in flight. Reports the chat responses
+received per second, so the scaling with the number of workers can be compared.
+
+Direct messages between users owned by different workers are routed between the
+worker processes, so the results include the cost of cross-worker delivery.
+The scaling is limited by the number of cores available to the server and clients.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_sharded`.
+"""
+import argparse
+import logging
+import os
+import socket
+import time
+from multiprocessing import Process, Queue
+
+from src.protocol import *
+from src.sharding import run_sharded
+
+
+HOST = "127.0.0.1"
+
+
+def run_server(port, num_workers):
+    """Run the sharded server, used as the target of the server process."""
+    logging.disable(logging.CRITICAL)
+    run_sharded(HOST, port, num_workers=num_workers, backlog=1024)
+
+
+def run_client(port, username, recipient, duration, window, results):
+    """Send direct messages for `duration` seconds and put the number of responses in `results`."""
+    s = socket.create_connection((HOST, port))
+    decoder = StreamDecoder(deserialize_server_message)
+    s.sendall(RegisterMessage(username=username, wire_format=BINARY_FORMAT).encode_())
+    while not any(isinstance(msg, RegisterResponse) for msg in decoder.recv(s)):
+        pass
+    # Wait for the other clients to register
+    time.sleep(1)
+
+    msg = ChatMessage(sender=username, recipient=recipient, text="A" * 100).encode_(BINARY_FORMAT)
+    sent = responses = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        # Keep `window` messages in flight
+        s.sendall(msg * (window - (sent - responses)))
+        sent += window - (sent - responses)
+        msgs = decoder.recv(s)
+        if msgs is None:
+            break
+        responses += sum(isinstance(msg, ChatResponse) for msg in msgs)
+    results.put((responses, time.perf_counter() - start))
+    s.close()
+
+
+def run_load(port, num_workers, args):
+    """Start the server with `num_workers` workers and return the chat responses per second."""
+    server = Process(target=run_server, args=(port, num_workers))
+    server.start()
+    time.sleep(1)
+    try:
+        results = Queue()
+        clients = [
+            Process(target=run_client, args=(port, f"user{i}", f"user{(i + 1) % args.clients}",
+                                             args.duration, args.window, results))
+            for i in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        counts = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.join()
+    return sum(responses / elapsed for responses, elapsed in counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of workers to compare.")
+    parser.add_argument("--clients", type=int, default=8, help="Number of client processes.")
+    parser.add_argument("--window", type=int, default=32, help="Messages in flight for each client.")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds that clients send for.")
+    parser.add_argument("--port", type=int, default=5103, help="Port for the benchmark server.")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs available")
+    baseline = None
+    for i, num_workers in enumerate(args.workers):
+        # Use a new port for each run, so connections from the previous run don't interfere
+        rate = run_load(args.port + i, num_workers, args)
+        baseline = baseline or rate
+        print(f"{num_workers} workers: {rate:,.0f} chats/sec ({rate / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmark for decode throughput of the text and binary wire formats. Builds a
+mix of server messages, encodes them into MAX_BUFFER_SIZE chunks with each format,
+and reports the number of messages per second that are framed by `split_frames`
+and fully decoded by `decode_server_buffer`.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.bench_wire_format`.
+"""
+import argparse
+import logging
+import time
+
+from src.protocol import *
+
+
+def build_messages(num_msgs):
+    """Return a list of server messages with a realistic mix of types."""
+    msgs = []
+    for i in range(num_msgs):
+        if i % 10 == 0:
+            msgs.append(ListResponse(success=True, users=[f"user{j}" for j in range(20)]))
+        elif i % 10 == 1:
+            msgs.append(ChatResponse(success=True))
+        else:
+            msgs.append(BroadcastMessage(sender=f"user{i % 50}", text="A" * (i % 280), direct="Bob" if i % 2 else None))
+    return msgs
+
+
+def bench_decode(decode_fn, buffers, num_msgs, repeat):
+    """
+    Return the best throughput in messages per second over `repeat` runs, where
+    `decode_fn` takes a buffer and returns a list of messages or frames.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decoded = 0
+        for buffer in buffers:
+            decoded += len(decode_fn(buffer))
+        best = min(best, time.perf_counter() - start)
+        assert decoded == num_msgs
+    return num_msgs / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-msgs", type=int, default=100000, help="Number of messages to decode.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best is reported.")
+    args = parser.parse_args()
+
+    # Silence the decoding warnings
+    logging.disable(logging.WARNING)
+
+    msgs = build_messages(args.num_msgs)
+    for wire_format in WIRE_FORMATS:
+        buffers = encode_msg_queue(msgs, wire_format)
+        framing_rate = bench_decode(lambda b: split_frames(b)[0], buffers, args.num_msgs, args.repeat)
+        decode_rate = bench_decode(decode_server_buffer, buffers, args.num_msgs, args.repeat)
+        print(f"{wire_format:>8}: framing {framing_rate:12,.0f} msgs/sec, decode {decode_rate:12,.0f} msgs/sec "
+              f"({sum(len(b) for b in buffers):,} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Load generator for the server. For each server mode in `--modes`, starts the server in
+its own process on a free localhost port, with the rate limits disabled. Then
+`--clients` simulated clients, spread over `--processes` client processes, register
+and send a mix of messages for `--duration` seconds at a total of `--rate` messages
+per second. `--mix` sets the weights of the message types:
+
+- dm: a ChatMessage to another client's user
+- broadcast: a ChatMessage to every active user
+- list: a ListMessage for every user
+- queue: a QueueMessage for the client's own queue, which is empty, so the response
+  is an error
+
+Messages are sent on a fixed schedule, whether or not the previous ones were answered,
+so a slow server shows up as latency rather than as a lower sending rate. Every message
+has a request ID. Chats carry the time they were sent, from `time.time_ns`, which is
+the same clock in every process, at the start of their text. After sending, the
+clients keep receiving for `--drain` seconds. Reports:
+
+- the messages sent, responses and deliveries per second, where a delivery is a chat
+  received by a client other than its sender
+- the p50, p95 and p99 delivery latency, from sending a chat to another client
+  receiving it
+- the p50, p95 and p99 response latency of each message type, from sending a message
+  to receiving the response with its request ID
+- failed responses and requests left without a response
+
+Everything runs on localhost, so the results also include the cost of the client
+processes on the same cores.
+
+Run from the `WireProtocol` directory with `python3 -m benchmarks.loadgen`.
+"""
+import argparse
+import logging
+import os
+import random
+import selectors
+import socket
+import sys
+import time
+from collections import Counter, defaultdict
+from multiprocessing import get_context
+
+from src import server
+from src.aio_server import run_asyncio
+from src.app import AppState, SafeAppState
+from src.protocol import *
+from src.queue_store import QueueStore
+from src.reactor import run_reactor
+from src.sharding import run_sharded
+
+
+HOST = "127.0.0.1"
+MODES = ("threaded", "asyncio", "reactor", "sharded")
+MESSAGE_TYPES = ("dm", "broadcast", "list", "queue")
+PERCENTILES = (0.50, 0.95, 0.99)
+# Listen backlog of the server, so every client can connect at once
+BACKLOG = 1024
+
+
+def parse_mix(value):
+    """Parse a mix such as "dm=70,broadcast=5,list=15,queue=10" into a dict of weights."""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in MESSAGE_TYPES:
+            raise argparse.ArgumentTypeError(f"Unknown message type '{name}', expected one of {', '.join(MESSAGE_TYPES)}.")
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("The mix needs a positive weight.")
+    return mix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def run_server(mode, port):
+    """Run the server in the mode, used as the target of the server process."""
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, "w")
+    # The clients send faster than the rate limits allow
+    server.rate_limiter.limits = {}
+    if mode == "threaded":
+        server.serve_threaded(HOST, port, SafeAppState(queue_store=QueueStore()), backlog=BACKLOG)
+    elif mode == "asyncio":
+        run_asyncio(HOST, port, AppState(queue_store=QueueStore()), backlog=BACKLOG)
+    elif mode == "reactor":
+        run_reactor(HOST, port, SafeAppState(queue_store=QueueStore()), backlog=BACKLOG)
+    else:
+        run_sharded(HOST, port, backlog=BACKLOG)
+
+
+class SimulatedClient:
+    """A connection of a simulated client, and its requests that wait for a response."""
+    def __init__(self, port, username):
+        self.username = username
+        self.decoder = StreamDecoder(deserialize_server_message)
+        self.pending = {} # Map of request IDs to the message type and the time it was sent
+        self._next_id = 0
+        for _ in range(100):
+            try:
+                self.sock = socket.create_connection((HOST, port))
+                break
+            except ConnectionRefusedError:
+                # The server is still starting
+                time.sleep(0.05)
+        else:
+            raise ConnectionError(f"Cannot connect to the server on port {port}.")
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def register(self):
+        """Register the client's user, and wait for the response."""
+        self.sock.sendall(RegisterMessage(username=self.username, wire_format=BINARY_FORMAT).encode_())
+        while True:
+            msgs = self.decoder.recv(self.sock)
+            if msgs is None:
+                raise ConnectionError("Server disconnected.")
+            for msg in msgs:
+                if isinstance(msg, RegisterResponse):
+                    if not msg.success:
+                        raise RuntimeError(f"Cannot register {self.username}: {msg.error}")
+                    return
+
+    def send(self, msg_type, msg):
+        """Send a message with the next request ID."""
+        self._next_id += 1
+        msg.request_id = self._next_id
+        self.pending[self._next_id] = (msg_type, time.perf_counter())
+        self.sock.sendall(msg.encode_(BINARY_FORMAT))
+
+
+def make_message(msg_type, client, recipients, rng, padding):
+    """Return a message of the type from the client."""
+    if msg_type == "dm":
+        return ChatMessage(sender=client.username, recipient=rng.choice(recipients),
+                           text=f"{time.time_ns()} {padding}")
+    if msg_type == "broadcast":
+        return ChatMessage(sender=client.username, text=f"{time.time_ns()} {padding}")
+    if msg_type == "list":
+        return ListMessage()
+    return QueueMessage(username=client.username)
+
+
+def run_clients(port, usernames, all_usernames, rate, duration, drain, mix, payload_size, seed, barrier, results):
+    """
+    Client process that registers the users, sends messages at `rate` messages per
+    second for `duration` seconds, and puts its counts and latencies in `results`.
+    """
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(seed)
+    padding = "x" * payload_size
+    clients = [SimulatedClient(port, username) for username in usernames]
+    for client in clients:
+        client.register()
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_READ, client)
+    types, weights = list(mix), list(mix.values())
+    # Map of each client to the users it sends direct messages to
+    recipients = {client: [username for username in all_usernames if username != client.username] for client in clients}
+
+    sent = Counter()
+    responses = Counter()
+    failures = Counter()
+    response_latencies = defaultdict(list)
+    delivery_latencies = []
+    barrier.wait()
+
+    start = time.perf_counter()
+    end = start + duration
+    next_send = start
+    while True:
+        now = time.perf_counter()
+        if now >= end + drain:
+            break
+        # Send every message that is due, catching up if receiving took too long
+        while next_send <= now < end:
+            client = rng.choice(clients)
+            msg_type = rng.choices(types, weights)[0]
+            client.send(msg_type, make_message(msg_type, client, recipients[client], rng, padding))
+            sent[msg_type] += 1
+            next_send += 1 / rate
+        timeout = (next_send if now < end else end + drain) - now
+        for key, _ in selector.select(max(timeout, 0)):
+            client = key.data
+            msgs = client.decoder.recv(client.sock)
+            received_at, received_ns = time.perf_counter(), time.time_ns()
+            if msgs is None:
+                raise ConnectionError("Server disconnected.")
+            for msg in msgs:
+                if isinstance(msg, BroadcastMessage):
+                    # Echoes of the client's own chats are not deliveries
+                    if msg.sender != client.username:
+                        delivery_latencies.append((received_ns - int(msg.text.split(" ", 1)[0])) / 1e9)
+                elif msg.request_id in client.pending:
+                    msg_type, sent_at = client.pending.pop(msg.request_id)
+                    responses[msg_type] += 1
+                    response_latencies[msg_type].append(received_at - sent_at)
+                    if not msg.success:
+                        failures[msg_type] += 1
+    unanswered = sum(len(client.pending) for client in clients)
+    for client in clients:
+        client.sock.close()
+    results.put((sent, responses, failures, dict(response_latencies), delivery_latencies, unanswered))
+
+
+def percentiles(latencies):
+    """Return the PERCENTILES of the latencies in microseconds, formatted for the report."""
+    if not latencies:
+        return "no samples"
+    latencies = sorted(latencies)
+    return ", ".join(f"p{p * 100:.0f} {latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1e6:8,.0f} us"
+                     for p in PERCENTILES)
+
+
+def run_load(mode, args):
+    """Start the server in the mode, run the clients, and print the report."""
+    port = free_port()
+    ctx = get_context("fork")
+    server_process = ctx.Process(target=run_server, args=(mode, port))
+    server_process.start()
+    try:
+        usernames = [f"user{i}" for i in range(args.clients)]
+        barrier = ctx.Barrier(args.processes + 1)
+        results = ctx.Queue()
+        clients = [ctx.Process(target=run_clients,
+                               args=(port, usernames[i::args.processes], usernames, args.rate / args.processes,
+                                     args.duration, args.drain, args.mix, args.payload_size, args.seed + i,
+                                     barrier, results))
+                   for i in range(args.processes)]
+        for client in clients:
+            client.start()
+        # Start sending once every client registered
+        barrier.wait(timeout=60)
+        reports = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    sent, responses, failures = Counter(), Counter(), Counter()
+    response_latencies = defaultdict(list)
+    delivery_latencies = []
+    unanswered = 0
+    for report in reports:
+        sent.update(report[0])
+        responses.update(report[1])
+        failures.update(report[2])
+        for msg_type, latencies in report[3].items():
+            response_latencies[msg_type] += latencies
+        delivery_latencies += report[4]
+        unanswered += report[5]
+
+    print(f"{mode}:")
+    print(f"  sent {sum(sent.values()) / args.duration:10,.0f} msgs/s, "
+          f"{sum(responses.values()) / args.duration:10,.0f} responses/s, "
+          f"{len(delivery_latencies) / args.duration:10,.0f} deliveries/s")
+    print(f"  {'delivery':>9}: {percentiles(delivery_latencies)}")
+    for msg_type in args.mix:
+        print(f"  {msg_type:>9}: {percentiles(response_latencies[msg_type])}, "
+              f"{failures[msg_type]:,} of {responses[msg_type]:,} failed")
+    if unanswered:
+        print(f"  {unanswered:,} messages without a response")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES), help="Server modes to run.")
+    parser.add_argument("--clients", type=int, default=50, help="Number of simulated clients.")
+    parser.add_argument("--processes", type=int, default=2, help="Number of client processes.")
+    parser.add_argument("--rate", type=float, default=2000, help="Messages sent per second by all clients.")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds that clients send for.")
+    parser.add_argument("--drain", type=float, default=1, help="Seconds that clients keep receiving after sending.")
+    parser.add_argument("--mix", type=parse_mix, default="dm=70,broadcast=5,list=15,queue=10",
+                        help="Weights of the message types, e.g. dm=70,broadcast=5,list=15,queue=10.")
+    parser.add_argument("--payload-size", type=int, default=64, help="Characters of text after the timestamp of each chat.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random clients and message types.")
+    args = parser.parse_args()
+    if args.clients < 2 or args.processes > args.clients:
+        parser.error("There must be at least 2 clients, and at least one for each process.")
+
+    print(f"{args.clients} clients in {args.processes} processes, {args.rate:,.0f} msgs/s for {args.duration:g} s, "
+          f"mix {', '.join(f'{name}={weight:g}' for name, weight in args.mix.items())}")
+    for mode in args.modes:
+        run_load(mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import logging
 import re
 
 # holds the overall state of the application--> users and their message lists, allows the server to delete, list, and send messages
@@ -49,7 +50,7 @@ class App:
         else:
             if len(self.users[username].messages) > 0:
                 msg = self.users[username].messages.pop(0)
-                print("msg in queue!--> " + msg.message)
+                logging.debug("msg in queue!--> %s", msg.message)
                 from_user = msg.from_user
                 msgText = msg.message
             return str(from_user + ": " + msgText)
@@ -58,7 +59,7 @@ class App:
         response = ""
         try:
             matchedUsers = [user for user in self.users if re.match(wildcard, user)]
-            print(matchedUsers)
+            logging.debug("Matched users: %s", matchedUsers)
             for user in matchedUsers:
                 response += str(self.users[user].username + ", ")
         except Exception:
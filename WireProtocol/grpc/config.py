@@ -7,5 +7,6 @@ config = {
     "MAX_NUM_CONNECTIONS": 10,
     "SERVER_HOST": "0.0.0.0", # Address the server binds to
     "SERVER_PORT": 5002,
-    "SERVER_ADDRESS": "localhost" # The IP address of the server
+    "SERVER_ADDRESS": "localhost", # The IP address of the server
+    "LOG_LEVEL": "INFO", # Minimum level of the logged records, e.g. "DEBUG" logs every request
 }
\ No newline at end of file
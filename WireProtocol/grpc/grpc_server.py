@@ -5,13 +5,15 @@ import chat_pb2
 import chat_pb2_grpc
 from app import App
 import logging
+import os
+import sys
 from config import config
 
-chatServer = App()
+# the logging setup is shared with the server in `src`, which is in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.log import configure_logging, stop_logging
 
-# Logging config
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-9s) %(message)s',)
+chatServer = App()
 
 
 # Server config
@@ -19,6 +21,7 @@ SERVER_HOST = config["SERVER_HOST"]
 SERVER_PORT = config["SERVER_PORT"]
 MAX_BUFFER_SIZE = config["MAX_BUFFER_SIZE"]
 MAX_NUM_CONNECTIONS = config["MAX_NUM_CONNECTIONS"]
+LOG_LEVEL = config["LOG_LEVEL"]
 
 
 # define all of the grpc functions on the server side
@@ -30,7 +33,7 @@ class Chat(chat_pb2_grpc.ChatServicer):
     # (3) user is already registered but not logged in. They are re-logged in and able to join.
     def create_user(self, request, _context):
         username = request.username
-        print("Joining user: " + username)
+        logging.info("Joining user: %s", username)
         result = chatServer.create_user(username)
         if result == 0:
             response = "SUCCESS"
@@ -46,7 +49,7 @@ class Chat(chat_pb2_grpc.ChatServicer):
         from_user = request.from_user
         to_user = request.to_user
         msg = request.message
-        print("sending message from: " + from_user + " to: " + str(to_user))
+        logging.debug("Sending message from: %s to: %s", from_user, to_user)
         result = chatServer.send_message(from_user, to_user, msg)
         return chat_pb2.ChatReply(message = result)
 
@@ -77,7 +80,7 @@ class Chat(chat_pb2_grpc.ChatServicer):
         user_deleting = request.from_user
         response = chatServer.delete_user(user_to_delete, user_deleting)
         if response == True:
-            print("User " + user_to_delete + " deleted by " + user_deleting)
+            logging.info("User %s deleted by %s", user_to_delete, user_deleting)
             response = "Success."
         return chat_pb2.ChatReply(message = response)
 
@@ -86,13 +89,15 @@ class Chat(chat_pb2_grpc.ChatServicer):
         user = request.username
         response = chatServer.logout_user(user)
         if response == True:
-            print("Logging out user " + user)
+            logging.info("Logging out user %s", user)
             response = "SUCCESS"
         else: response = "Error logging out."
         return chat_pb2.ChatReply(message = response)
 
 
 def serve():
+    # records are written by a background thread, so a slow terminal never blocks a request
+    configure_logging(level=LOG_LEVEL)
     connectionString = str(SERVER_HOST + ":" + str(SERVER_PORT))
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=5))
     chat_pb2_grpc.add_ChatServicer_to_server(Chat(), server)
@@ -100,6 +105,7 @@ def serve():
     server.start()
     print("GRPC Server started, listening on " + connectionString)
     server.wait_for_termination()
+    stop_logging()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+"""
+asyncio client API for bots and integration tests. An AsyncClient keeps many requests in
+flight on one connection like the PipelinedClient in `client.py`, but runs on the
+caller's event loop instead of a reader thread, so one process can drive many clients.
+Each request is sent with a new request ID and awaits the response with the same ID, and
+BroadcastMessages are read with `async for msg in client.messages()`.
+
+    client = await AsyncClient.connect("127.0.0.1", 5002)
+    await client.register("John", wire_format=BINARY_FORMAT)
+    await client.send("Hello all!")
+    responses = await client.send_many([ChatMessage(sender="John", recipient="Jane", text=str(i)) for i in range(100)])
+    async for msg in client.messages():
+        print(msg.sender, msg.text)
+"""
+import asyncio
+import logging
+from itertools import count
+
+from .protocol import *
+from .client import SERVER_ADDRESS, SERVER_PORT, WIRE_FORMAT, COMPRESSION, _session_format, _queue_ack
+
+
+class AsyncClient:
+    """
+    Client API that sends requests from coroutines on an asyncio event loop. A reader task
+    resolves the Future of each request when the response with its request ID arrives, in
+    whatever order the responses arrive, and queues the BroadcastMessages for `messages()`.
+    Windows of queued messages that the server pushes after registering are acknowledged
+    by the reader task, which requests the next window, like the interactive client does.
+    """
+    def __init__(self, reader, writer, wire_format=TEXT_FORMAT):
+        """
+        Initialize AsyncClient, and start its reader task on the running event loop.
+
+        Args:
+            reader (asyncio.StreamReader): The stream of bytes from the server.
+            writer (asyncio.StreamWriter): The stream of bytes to the server.
+            wire_format (str): The wire format to send messages with until one is negotiated.
+        """
+        self.username = None
+        self.wire_format = wire_format
+        self._stream_reader = reader
+        self._writer = writer
+        self._decoder = StreamDecoder(deserialize_server_message)
+        self._pending = {} # Map of request IDs to the Futures of the requests in flight
+        self._request_ids = count(1)
+        self._messages = asyncio.Queue() # BroadcastMessages from the server, and None once it disconnected
+        self._closed = False
+        self._reader = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def connect(cls, ip_address=SERVER_ADDRESS, port=SERVER_PORT, **kwargs):
+        """Return an AsyncClient connected to the server."""
+        reader, writer = await asyncio.open_connection(ip_address, port)
+        return cls(reader, writer, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def request_many(self, msgs):
+        """
+        Write several client messages to the stream at once, without waiting for responses.
+
+        Args:
+            msgs (List[Message]): The client messages to send. Their request IDs are set.
+
+        Returns:
+            List[asyncio.Future]: The Future of each message's response.
+
+        Raises:
+            ConnectionError: If the server has disconnected.
+        """
+        if self._closed:
+            raise ConnectionError("Server has disconnected.")
+        loop = asyncio.get_running_loop()
+        futures = []
+        for msg in msgs:
+            # Request IDs are uint32, and wrap around
+            msg.request_id = next(self._request_ids) & 0xFFFFFFFF
+            future = self._pending[msg.request_id] = loop.create_future()
+            futures.append(future)
+        self._writer.write(b"".join(msg.encode_(self.wire_format) for msg in msgs))
+        return futures
+
+    async def request(self, msg):
+        """Send a client message, and return its response."""
+        future = self.request_many([msg])[0]
+        await self._writer.drain()
+        return await future
+
+    async def register(self, username, wire_format=WIRE_FORMAT, compression=COMPRESSION):
+        """
+        Register the username. If the registration succeeds, the negotiated wire format and
+        compression are used for the following requests, and the username is the sender of
+        the messages sent with `send`.
+
+        Returns:
+            RegisterResponse: The response from server.
+        """
+        # Queued messages can be pushed right after the response, and are acknowledged for the username
+        previous_username, self.username = self.username, username
+        res = await self.request(RegisterMessage(username=username, wire_format=wire_format, compression=compression))
+        if not res.success:
+            self.username = previous_username
+        elif res.wire_format or res.compression:
+            self.wire_format = _session_format(res)
+        return res
+
+    async def send(self, text, recipient=None):
+        """
+        Send a chat from the registered user.
+
+        Args:
+            text (str): The text of the chat.
+            recipient (str, optional): The user or prefixed room to send to, every active user if None.
+
+        Returns:
+            ChatResponse: The response from server.
+        """
+        return await self.request(ChatMessage(sender=self.username, recipient=recipient, text=text))
+
+    async def send_many(self, msgs):
+        """
+        Send several ChatMessages with one write, and wait for all of their responses. The
+        server decodes every message in the write at once, and answers them with one write
+        when it coalesces writes, so this is much faster than awaiting `send` for each chat.
+
+        Args:
+            msgs (List[ChatMessage]): The chats to send. Their request IDs are set.
+
+        Returns:
+            List[ChatResponse]: The response to each chat, in the same order.
+        """
+        futures = self.request_many(msgs)
+        await self._writer.drain()
+        return list(await asyncio.gather(*futures))
+
+    async def list(self, wildcard=None, cursor=None):
+        """Return the ListResponse of the usernames that match the wildcard, after the cursor if given."""
+        return await self.request(ListMessage(wildcard=wildcard, cursor=cursor))
+
+    async def delete(self, username):
+        """Delete the user, and return the DeleteResponse."""
+        return await self.request(DeleteMessage(username=username))
+
+    async def queue(self):
+        """
+        Request the messages queued for the registered user, and acknowledge each window
+        until the queue is empty. The messages are read with `messages()`.
+
+        Returns:
+            QueueResponse: The response to the first request, which fails if nothing was queued.
+        """
+        res = first = await self.request(QueueMessage(username=self.username))
+        while res.success and res.last_seq is not None:
+            res = await self.request(QueueMessage(username=self.username, ack=res.last_seq))
+        return first
+
+    async def messages(self):
+        """Yield the BroadcastMessages from the server, until it disconnects."""
+        while True:
+            msg = await self._messages.get()
+            if msg is None:
+                # Let other iterators stop as well
+                self._messages.put_nowait(None)
+                return
+            yield msg
+
+    async def _read_loop(self):
+        """Resolve the Futures of the responses received from server, until it disconnects."""
+        try:
+            while True:
+                data = await self._stream_reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                for msg in self._decoder.feed(data):
+                    future = self._pending.pop(msg.request_id, None) if msg.request_id is not None else None
+                    if future is not None:
+                        if not future.done():
+                            future.set_result(msg)
+                    elif isinstance(msg, BroadcastMessage):
+                        self._messages.put_nowait(msg)
+                    else:
+                        # Acknowledge a window of queued messages pushed after registering
+                        ack = _queue_ack(msg, self.username)
+                        if ack is not None:
+                            self._writer.write(ack.encode_(self.wire_format))
+        except (OSError, ValueError) as e:
+            logging.error("[!] Error: %s", e)
+        finally:
+            # Fail the requests that are still in flight
+            self._closed = True
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Server has disconnected."))
+            self._messages.put_nowait(None)
+
+    async def close(self):
+        """Close the connection, and wait for the reader task to stop."""
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        await self._reader
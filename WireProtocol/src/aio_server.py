@@ -0,0 +1,144 @@
+"""
+asyncio mode for the chat server. Every client connection is handled by a ChatProtocol
+instance on a single event loop instead of an OS thread, so idle connections only cost
+a small amount of memory. The messages are handled by the same services as the threaded
+server, which are passed an AsyncConnection in place of a client socket.
+
+Run with `SERVER_MODE` set to "asyncio" in `config.py`.
+"""
+import asyncio
+import logging
+
+from .protocol import *
+from .config import config
+from .server import handle_messages, disconnect_client, set_tcp_nodelay
+from .fanout import DROP_POLICY, DISCONNECT_POLICY
+from .log import log_sampled
+from .stats import stats
+
+
+# Server config
+MAX_NUM_CONNECTIONS = config["MAX_NUM_CONNECTIONS"]
+OUTBOUND_HIGH_WATER_MARK = config["OUTBOUND_HIGH_WATER_MARK"]
+SLOW_CONSUMER_POLICY = config["SLOW_CONSUMER_POLICY"]
+
+# Connections handled by the event loop only buffer a couple of messages at a time,
+# so they use a smaller receive buffer than the threaded server.
+ASYNC_RECV_BUFFER_SIZE = 2 * MAX_BUFFER_SIZE
+
+
+class AsyncConnection:
+    """
+    Wraps an asyncio transport with the socket methods used by the services, so the
+    services can send to it like any other client socket. Writes never block, they are
+    buffered by the transport and flushed by the event loop.
+
+    If the transport's write buffer exceeds OUTBOUND_HIGH_WATER_MARK, new messages are
+    dropped or the client is disconnected depending on the slow consumer policy. With the
+    "spill" policy, the messages keep being buffered in memory by the transport.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+
+    def _is_full(self):
+        """Returns True if new messages should not be written to the transport."""
+        if self.transport.is_closing():
+            return True
+        if self.transport.get_write_buffer_size() <= OUTBOUND_HIGH_WATER_MARK:
+            return False
+
+        if SLOW_CONSUMER_POLICY == DROP_POLICY:
+            log_sampled("slow_consumer", logging.WARNING, "Outbound buffer is full, dropped message for %s.",
+                        self.getsockname())
+            return True
+        elif SLOW_CONSUMER_POLICY == DISCONNECT_POLICY:
+            logging.warning("Outbound buffer is full, disconnecting %s.", self.getsockname())
+            self.transport.abort()
+            return True
+        return False
+
+    def sendall(self, data):
+        if not self._is_full():
+            self.transport.write(data)
+
+    def sendmsg(self, buffers):
+        if not self._is_full():
+            self.transport.writelines(buffers)
+        # Report every byte as sent, since the transport buffers what it cannot send yet
+        return sum(len(buffer) for buffer in buffers)
+
+    def getsockname(self):
+        return self.transport.get_extra_info("sockname")
+
+    def getpeername(self):
+        return self.transport.get_extra_info("peername")
+
+    def shutdown(self, how):
+        self.transport.abort()
+
+    def close(self):
+        self.transport.close()
+
+
+class ChatProtocol(asyncio.Protocol):
+    """
+    Handles one client connection. Received bytes are decoded with a StreamDecoder, and
+    the complete messages are handled by the services with the shared app state.
+    """
+    def __init__(self, app):
+        """
+        Initialize ChatProtocol.
+
+        Args:
+            app (AppState): The app state shared by all connections.
+        """
+        self.app = app
+        self.decoder = StreamDecoder(deserialize_client_message, size=ASYNC_RECV_BUFFER_SIZE)
+        self.conn = None
+
+    def connection_made(self, transport):
+        self.conn = AsyncConnection(transport)
+        # The event loop sets TCP_NODELAY on TCP transports, so it is reset if it is disabled
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            set_tcp_nodelay(sock)
+        logging.info("%s has connected.", transport.get_extra_info('peername'))
+        stats.increment("connections")
+
+    def data_received(self, data):
+        handle_messages(self.decoder.feed(data), self.app, self.conn)
+
+    def connection_lost(self, exc):
+        if exc:
+            logging.error("[!] Error: %s", exc)
+        disconnect_client(self.conn, self.app)
+
+
+async def serve_asyncio(host, port, app, backlog=MAX_NUM_CONNECTIONS):
+    """
+    Start listening for connections on the running event loop.
+
+    Args:
+        host (str): The address to bind to.
+        port (int): The port to bind to, or 0 to pick a free port.
+        app (AppState): The app state shared by all connections.
+        backlog (int): The listen backlog.
+
+    Returns:
+        asyncio.Server: The listening server.
+    """
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: ChatProtocol(app), host, port,
+                                      backlog=backlog, reuse_address=True)
+    return server
+
+
+def run_asyncio(host, port, app, backlog=MAX_NUM_CONNECTIONS):
+    """Run the asyncio server until the process is stopped."""
+    async def run():
+        server = await serve_asyncio(host, port, app, backlog)
+        print(f"[*] Listening as {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
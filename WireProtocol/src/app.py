@@ -1,10 +1,52 @@
 """
 Defines logic for chat application state. AppState stores registered usernames,
-active connections, and queued messages for inactive users.
+active connections, queued messages for inactive users, and the members of each room.
 
-TODO: Implement locking for race conditions in SafeAppState class.
+AppState is not thread-safe. SafeAppState adds locking for servers that call it from
+several threads, with a lock for each stripe of users so unrelated users don't contend.
+
+An AppState can be persisted with a Journal from `persistence.py`, which it tells about
+every registration, deletion, queued message and acknowledgement.
 """
 import re
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Lock, RLock
+
+from .config import config
+
+
+# Characters with a special meaning in regexes, which end the literal prefix of a wildcard
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+
+@lru_cache(maxsize=256)
+def compile_wildcard(wildcard):
+    """Return the compiled regex for a wildcard, caching recently used wildcards."""
+    return re.compile(wildcard)
+
+
+@lru_cache(maxsize=256)
+def literal_prefix(wildcard):
+    """
+    Return the literal prefix that every username matching the wildcard starts with,
+    e.g. "jo" for "jo.*", or an empty string if the wildcard has no literal prefix.
+    """
+    # An alternative can match usernames with a different prefix
+    if "|" in wildcard:
+        return ""
+    prefix = []
+    for char in wildcard:
+        if char in "*?{":
+            # The previous character is optional or repeated, so it is not part of the prefix
+            if prefix:
+                prefix.pop()
+            break
+        if char in REGEX_SPECIAL_CHARS:
+            break
+        prefix.append(char)
+    return "".join(prefix)
 
 
 class InvalidUserError(Exception):
@@ -14,7 +56,7 @@ class InvalidUserError(Exception):
 
 
 class AppState:
-    def __init__(self, users=set(), connections={}, msg_queue={}):
+    def __init__(self, users=None, connections=None, msg_queue=None, queue_store=None):
         """
         Initialize AppState.
         
@@ -22,23 +64,53 @@ class AppState:
             users (Set[str], optional): Set of username strings.
             connections (Dict[str, Socket], optional): Map of usernames to active socket connections.
             msg_queue (Dict[str, List[str]], optional): Map of usernames to queued messages in string format.
+            queue_store (QueueStore, optional): Store that spills queued messages to disk. If it is
+                None, queued messages are kept in `msg_queue`.
         """
-        self._users = users 
-        self._connections = connections 
-        self._msg_queue = msg_queue 
+        # Create new containers by default, so instances don't share state
+        self._users = users if users is not None else set()
+        self._connections = connections if connections is not None else {}
+        self._msg_queue = msg_queue if msg_queue is not None else {}
+        self._queue_store = queue_store
+        self._queue_seqs = {} # Map of usernames to the sequence number of their oldest queued message
+        self._wire_formats = {} # Map of active sockets to their negotiated wire format
+        self._journal = None # Journal that changes are logged to, if the state is persisted
+        self._rooms = {} # Map of room names to the usernames of their members
+        self._user_rooms = {} # Map of usernames to the names of the rooms they joined
+        # Map of room names to the sockets of their active members by username, kept up to date
+        # when members connect and disconnect, so sending to a room doesn't look up every member
+        self._room_connections = {}
+        self._sorted_users = sorted(self._users) # Index of the usernames in sorted order
+        # Map of active sockets to their usernames, the reverse of `_connections`
+        self._connection_users = {socket: username for username, socket in self._connections.items()}
 
     def _get_connection_username(self, conn):
         """Return the username that the connection is logged in as."""
-        for key, value in self._connections.items():
-            if value == conn:
-                return key
-
-        raise KeyError("No user found for connection.")
+        try:
+            return self._connection_users[conn]
+        except KeyError:
+            raise KeyError("No user found for connection.")
     
     def is_valid_user(self, username):
         """Returns True if username is registered."""
         return (username in self._users)
+
+    def is_active_user(self, username):
+        """Returns True if username has an active connection."""
+        return (username in self._connections)
+
+    def get_active_users(self):
+        """Return a set-like view of the active usernames."""
+        return self._connections.keys()
     
+    def count_active_users(self):
+        """Return the number of active users."""
+        return len(self._connections)
+
+    def get_connection_user(self, socket):
+        """Return the username that the socket is logged in as, or None."""
+        return self._connection_users.get(socket)
+
     def get_all_connections(self):
         """Return sockets for all active users."""
         return list(self._connections.values())
@@ -62,15 +134,50 @@ class AppState:
         
         return self._connections.get(username, None)
   
-    def list_users(self, wildcard=None):
+    def list_users(self, wildcard=None, limit=None, after=None):
         """
-        Return a list of all registered usernames.
+        Return the registered usernames in sorted order.
+
+        Usernames are kept in a sorted index, so a wildcard with a literal prefix, e.g.
+        "jo.*", is answered by scanning only the usernames with that prefix, and the scan
+        stops once `limit` usernames are found.
+
+        Args:
+            wildcard (str, optional): Only return usernames that match this regex.
+            limit (int, optional): Stop after this many usernames are found.
+            after (str, optional): Only return usernames after this one, used to continue a listing.
         """
-        if not wildcard:
-            return list(self._users)
-        
-        return [user for user in self._users if re.match(wildcard, user)]
-  
+        users = self._sorted_users
+        pattern = compile_wildcard(wildcard) if wildcard else None
+        prefix = literal_prefix(wildcard) if wildcard else ""
+
+        # Start at the first username with the prefix, or after the cursor
+        start = bisect_left(users, prefix)
+        if after is not None:
+            start = max(start, bisect_right(users, after))
+
+        matched = []
+        for i in range(start, len(users)):
+            user = users[i]
+            # Usernames with the prefix are adjacent in the index
+            if not user.startswith(prefix):
+                break
+            if pattern is None or pattern.match(user):
+                matched.append(user)
+                if len(matched) == limit:
+                    break
+        return matched
+
+    def _index_user(self, username):
+        """Add a username to the sorted index."""
+        insort(self._sorted_users, username)
+
+    def _unindex_user(self, username):
+        """Remove a username from the sorted index."""
+        i = bisect_left(self._sorted_users, username)
+        if i < len(self._sorted_users) and self._sorted_users[i] == username:
+            del self._sorted_users[i]
+
     def register_user(self, username):
         """
         Register a username.
@@ -95,6 +202,9 @@ class AppState:
             return False
         else:
             self._users.add(username)
+            self._index_user(username)
+            if self._journal is not None:
+                self._journal.log_register(username)
             return True
 
     def delete_user(self, username):
@@ -118,7 +228,15 @@ class AppState:
             raise ValueError("Cannot delete an active user.")
         
         self._users.remove(username)
+        self._unindex_user(username)
         self._msg_queue.pop(username, None) # Pass a default so that KeyError is not raised
+        self._queue_seqs.pop(username, None)
+        if self._queue_store is not None:
+            self._queue_store.delete(username)
+        for room in list(self._user_rooms.get(username, ())):
+            self._remove_member(username, room)
+        if self._journal is not None:
+            self._journal.log_delete(username)
 
     def add_connection(self, username, socket):
         """Create an active connection for `username` to socket."""
@@ -126,15 +244,136 @@ class AppState:
         if username in self._connections.keys():
             raise InvalidUserError("Username is already connected to a socket.")
         # Check that the socket is not already registered to a user
-        if socket in self._connections.values():
+        if socket in self._connection_users:
             raise ValueError("Socket is already associated with another user.")
 
         self._connections[username] = socket
+        self._connection_users[socket] = username
+        self._connect_rooms(username, socket)
 
     def remove_connection(self, socket):
         """Remove the socket from active connections."""
         username = self._get_connection_username(socket)
         self._connections.pop(username)
+        self._connection_users.pop(socket)
+        self._wire_formats.pop(socket, None)
+        self._connect_rooms(username, None)
+
+    def remove_connections(self, sockets):
+        """
+        Remove several sockets from active connections, e.g. when many clients disconnect
+        at once. Sockets that are not active connections are ignored.
+
+        Args:
+            sockets (Iterable[Socket]): The sockets to remove.
+
+        Returns:
+            List[str]: The usernames of the removed connections.
+        """
+        removed = []
+        for socket in sockets:
+            username = self._connection_users.pop(socket, None)
+            if username is not None:
+                self._connections.pop(username)
+                self._wire_formats.pop(socket, None)
+                self._connect_rooms(username, None)
+                removed.append(username)
+        return removed
+
+    def _connect_rooms(self, username, socket):
+        """Set the user's socket in the rooms it joined, or remove it if `socket` is None."""
+        for room in self._user_rooms.get(username, ()):
+            if socket is None:
+                self._room_connections[room].pop(username, None)
+            else:
+                self._room_connections[room][username] = socket
+
+    def join_room(self, username, room):
+        """
+        Add the user to the members of a room, creating the room if it doesn't exist.
+
+        Args:
+            username (str): The username.
+            room (str): The name of the room, without the ROOM_PREFIX.
+
+        Returns:
+            bool: True if the user joined, False if the user was already a member.
+
+        Raises:
+            InvalidUserError: If the user is not registered.
+            ValueError: If the room name contains non-alphanumeric characters or is greater than max length.
+        """
+        if not self.is_valid_user(username):
+            raise InvalidUserError()
+        if not room.isalnum():
+            raise ValueError("Room name must contain only alphanumeric characters.")
+        if len(room) > 12:
+            raise ValueError("Room name can be at most 12 characters.")
+
+        if room in self._user_rooms.get(username, ()):
+            return False
+        self._add_member(username, room)
+        if self._journal is not None:
+            self._journal.log_join(username, room)
+        return True
+
+    def leave_room(self, username, room):
+        """
+        Remove the user from the members of a room. The room is removed once it has no members.
+
+        Raises:
+            ValueError: If the user is not a member of the room.
+        """
+        if not self.is_room_member(username, room):
+            raise ValueError(f"Not a member of room '{room}'.")
+        self._remove_member(username, room)
+        if self._journal is not None:
+            self._journal.log_leave(username, room)
+
+    def _add_member(self, username, room):
+        """Add the user to the members of a room, and its socket if the user is active."""
+        self._rooms.setdefault(room, set()).add(username)
+        self._user_rooms.setdefault(username, set()).add(room)
+        connections = self._room_connections.setdefault(room, {})
+        socket = self._connections.get(username)
+        if socket is not None:
+            connections[username] = socket
+
+    def _remove_member(self, username, room):
+        """Remove the user from the members of a room, removing rooms and users without rooms."""
+        members = self._rooms[room]
+        members.discard(username)
+        self._room_connections[room].pop(username, None)
+        if not members:
+            del self._rooms[room], self._room_connections[room]
+        rooms = self._user_rooms[username]
+        rooms.discard(room)
+        if not rooms:
+            del self._user_rooms[username]
+
+    def is_room_member(self, username, room):
+        """Returns True if the user is a member of the room."""
+        return room in self._user_rooms.get(username, ())
+
+    def get_room_members(self, room):
+        """Return the usernames of the room's members, or an empty list if the room doesn't exist."""
+        return list(self._rooms.get(room, ()))
+
+    def get_room_connections(self, room):
+        """Return the sockets of the room's active members."""
+        return list(self._room_connections.get(room, {}).values())
+
+    def count_room_connections(self, room):
+        """Return the number of the room's active members."""
+        return len(self._room_connections.get(room, ()))
+
+    def set_wire_format(self, socket, wire_format):
+        """Set the wire format negotiated by the client connected to socket."""
+        self._wire_formats[socket] = wire_format
+
+    def get_wire_format(self, socket):
+        """Return the wire format for socket, or None if it was not negotiated."""
+        return self._wire_formats.get(socket, None)
 
     def queue_message(self, username, msg):
         """
@@ -152,13 +391,27 @@ class AppState:
         """
         if not self.is_valid_user(username):
             raise InvalidUserError()
-        
+
+        if self._journal is not None:
+            # The message gets the sequence number after the user's last queued message
+            count = self._queue_store.count(username) if self._queue_store is not None else len(self._msg_queue.get(username, []))
+            self._journal.log_queue(username, self._queue_seqs.get(username, 1) + count, msg)
+
         # Add the text to the user's message queue
-        if username in self._msg_queue:
+        if self._queue_store is not None:
+            self._queue_store.append(username, msg)
+        elif username in self._msg_queue:
             self._msg_queue[username].append(msg)
         else:
             self._msg_queue[username] = [msg]
 
+    def count_queued_messages(self):
+        """Return the number of messages queued for every user."""
+        if self._queue_store is not None:
+            return self._queue_store.total_count()
+        # Copying the queues is atomic, so other threads can queue messages at the same time
+        return sum(len(queued_msgs) for queued_msgs in list(self._msg_queue.values()))
+
     def get_queued_messages(self, username):
         """
         Return the queued messages for the user.
@@ -175,6 +428,283 @@ class AppState:
         if not self.is_valid_user(username):
             raise InvalidUserError()
         
+        if self._queue_store is not None:
+            return self._queue_store.get(username)
         # If no messages, return empty list
         return self._msg_queue.get(username, [])
 
+    def get_queued_window(self, username, size):
+        """
+        Return a window of the user's oldest queued messages. The queued messages of each
+        user are numbered with consecutive sequence numbers, starting at 1.
+
+        Args:
+            username (str): The user's username.
+            size (int): The maximum number of messages in the window.
+
+        Returns:
+            Tuple[int, List[BroadcastMessage], int]: The sequence number of the first message,
+                the messages in the window, and the number of queued messages after the window.
+
+        Raises:
+            InvalidUserError: If the user is not registered.
+        """
+        if not self.is_valid_user(username):
+            raise InvalidUserError()
+
+        first_seq = self._queue_seqs.get(username, 1)
+        if self._queue_store is not None:
+            count = self._queue_store.count(username)
+            msgs = self._queue_store.get(username, 0, size)
+        else:
+            queued_msgs = self._msg_queue.get(username, [])
+            count = len(queued_msgs)
+            msgs = queued_msgs[:size]
+        return first_seq, msgs, count - len(msgs)
+
+    def ack_queued_messages(self, username, seq):
+        """
+        Remove the user's queued messages up to and including sequence number `seq`,
+        once the user acknowledged receiving them.
+
+        Raises:
+            InvalidUserError: If the user is not registered.
+        """
+        if not self.is_valid_user(username):
+            raise InvalidUserError()
+
+        first_seq = self._queue_seqs.get(username, 1)
+        count = seq - first_seq + 1
+        if count <= 0:
+            return
+        if self._queue_store is not None:
+            count = min(count, self._queue_store.count(username))
+            self._queue_store.discard(username, count)
+        else:
+            queued_msgs = self._msg_queue.get(username, [])
+            count = min(count, len(queued_msgs))
+            del queued_msgs[:count]
+        self._queue_seqs[username] = first_seq + count
+        if self._journal is not None:
+            self._journal.log_ack(username, first_seq + count - 1)
+
+    def set_journal(self, journal):
+        """Log every later change of the registered users and queued messages to the journal."""
+        self._journal = journal
+
+    def _snapshot_queue(self, username):
+        """Return the sequence number of the user's oldest queued message, and a copy of the messages."""
+        return self._queue_seqs.get(username, 1), list(self.get_queued_messages(username))
+
+    def snapshot(self):
+        """
+        Return a copy of the registered usernames and queued messages, used to persist the
+        app state. Each user's queue is copied at once, but different users can be copied
+        before and after concurrent changes, which the journal replays on recovery.
+
+        Returns:
+            Tuple[List[str], List[Tuple[str, int, List[BroadcastMessage]]], List[Tuple[str, List[str]]]]:
+                The sorted usernames, the username, sequence number of the oldest message, and
+                queued messages of each user with queued messages, and the name and usernames
+                of the members of each room.
+        """
+        # Copying a list or set is atomic, so the index doesn't need to be locked
+        users = list(self._sorted_users)
+        queued = set(self._queue_seqs) | set(self._msg_queue)
+        if self._queue_store is not None:
+            queued.update(self._queue_store.usernames())
+
+        queues = []
+        for username in queued:
+            if not self.is_valid_user(username):
+                continue
+            first_seq, msgs = self._snapshot_queue(username)
+            if msgs or first_seq != 1:
+                queues.append((username, first_seq, msgs))
+        rooms = [(room, self.get_room_members(room)) for room in list(self._rooms)]
+        return users, queues, [(room, members) for room, members in rooms if members]
+
+    def restore(self, users, queues, rooms=()):
+        """
+        Replace the registered usernames and queued messages, e.g. with the persisted
+        state when the server starts. Changes are not logged to the journal.
+
+        Args:
+            users (List[str]): The registered usernames, without duplicates.
+            queues (Iterable[Tuple[str, int, List[BroadcastMessage]]]): The username, sequence
+                number of the oldest message, and queued messages of each user.
+            rooms (Iterable[Tuple[str, Iterable[str]]]): The name and members of each room.
+        """
+        self._users = set(users)
+        # Sorting is fast if the usernames are already sorted, e.g. when read from a snapshot
+        self._sorted_users = sorted(users)
+        self._msg_queue = {}
+        self._queue_seqs = {}
+        for username, first_seq, msgs in queues:
+            if first_seq != 1:
+                self._queue_seqs[username] = first_seq
+            if self._queue_store is not None:
+                self._queue_store.extend(username, msgs)
+            elif msgs:
+                self._msg_queue[username] = list(msgs)
+        self._rooms, self._user_rooms, self._room_connections = {}, {}, {}
+        for room, members in rooms:
+            for username in members:
+                self._add_member(username, room)
+
+
+
+class SafeAppState(AppState):
+    """
+    Thread-safe AppState. Each username and socket is mapped to one of `num_stripes`
+    locks, and an operation only holds the locks of the users and sockets it changes,
+    so operations on unrelated users run without contending for a lock. Operations that
+    need several locks acquire them in stripe order, so they cannot deadlock.
+
+    Reads of a single container, e.g. `is_valid_user`, don't need a lock, since a single
+    set or dict operation is atomic.
+    """
+    def __init__(self, users=None, connections=None, msg_queue=None, queue_store=None,
+                 num_stripes=config["LOCK_STRIPES"]):
+        """
+        Initialize SafeAppState.
+
+        Args:
+            users (Set[str], optional): Set of username strings.
+            connections (Dict[str, Socket], optional): Map of usernames to active socket connections.
+            msg_queue (Dict[str, List[str]], optional): Map of usernames to queued messages in string format.
+            queue_store (QueueStore, optional): Store that spills queued messages to disk.
+            num_stripes (int, optional): The number of locks. With 1 stripe, every operation uses one global lock.
+        """
+        super().__init__(users, connections, msg_queue, queue_store)
+        # Reentrant, since locked methods call other locked methods, e.g. `delete_user` calls `get_user_connection`
+        self._stripes = [RLock() for _ in range(num_stripes)]
+        self._index_lock = Lock()
+        self._rooms_lock = Lock()
+
+    def _stripe(self, key):
+        """Return the lock of the stripe that the username or socket is mapped to."""
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    @contextmanager
+    def _locked(self, *keys):
+        """Hold the locks of the stripes that several usernames or sockets are mapped to."""
+        locks = [self._stripes[i] for i in sorted({hash(key) % len(self._stripes) for key in keys})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def get_user_connection(self, username):
+        with self._stripe(username):
+            return super().get_user_connection(username)
+
+    def list_users(self, wildcard=None, limit=None, after=None):
+        # The sorted index is shared by every stripe, so it has its own lock
+        with self._index_lock:
+            return super().list_users(wildcard, limit, after)
+
+    def _index_user(self, username):
+        with self._index_lock:
+            super()._index_user(username)
+
+    def _unindex_user(self, username):
+        with self._index_lock:
+            super()._unindex_user(username)
+
+    def register_user(self, username):
+        with self._stripe(username):
+            return super().register_user(username)
+
+    def delete_user(self, username):
+        with self._stripe(username):
+            return super().delete_user(username)
+
+    def add_connection(self, username, socket):
+        with self._locked(username, socket):
+            return super().add_connection(username, socket)
+
+    def remove_connection(self, socket):
+        while True:
+            username = self._get_connection_username(socket)
+            with self._locked(username, socket):
+                # Retry if the socket was removed or moved to another user before locking
+                if self._connection_users.get(socket) != username:
+                    continue
+                return super().remove_connection(socket)
+
+    def remove_connections(self, sockets):
+        # Hold the lock of every stripe involved once, instead of locking for each socket
+        sockets = list(sockets)
+        usernames = [self._connection_users.get(socket) for socket in sockets]
+        removed, changed = [], []
+        with self._locked(*sockets, *(username for username in usernames if username is not None)):
+            for socket, username in zip(sockets, usernames):
+                if self._connection_users.get(socket) != username:
+                    changed.append(socket)
+                elif username is not None:
+                    removed += super().remove_connections([socket])
+        # Retry the sockets that were connected or moved to another user before locking
+        for socket in changed:
+            removed += self.remove_connections([socket])
+        return removed
+
+    def set_wire_format(self, socket, wire_format):
+        with self._stripe(socket):
+            return super().set_wire_format(socket, wire_format)
+
+    # Rooms have members in many stripes, so they are changed under their own lock. It is
+    # acquired after the stripe locks, e.g. when a member connects.
+    def _connect_rooms(self, username, socket):
+        with self._rooms_lock:
+            super()._connect_rooms(username, socket)
+
+    def join_room(self, username, room):
+        with self._stripe(username):
+            return super().join_room(username, room)
+
+    def leave_room(self, username, room):
+        with self._stripe(username):
+            return super().leave_room(username, room)
+
+    def _add_member(self, username, room):
+        with self._rooms_lock:
+            super()._add_member(username, room)
+
+    def _remove_member(self, username, room):
+        with self._rooms_lock:
+            super()._remove_member(username, room)
+
+    def get_room_members(self, room):
+        with self._rooms_lock:
+            return super().get_room_members(room)
+
+    def get_room_connections(self, room):
+        with self._rooms_lock:
+            return super().get_room_connections(room)
+
+    def queue_message(self, username, msg):
+        with self._stripe(username):
+            return super().queue_message(username, msg)
+
+    def get_queued_window(self, username, size):
+        with self._stripe(username):
+            first_seq, msgs, remaining = super().get_queued_window(username, size)
+            return first_seq, list(msgs), remaining
+
+    def ack_queued_messages(self, username, seq):
+        with self._stripe(username):
+            return super().ack_queued_messages(username, seq)
+
+    def _snapshot_queue(self, username):
+        # The sequence number and the messages are read under the same lock
+        with self._stripe(username):
+            return super()._snapshot_queue(username)
+
+    def get_queued_messages(self, username):
+        with self._stripe(username):
+            # Return a copy, since other threads can queue messages after the lock is released
+            return list(super().get_queued_messages(username))
@@ -8,74 +8,86 @@ import socket
 import select
 import sys
 import logging
+from concurrent.futures import Future
+from itertools import count
+from threading import Lock, Thread
 
 from .protocol import *
 from .config import config
-
-
-# Logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-9s) %(message)s',)
+from .log import configure_logging
 
 
 # Configuration
 DEBUG = config["DEBUG"]
-MAX_BUFFER_SIZE = config["MAX_BUFFER_SIZE"]
 SERVER_ADDRESS = config["SERVER_ADDRESS"] if not DEBUG else config["DEBUG_SERVER_ADDRESS"]
 SERVER_PORT = config["SERVER_PORT"]
+WIRE_FORMAT = config["WIRE_FORMAT"]
+COMPRESSION = config["COMPRESSION"]
 
 
-def _authenticate(server):
+def _authenticate(server, decoder):
     """
     This will hold the client at sending `REGISTER` messages until a
     success response is received, then returns the client's
-    username and whether they are a previous user. Other messages from the server will be
-    ignored.
+    username, whether they are a previous user, the wire format accepted
+    by the server, and the messages received after the success response, e.g. the
+    queued messages the server pushes to a returning user. Other messages from
+    the server will be ignored.
 
     Args:
         server (Socket): The socket to send register message to.
+        decoder (StreamDecoder): The decoder for messages received from server.
 
     Returns:
-        Tuple[str, bool]: The first argument is the username, and the
-            second argument is whether the user is new or returning.
+        Tuple[str, bool, str, List[Message]]: The first argument is the username, the
+            second argument is whether the user is new or returning, the
+            third is the wire format to use for the rest of the session, and the
+            fourth is the messages received after the success response.
 
     Raises:
-        ConnectionError: If the server disconnects during the process or a RegisterResponse
-            is not received.
+        ConnectionError: If the server disconnects during the process.
     """
     while True:
         username = input("Enter your username:")
-        msg = RegisterMessage(username=username)
+        msg = RegisterMessage(username=username, wire_format=WIRE_FORMAT, compression=COMPRESSION)
         server.send(msg.encode_())
 
         # Now listen for the desired success/error response, other messages
         # from server will be ignored.
         while True:
-            res = server.recv(MAX_BUFFER_SIZE)
+            msgs = decoder.recv(server)
             # If no bytes received, server has disconnected
-            if not res:
+            if msgs is None:
                 raise ConnectionError("Server has disconnected.")
             
             # Since the buffer could contain multiple messages, ignore 
-            # all messages except the last RegisterResponse
-            msgs = decode_server_buffer(res)
-            res = None
+            # all messages except the last RegisterResponse and the ones after it
+            res, pushed = None, []
             for msg in msgs:
                 if isinstance(msg, RegisterResponse):
-                    res = msg
+                    res, pushed = msg, []
+                else:
+                    pushed.append(msg)
             
-            # If no RegisterResponse was recieved, something went wrong, raise ConnectionError
+            # If no RegisterResponse was recieved yet, keep listening
             if not res:
-                raise ConnectionError()
+                continue
             # If success response, return the username for future use
             if res.success:
-                return username, res.is_new_user
+                return username, res.is_new_user, _session_format(res), pushed
             # Otherwise, display the error message and wait for user input
             else:
                 print(res.error)
                 break
         
 
+def _session_format(res):
+    """Return the encoding to use after a successful RegisterResponse."""
+    if res.compression:
+        return COMPRESSED_FORMAT
+    return res.wire_format or TEXT_FORMAT
+
+
 def _display_message(msg):
     """
     Display message on the client console. The formatting depends on the instance of 
@@ -100,7 +112,8 @@ def _display_message(msg):
         # If the `limit_exceeded` flag is True, let the user know
         # that there are users that satisfy wildcard.
         if msg.limit_exceeded:
-            print(f"There are more users satisfying this query. Only showing the first {msg.max_num_users}")
+            print(f"There are more users satisfying this query. Only showing the next {msg.max_num_users}, "
+                  "enter '/more' to list more")
         for username in msg.users:
             print(username)
     elif isinstance(msg, DeleteResponse):
@@ -117,23 +130,35 @@ def _display_message(msg):
         raise NotImplementedError
 
 
+def _queue_ack(msg, username):
+    """
+    Return the QueueMessage that acknowledges a window of queued messages and requests
+    the next one, or None if the message is not a QueueResponse with a window.
+    """
+    if isinstance(msg, QueueResponse) and msg.last_seq is not None:
+        return QueueMessage(username=username, ack=msg.last_seq)
+    return None
+
+
 def _display_usage_instructions():
     """Print the usage instructions."""
     print("(1) Send a message to all --> type message and press enter")
     print("(2) Send a message to specified recipient --> '>> [recipient]: [message]'")
-    print("(3) List all recipients w/ optional wildcard --> '/list [wildcard]'")
+    print("(3) List all recipients w/ optional wildcard --> '/list [wildcard]', and '/more' to continue the list")
     print("(4) Delete a specified recipient account --> '/delete [recipient]'")
     print("(5) Get messages in your queue --> '/queue'")
-    print("(6) Logout --> '/logout'")
+    print("(6) Join or leave a room --> '/join [room]' or '/leave [room]', and '>> #[room]: [message]' to send to it")
+    print("(7) Logout --> '/logout'")
 
 
-def _message_from_input(input, username):
+def _message_from_input(input, username, next_list=None):
     """
     Convert the user input into a Message object.
     
     Args:
         input (str): The input read from sys.stind.
         username (str): The username of client.
+        next_list (ListMessage, optional): The message that continues the last listing, used for `/more`.
 
     Returns:
         Message: The message to send to server.
@@ -149,10 +174,18 @@ def _message_from_input(input, username):
             # If input is just `/list`, wildcard is None
             wildcard = fields[1] if len(fields) > 1 else None
             return ListMessage(wildcard=wildcard)
+        elif input.startswith("/more"):
+            if next_list is None:
+                raise ValueError("There are no more users to list.")
+            return next_list
         elif input.startswith("/delete"):
             return DeleteMessage(username=input.split(" ")[1])
         elif input.startswith("/queue"):
             return QueueMessage(username=username)
+        elif input.startswith("/join"):
+            return JoinMessage(username=username, room=input.split(" ")[1])
+        elif input.startswith("/leave"):
+            return LeaveMessage(username=username, room=input.split(" ")[1])
         # User requesting to send a direct message to a specified recipient
         elif input.startswith(">>"):
             fields = input.split(":")
@@ -165,6 +198,116 @@ def _message_from_input(input, username):
         raise ValueError(str(e))
 
 
+class PipelinedClient:
+    """
+    Client API for bots and integrations that keeps many requests in flight on one
+    connection. Each request is sent with a new request ID and returns a Future, which a
+    reader thread resolves when the response with the same request ID is received, in
+    whatever order the responses arrive. BroadcastMessages, and other messages that don't
+    answer a request, are passed to `on_message` on the reader thread.
+    """
+    def __init__(self, sock, wire_format=TEXT_FORMAT, on_message=None):
+        """
+        Initialize PipelinedClient, and start its reader thread.
+
+        Args:
+            sock (Socket): A socket connected to the server.
+            wire_format (str): The wire format to send messages with until one is negotiated.
+            on_message (Callable[[Message], None], optional): Called with each message that doesn't answer a request.
+        """
+        self.sock = sock
+        self.wire_format = wire_format
+        self.on_message = on_message
+        self._decoder = StreamDecoder(deserialize_server_message)
+        self._pending = {} # Map of request IDs to the Futures of the requests in flight
+        self._request_ids = count(1)
+        self._closed = False
+        self._lock = Lock()
+        self._reader = Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    @classmethod
+    def connect(cls, ip_address, port, **kwargs):
+        """Return a PipelinedClient connected to the server."""
+        return cls(socket.create_connection((ip_address, port)), **kwargs)
+
+    def request_many(self, msgs):
+        """
+        Send several client messages with one write, without waiting for responses.
+
+        Args:
+            msgs (List[Message]): The client messages to send. Their request IDs are set.
+
+        Returns:
+            List[Future]: The Future of each message's response.
+
+        Raises:
+            ConnectionError: If the server has disconnected.
+        """
+        futures = [Future() for _ in msgs]
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("Server has disconnected.")
+            for msg, future in zip(msgs, futures):
+                # Request IDs are uint32, and wrap around
+                msg.request_id = next(self._request_ids) & 0xFFFFFFFF
+                self._pending[msg.request_id] = future
+            self.sock.sendall(b"".join(msg.encode_(self.wire_format) for msg in msgs))
+        return futures
+
+    def request(self, msg):
+        """Send a client message, and return the Future of its response."""
+        return self.request_many([msg])[0]
+
+    def register(self, username, wire_format=WIRE_FORMAT, compression=COMPRESSION):
+        """
+        Register the username and wait for the response. If the registration succeeds, the
+        negotiated wire format and compression are used for the following requests.
+
+        Returns:
+            RegisterResponse: The response from server.
+        """
+        msg = RegisterMessage(username=username, wire_format=wire_format, compression=compression)
+        res = self.request(msg).result()
+        if res.success and (res.wire_format or res.compression):
+            self.wire_format = _session_format(res)
+        return res
+
+    def _read_loop(self):
+        """Resolve the Futures of the responses received from server, until it disconnects."""
+        while True:
+            try:
+                msgs = self._decoder.recv(self.sock)
+            except (OSError, ValueError) as e:
+                logging.error("[!] Error: %s", e)
+                msgs = None
+            if msgs is None:
+                break
+            for msg in msgs:
+                with self._lock:
+                    future = self._pending.pop(msg.request_id, None) if msg.request_id is not None else None
+                if future is not None:
+                    future.set_result(msg)
+                elif self.on_message:
+                    self.on_message(msg)
+
+        # Fail the requests that are still in flight
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Server has disconnected."))
+
+    def close(self):
+        """Close the connection, and wait for the reader thread to stop."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join()
+        self.sock.close()
+
+
 def run(ip_address, port):
     """
     The control logic for client connection. First calls `_authenticate`, which
@@ -176,11 +319,13 @@ def run(ip_address, port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
         # Initialize connection with server
         server.connect((ip_address, port))
+        # Decoder that keeps partial messages between `recv()` calls
+        decoder = StreamDecoder(deserialize_server_message)
 
         # _authenticate will loop until a username is successfully registered
         # If the server disconnects during this process, it will raise ConnectionError
         try:
-            username, is_new_user = _authenticate(server)
+            username, is_new_user, wire_format, pushed = _authenticate(server, decoder)
         except ConnectionError as _:
             print("Server disconnected.")
             server.close()
@@ -195,6 +340,16 @@ def run(ip_address, port):
         # Print usage instructions
         _display_usage_instructions()        
 
+        # Display the queued messages the server pushed after registering
+        for msg in pushed:
+            _display_message(msg)
+            ack = _queue_ack(msg, username)
+            if ack:
+                server.send(ack.encode_(wire_format))
+
+        # The last ListMessage sent, and the message that continues its listing
+        last_list, next_list = None, None
+
         while True:
             # Maintain a list of possible input streams
             sockets_list = [sys.stdin, server]
@@ -203,12 +358,18 @@ def run(ip_address, port):
             for socks in read_sockets:
                 # If the read buffer from server has data, decode and display
                 if socks == server:
-                    data = socks.recv(MAX_BUFFER_SIZE)
-                    if data:
-                        msgs = decode_server_buffer(data)
+                    msgs = decoder.recv(socks)
+                    if msgs is not None:
                         # Iterate through the received messages and display
                         for msg in msgs:
                             _display_message(msg)
+                            # Remember where to continue the listing
+                            if isinstance(msg, ListResponse) and last_list is not None:
+                                next_list = ListMessage(wildcard=last_list.wildcard, cursor=msg.cursor) if msg.cursor else None
+                            # Acknowledge the window of queued messages, which also requests the next one
+                            ack = _queue_ack(msg, username)
+                            if ack:
+                                server.send(ack.encode_(wire_format))
                     # If 0 bytes are recieved, the server has disconnected
                     else:
                         print("Server disconnected.")
@@ -225,13 +386,16 @@ def run(ip_address, port):
                     # Try to cast user input to a message. If this fails,
                     # print a message explaining how to use.
                     try:
-                        msg = _message_from_input(input, username)
-                        server.send(msg.encode_())
+                        msg = _message_from_input(input, username, next_list)
+                        server.send(msg.encode_(wire_format))
+                        if isinstance(msg, ListMessage):
+                            last_list = msg
                     except ValueError as _:
                         print("Improper usage.")
                         _display_usage_instructions()
 
 
 if __name__ == "__main__":
+    configure_logging()
     # Run client with the specified server address and port
     run(SERVER_ADDRESS, SERVER_PORT)
\ No newline at end of file
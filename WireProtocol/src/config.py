@@ -3,11 +3,52 @@ Basic implementation for configuration values shared across client and server.
 """
 
 config = {
-    "MAX_BUFFER_SIZE": 1024,
+    "MAX_BUFFER_SIZE": 1024, # Maximum byte length of an encoded message
+    "RECV_BUFFER_SIZE": 65536, # Size of each connection's receive buffer
     "MAX_NUM_CONNECTIONS": 10,
     "SERVER_HOST": "0.0.0.0", # Address the server binds to
     "SERVER_PORT": 5002,
     "SERVER_ADDRESS": "10.250.146.71", # The IP address of the server
     "DEBUG_SERVER_ADDRESS": "0.0.0.0", # The localhost
-    "DEBUG": False
+    "DEBUG": False,
+    "SERVER_MODE": "threaded", # How the server handles connections, "threaded", "asyncio", "reactor" or "sharded"
+    "LOCK_STRIPES": 64, # Number of locks that the users of a SafeAppState are spread over
+    "WORKER_POOL_SIZE": 8, # Number of threads running services in the "reactor" server mode
+    "NUM_WORKERS": 4, # Number of worker processes in the "sharded" server mode
+    "OUTBOUND_HIGH_WATER_MARK": 1 << 20, # Maximum bytes queued in memory for each client
+    "SLOW_CONSUMER_POLICY": "spill", # What to do when a client's queue is full, "drop", "disconnect" or "spill"
+    "COALESCE_WRITES": True, # Whether what is sent to a client while handling a batch of its messages is written at once
+    "COALESCE_MAX_BYTES": 64 << 10, # Coalesced bytes for a client that are written before the end of the batch
+    "TCP_NODELAY": True, # Whether client sockets disable Nagle's algorithm, so each write is sent without delay
+    "QUEUE_DIR": None, # Directory that each queue store creates its own directory of spilled messages in, the system temporary directory if None
+    "QUEUE_MEMORY_BUDGET": 16 << 20, # Maximum bytes of queued messages kept in memory for all users
+    "QUEUE_TAIL_SIZE": 32, # Maximum number of queued messages kept in memory for each user
+    "QUEUE_SEGMENT_SIZE": 64 << 20, # Byte size of each file that queued messages are spilled to
+    "QUEUE_WINDOW_SIZE": 64, # Maximum number of queued messages sent for each QueueMessage
+    "WIRE_FORMAT": "binary", # The wire format the client requests when registering, "text" or "binary"
+    "COMPRESSION": "zlib", # The compression the client requests with the binary wire format, "zlib" or None
+    "COMPRESSION_THRESHOLD": 256, # Minimum byte length of a frame that is compressed
+    "ADMIN_USERS": [], # Usernames that can request the server's metrics with a StatsMessage from any address
+    "LOG_LEVEL": "INFO", # Minimum level of the logged records, e.g. "DEBUG", "INFO" or "WARNING"
+    "LOG_FORMAT": "(%(threadName)-9s) %(message)s", # Format of the logged records
+    # Only one in this many events of each category is logged, for events that happen for every message
+    "LOG_SAMPLE_RATES": {
+        "message": 1000,
+        "slow_consumer": 100,
+    },
+    "PERSIST_DIR": None, # Directory for the log and snapshots of users and queued messages, not persisted if None
+    "PERSIST_FLUSH_INTERVAL": 0.05, # Seconds between batched writes of the log
+    "PERSIST_SNAPSHOT_INTERVAL": 1 << 20, # Number of log records after which a snapshot is written
+    "PERSIST_FSYNC": True, # Whether each batched write of the log is followed by an fsync
+    # Rate and burst of the token bucket of each connection for each message type, see `rate_limit.py`.
+    # Chats cost one token for each recipient, so a broadcast costs as many tokens as there are active users.
+    "RATE_LIMITS": {
+        "REG": (1, 10),
+        "MSG": (2000, 20000),
+        "LST": (20, 200),
+        "DEL": (1, 10),
+        "QUE": (100, 1000),
+        "JOI": (5, 50),
+        "LEA": (5, 50),
+    },
 }
\ No newline at end of file
@@ -0,0 +1,393 @@
+"""
+Defines the fan-out engine the server uses to send encoded messages to clients. Each
+registered socket has an OutboundQueue that is drained by a dedicated writer thread,
+so sending to a slow client never blocks the thread that handles another client's
+messages. Messages are queued as immutable byte strings, so a broadcast is encoded once
+and the same object is shared by every receiving queue.
+
+If a client does not read fast enough, its queue grows until it reaches the high-water
+mark, and then the slow consumer policy decides what happens to new messages:
+    - "drop": new messages are dropped until the queue drains.
+    - "disconnect": the client is disconnected.
+    - "spill": new messages are written to a temporary file and sent after the queue drains.
+
+A thread can also coalesce what it sends to one socket, see `FanoutEngine.coalesce`, so
+the responses and messages produced for a client while handling a batch of its messages
+are written together instead of with one send each.
+"""
+import logging
+import os
+import socket
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread, local
+
+from .log import log_sampled
+
+
+DROP_POLICY = "drop"
+DISCONNECT_POLICY = "disconnect"
+SPILL_POLICY = "spill"
+SLOW_CONSUMER_POLICIES = (DROP_POLICY, DISCONNECT_POLICY, SPILL_POLICY)
+
+
+# The maximum number of buffers that can be passed to one `sendmsg()` call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def sendmsg_all(sock, buffers):
+    """
+    Send all of the buffers using vectored I/O, so that several buffers are written
+    with a single `sendmsg()` call. Falls back to `sendall()` for each buffer if the
+    socket does not support `sendmsg()`.
+
+    Args:
+        sock (Socket): The socket to send to.
+        buffers (List[bytes]): The byte strings to send, in order.
+
+    Returns:
+        None
+    """
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    buffers = deque(memoryview(buffer) for buffer in buffers if len(buffer))
+    while buffers:
+        sent = sock.sendmsg([buffers[i] for i in range(min(len(buffers), IOV_MAX))])
+        # Remove the buffers that were completely sent, and the sent part of a partially sent buffer
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.popleft())
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+class OutboundQueue:
+    """
+    Queue of byte strings waiting to be sent to one socket, and the writer thread that sends them.
+    """
+    def __init__(self, sock, high_water_mark, policy):
+        """
+        Initialize OutboundQueue.
+
+        Args:
+            sock (Socket): The socket to send to.
+            high_water_mark (int): The maximum number of bytes held in memory.
+            policy (str): The slow consumer policy, one of SLOW_CONSUMER_POLICIES.
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{policy}'.")
+
+        self.sock = sock
+        self.high_water_mark = high_water_mark
+        self.policy = policy
+        self.dropped = 0 # Number of messages dropped by the drop policy
+
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._spill = None # Temporary file for spilled messages
+        self._spill_read = 0 # Position of the next unsent byte in the spill file
+        self._spill_write = 0 # Position of the end of the spill file
+        self._closed = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread.start()
+
+    def close(self):
+        """Stop the writer thread. Messages that have not been sent are discarded."""
+        with self._cond:
+            self._closed = True
+            self._close_spill()
+            self._cond.notify()
+
+    def put(self, data):
+        """
+        Queue a byte string to be sent.
+
+        Args:
+            data (bytes): The encoded message(s).
+
+        Returns:
+            bool: True if the data was queued, False if it was dropped or the queue is closed.
+        """
+        return self.put_many([data])
+
+    def put_many(self, buffers):
+        """
+        Queue several byte strings to be sent. They are handled by the slow consumer
+        policy as one unit, so either all or none of them are dropped.
+
+        Args:
+            buffers (List[bytes]): The encoded messages.
+
+        Returns:
+            bool: True if the data was queued, False if it was dropped or the queue is closed.
+        """
+        num_bytes = sum(len(data) for data in buffers)
+        disconnect = False
+        with self._cond:
+            if self._closed:
+                return False
+            # Once messages are spilled, the following messages are spilled as well to keep their order.
+            # The policy only applies to a backlog, so a large message is queued if nothing is pending.
+            if self._spill is None and (self._pending_bytes == 0 or self._pending_bytes + num_bytes <= self.high_water_mark):
+                self._pending.extend(buffers)
+                self._pending_bytes += num_bytes
+            elif self.policy == SPILL_POLICY:
+                for data in buffers:
+                    self._spill_data(data)
+            elif self.policy == DROP_POLICY:
+                self.dropped += 1
+                log_sampled("slow_consumer", logging.WARNING, "Outbound queue is full, dropped message for %s.", self.sock)
+                return False
+            else:
+                self._closed = True
+                disconnect = True
+            self._cond.notify()
+
+        if disconnect:
+            logging.warning("Outbound queue is full, disconnecting %s.", self.sock)
+            self._disconnect()
+            return False
+        return True
+
+    def _spill_data(self, data):
+        """Append data to the spill file. Must be called while holding the lock."""
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+            self._spill_read = self._spill_write = 0
+        self._spill.seek(self._spill_write)
+        self._spill.write(data)
+        self._spill_write += len(data)
+
+    def _read_spill(self):
+        """Read the next chunk of spilled data. Must be called while holding the lock."""
+        self._spill.seek(self._spill_read)
+        data = self._spill.read(min(self.high_water_mark, self._spill_write - self._spill_read))
+        self._spill_read += len(data)
+        # Once every spilled byte is read, new messages can be queued in memory again
+        if self._spill_read == self._spill_write:
+            self._close_spill()
+        return [data]
+
+    def _close_spill(self):
+        """Close the spill file. Must be called while holding the lock."""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def _disconnect(self):
+        """Shut down the socket, which makes the client's handler disconnect it."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        """Writer thread loop that sends the queued data until the queue is closed."""
+        while True:
+            with self._cond:
+                while not self._pending and self._spill is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Send everything that is queued in memory first, then the spilled data
+                if self._pending:
+                    buffers = list(self._pending)
+                    self._pending.clear()
+                    self._pending_bytes = 0
+                else:
+                    buffers = self._read_spill()
+
+            try:
+                sendmsg_all(self.sock, buffers)
+            except OSError as e:
+                logging.error("[!] Error sending to %s: %s", self.sock, e)
+                self.close()
+                return
+
+
+class WriteBatch:
+    """The byte strings collected for one socket while its sends are coalesced."""
+    __slots__ = ("buffers", "size")
+
+    def __init__(self):
+        self.buffers = []
+        self.size = 0
+
+
+class _ThreadBatches(local):
+    """Map of the sockets whose sends the calling thread coalesces to their WriteBatch."""
+    batches = None
+
+
+class FanoutEngine:
+    """
+    Keeps an OutboundQueue for each registered socket. Sockets that are not registered
+    are sent to directly with `sendall()`.
+    """
+    def __init__(self, high_water_mark, policy, max_batch_size=None):
+        """
+        Initialize FanoutEngine.
+
+        Args:
+            high_water_mark (int): The maximum number of bytes held in memory for each socket.
+            policy (str): The slow consumer policy, one of SLOW_CONSUMER_POLICIES.
+            max_batch_size (int, optional): The number of coalesced bytes after which they are
+                sent before the end of the `coalesce` block. Defaults to the high-water mark.
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{policy}'.")
+
+        self.high_water_mark = high_water_mark
+        self.policy = policy
+        self.max_batch_size = max_batch_size if max_batch_size is not None else high_water_mark
+        self._queues = {}
+        self._lock = Lock()
+        self._local = _ThreadBatches()
+
+    def register(self, sock):
+        """Create an outbound queue and writer thread for the socket."""
+        queue = OutboundQueue(sock, self.high_water_mark, self.policy)
+        with self._lock:
+            self._queues[sock] = queue
+        queue.start()
+
+    def unregister(self, sock):
+        """Stop the writer thread for the socket if it is registered."""
+        with self._lock:
+            queue = self._queues.pop(sock, None)
+        if queue:
+            queue.close()
+
+    @contextmanager
+    def coalesce(self, sock):
+        """
+        Context manager that collects the byte strings the calling thread sends to the socket,
+        and sends them with a single `send_buffers` call when the block exits. Sends from other
+        threads are not held back. If the collected bytes reach `max_batch_size`, they are sent
+        before the end of the block. Nested blocks for the same socket join the outer block.
+
+        The slow consumer policy applies to the collected bytes as one unit when they are sent,
+        so the sends inside the block report that their data was not dropped.
+
+        Args:
+            sock (Socket): The socket to coalesce sends to.
+        """
+        batches = self._local.batches
+        if batches is None:
+            batches = self._local.batches = {}
+        if sock in batches:
+            yield
+            return
+        batch = batches[sock] = WriteBatch()
+        try:
+            yield
+        finally:
+            del batches[sock]
+            self._send_batch(sock, batch)
+
+    def _collect(self, batch, sock, buffers):
+        """Add byte strings to the socket's WriteBatch, and send it if it reached `max_batch_size`."""
+        batch.buffers.extend(buffers)
+        batch.size += sum(len(data) for data in buffers)
+        if batch.size >= self.max_batch_size:
+            self._send_batch(sock, batch)
+
+    def _send_batch(self, sock, batch):
+        """Send the collected byte strings of a WriteBatch, and empty it."""
+        buffers = batch.buffers
+        batch.buffers = []
+        batch.size = 0
+        if len(buffers) == 1:
+            self._send(sock, buffers[0])
+        elif buffers:
+            self._send_buffers(sock, buffers)
+
+    def send(self, sock, data):
+        """
+        Send a byte string to the socket without blocking if it is registered.
+
+        Args:
+            sock (Socket): The socket to send to.
+            data (bytes): The encoded message(s).
+
+        Returns:
+            bool: False if the data was dropped by the slow consumer policy, True otherwise.
+        """
+        batches = self._local.batches
+        if batches and sock in batches:
+            self._collect(batches[sock], sock, (data,))
+            return True
+        return self._send(sock, data)
+
+    def _send(self, sock, data):
+        queue = self._queues.get(sock, None)
+        if queue:
+            return queue.put(data)
+        sock.sendall(data)
+        return True
+
+    def send_buffers(self, sock, buffers):
+        """
+        Send several byte strings to the socket in order. If the socket is not registered,
+        they are sent directly with as few `sendmsg()` calls as possible.
+
+        Args:
+            sock (Socket): The socket to send to.
+            buffers (List[bytes]): The encoded messages.
+
+        Returns:
+            bool: False if the data was dropped by the slow consumer policy, True otherwise.
+        """
+        batches = self._local.batches
+        if batches and sock in batches:
+            self._collect(batches[sock], sock, buffers)
+            return True
+        return self._send_buffers(sock, buffers)
+
+    def _send_buffers(self, sock, buffers):
+        queue = self._queues.get(sock, None)
+        if queue:
+            return queue.put_many(buffers)
+        sendmsg_all(sock, buffers)
+        return True
+
+    def send_batches(self, sock, batches):
+        """
+        Send batches of byte strings to the socket in order. If the socket is registered, each
+        batch is queued separately, so a long backlog fills the queue gradually and the slow
+        consumer policy only applies to the batches that don't fit. Otherwise, every batch is
+        sent with as few `sendmsg()` calls as possible. Sends the calling thread coalesces are
+        collected with the rest of its block instead, see `coalesce`.
+
+        Args:
+            sock (Socket): The socket to send to.
+            batches (List[List[bytes]]): The batches of encoded messages.
+
+        Returns:
+            bool: False if a batch was dropped by the slow consumer policy, in which case the
+                following batches are not sent, True otherwise.
+        """
+        coalesced = self._local.batches
+        if coalesced and sock in coalesced:
+            self._collect(coalesced[sock], sock, [data for batch in batches for data in batch])
+            return True
+        queue = self._queues.get(sock, None)
+        if queue:
+            return all(queue.put_many(batch) for batch in batches)
+        sendmsg_all(sock, [data for batch in batches for data in batch])
+        return True
+
+    def publish(self, data, socks):
+        """Send the same byte string to each of the sockets."""
+        for sock in socks:
+            self.send(sock, data)
@@ -0,0 +1,124 @@
+"""
+Defines the logging pipeline of the server and client. `configure_logging` is called once
+by the entry points, e.g. the server's `main()`, with the `LOG_*` config values, rather
+than when a module is imported. Log records are put on a queue by the thread that logs
+them, and formatted and written by a QueueListener on a background thread, so a slow
+terminal or file never blocks a thread that handles messages.
+
+Logging calls pass their arguments separately from the message, e.g.
+`logging.debug("Handling message from %s", sock)`, so a message below the configured
+level costs a level check and is never formatted. Events that happen for every message,
+e.g. handling a message or dropping it for a slow consumer, are logged with `log_sampled`,
+which only logs one in every `LOG_SAMPLE_RATES[category]` events of their category.
+"""
+import atexit
+import logging
+import os
+import queue
+from collections import defaultdict
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener
+
+from .config import config
+
+
+LOG_LEVEL = config["LOG_LEVEL"]
+LOG_FORMAT = config["LOG_FORMAT"]
+LOG_SAMPLE_RATES = config["LOG_SAMPLE_RATES"]
+
+
+# The listener started by `configure_logging`, None until it is called
+_listener = None
+# The handlers and level of the root logger before `configure_logging`, restored by `stop_logging`
+_previous_config = None
+
+# Map of sampled categories to the counter of their events
+_event_counts = defaultdict(count)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that puts records on the queue without formatting them, so the message
+    and its arguments are only formatted by the listener's handler on the background thread.
+    """
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """
+    Configure the root logger to write records from a background thread. Only the first
+    call configures logging, later calls return the running listener.
+
+    Args:
+        level (Union[str, int]): The minimum level of the records that are logged.
+        fmt (str): The format of the records.
+        stream (IO, optional): The stream records are written to, sys.stderr if None.
+
+    Returns:
+        QueueListener: The listener that writes the records.
+    """
+    global _previous_config
+    if _listener is not None:
+        return _listener
+    root = logging.getLogger()
+    _previous_config = (root.handlers[:], root.level)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(fmt))
+    root.setLevel(level)
+    return _start_listener(handler)
+
+
+def _start_listener(handler):
+    """Replace the root logger's handlers with a queue, and start a listener that writes its records with the handler."""
+    global _listener
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(DeferredQueueHandler(records))
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    return _listener
+
+
+def _restart_after_fork():
+    """Start a listener in a forked process, e.g. a worker of the sharded server, which doesn't have the parent's thread."""
+    if _listener is not None:
+        _start_listener(*_listener.handlers)
+
+
+def stop_logging():
+    """Write the queued records, stop the listener started by `configure_logging`, and restore the root logger."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        root = logging.getLogger()
+        root.handlers, level = _previous_config
+        root.setLevel(level)
+
+
+def log_sampled(category, level, msg, *args):
+    """
+    Log one in every `LOG_SAMPLE_RATES[category]` events of a category, starting with the
+    first one. Categories without a rate are always logged. Events below the logged level
+    are not counted.
+
+    Args:
+        category (str): The category of the event, e.g. "message".
+        level (int): The level of the record.
+        msg (str): The message, formatted with `args` if the record is written.
+    """
+    if not logging.root.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE_RATES.get(category, 1)
+    if next(_event_counts[category]) % rate == 0:
+        if rate > 1:
+            msg = f"{msg} (1 in {rate} {category} events)"
+        logging.log(level, msg, *args)
+
+
+# Write the records that are still queued when the process exits
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,407 @@
+"""
+Defines the journal that persists the registered usernames, queued messages and room
+members of an AppState, so they survive a restart of the server.
+
+Every registration, deletion, queued message, acknowledgement, and room join and leave
+is appended to a write-ahead log. Services only add the change to a list of pending records, and a
+background thread writes the pending records in one batch every PERSIST_FLUSH_INTERVAL
+seconds, followed by one `fsync`, so the request path never waits for the disk. Changes
+made in the last interval before a crash can be lost.
+
+Once PERSIST_SNAPSHOT_INTERVAL records were logged, the thread starts a new log file and
+writes a snapshot of the whole state, after which the older log files are deleted. On
+startup, the latest snapshot is loaded and the log files after it are replayed. Records
+of changes that the snapshot already contains are skipped, so the snapshot doesn't need
+to stop the services while it is written.
+
+Each log record starts with a `RECORD` header, containing a CRC-32 of the rest of the
+record, the operation, the byte length of the username, a sequence number and the byte
+length of the payload, followed by the username and the payload. A torn record at the
+end of a log, e.g. after a crash, ends the replay of that log.
+"""
+import gc
+import logging
+import os
+import struct
+import zlib
+from threading import Event, Lock, Thread
+
+from .protocol import *
+from .queue_store import StoredMessage
+from .config import config
+
+
+PERSIST_FLUSH_INTERVAL = config["PERSIST_FLUSH_INTERVAL"]
+PERSIST_SNAPSHOT_INTERVAL = config["PERSIST_SNAPSHOT_INTERVAL"]
+PERSIST_FSYNC = config["PERSIST_FSYNC"]
+
+# Log record operations
+OP_REGISTER = 1
+OP_DELETE = 2
+OP_QUEUE = 3 # The payload is the queued message's binary frame
+OP_ACK = 4
+OP_JOIN = 5 # The payload is the room name
+OP_LEAVE = 6 # The payload is the room name
+
+# CRC-32, operation, username length, sequence number, payload length
+RECORD = struct.Struct("!IBBII")
+
+SNAPSHOT_MAGIC = b"WPS1"
+# Magic, byte length of the usernames, number of queues, number of rooms
+SNAPSHOT_HEADER = struct.Struct("!4sQQQ")
+# Username length, sequence number of the oldest message, number of messages
+SNAPSHOT_QUEUE = struct.Struct("!BII")
+# Room name length, byte length of the members' usernames
+SNAPSHOT_ROOM = struct.Struct("!BI")
+FRAME_LENGTH = struct.Struct("!I")
+
+
+def encode_record(op, username, seq=0, payload=b""):
+    """Return a log record."""
+    name = username.encode()
+    body = RECORD.pack(0, op, len(name), seq, len(payload))[4:] + name + payload
+    return struct.pack("!I", zlib.crc32(body)) + body
+
+
+def decode_records(data):
+    """
+    Yield the operation, username, sequence number and payload of each record in a log.
+    Stops at the first torn or corrupt record.
+    """
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        crc, op, name_length, seq, payload_length = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + name_length + payload_length
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+            logging.warning("Ignoring a torn record at the end of the log.")
+            return
+        name_end = offset + RECORD.size + name_length
+        yield op, data[offset + RECORD.size:name_end].decode(), seq, data[name_end:end]
+        offset = end
+
+
+def replay(records, users, queues, rooms):
+    """
+    Apply log records to the registered usernames, queued messages and rooms read from a
+    snapshot. Records of changes that the snapshot already contains are skipped.
+
+    Args:
+        records (Iterable[Tuple[int, str, int, bytes]]): The decoded log records.
+        users (Set[str]): The registered usernames, which are updated.
+        queues (Dict[str, List]): Map of usernames to the sequence number of the oldest
+            queued message and the list of queued frames, which is updated.
+        rooms (Dict[str, Set[str]]): Map of room names to their members, which is updated.
+    """
+    for op, username, seq, payload in records:
+        if op == OP_REGISTER:
+            users.add(username)
+        elif op == OP_DELETE:
+            # Deleting a user also resets its sequence numbers
+            users.discard(username)
+            queues.pop(username, None)
+            for members in rooms.values():
+                members.discard(username)
+        elif op == OP_QUEUE:
+            queue = queues.get(username)
+            if queue is None:
+                queue = queues[username] = [seq, []]
+            elif not queue[1] and seq > queue[0]:
+                queue[0] = seq
+            # Only the message after the last queued one is new
+            if seq == queue[0] + len(queue[1]):
+                queue[1].append(payload)
+        elif op == OP_ACK:
+            queue = queues.get(username)
+            if queue is None:
+                continue
+            count = min(seq - queue[0] + 1, len(queue[1]))
+            if count > 0:
+                del queue[1][:count]
+                queue[0] += count
+        elif op == OP_JOIN:
+            rooms.setdefault(payload.decode(), set()).add(username)
+        elif op == OP_LEAVE:
+            rooms.get(payload.decode(), set()).discard(username)
+        else:
+            raise ValueError(f"Unknown log record operation {op}.")
+
+
+def write_snapshot(path, users, queues, rooms=()):
+    """
+    Write a snapshot of the registered usernames, queued messages and rooms, replacing the
+    file at `path` only once the snapshot was completely written.
+
+    Args:
+        path (str): The path of the snapshot file.
+        users (List[str]): The sorted usernames.
+        queues (List[Tuple[str, int, List[bytes]]]): The username, sequence number of the
+            oldest message, and queued frames of each user.
+        rooms (List[Tuple[str, List[str]]]): The name and members of each room.
+    """
+    # Usernames are alphanumeric, so they can be separated by newlines
+    names = "\n".join(users).encode()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(names), len(queues), len(rooms)))
+        f.write(names)
+        for username, first_seq, frames in queues:
+            name = username.encode()
+            f.write(SNAPSHOT_QUEUE.pack(len(name), first_seq, len(frames)) + name)
+            f.write(b"".join(FRAME_LENGTH.pack(len(frame)) + frame for frame in frames))
+        for room, members in rooms:
+            name, members = room.encode(), "\n".join(members).encode()
+            f.write(SNAPSHOT_ROOM.pack(len(name), len(members)) + name + members)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Read a snapshot written by `write_snapshot`.
+
+    Returns:
+        Tuple[List[str], Dict[str, List], Dict[str, Set[str]]]: The sorted usernames, a map of
+            usernames to the sequence number of the oldest queued message and the list of
+            queued frames, and a map of room names to their members.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, names_length, num_queues, num_rooms = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"'{path}' is not a snapshot.")
+    offset = SNAPSHOT_HEADER.size
+    names = data[offset:offset + names_length].decode()
+    users = names.split("\n") if names else []
+    offset += names_length
+
+    queues = {}
+    for _ in range(num_queues):
+        name_length, first_seq, num_frames = SNAPSHOT_QUEUE.unpack_from(data, offset)
+        offset += SNAPSHOT_QUEUE.size
+        username = data[offset:offset + name_length].decode()
+        offset += name_length
+        frames = []
+        for _ in range(num_frames):
+            (length,) = FRAME_LENGTH.unpack_from(data, offset)
+            offset += FRAME_LENGTH.size
+            frames.append(data[offset:offset + length])
+            offset += length
+        queues[username] = [first_seq, frames]
+
+    rooms = {}
+    for _ in range(num_rooms):
+        name_length, members_length = SNAPSHOT_ROOM.unpack_from(data, offset)
+        offset += SNAPSHOT_ROOM.size
+        room = data[offset:offset + name_length].decode()
+        offset += name_length
+        rooms[room] = set(data[offset:offset + members_length].decode().split("\n"))
+        offset += members_length
+    return users, queues, rooms
+
+
+def _payload(payload):
+    """Return the bytes of a pending record's payload, which can be a message, bytes or None."""
+    if payload is None:
+        return b""
+    return payload if isinstance(payload, bytes) else payload.encode_(BINARY_FORMAT)
+
+
+class Journal:
+    """
+    Write-ahead log and snapshots of an AppState, see the module docstring. The snapshots
+    are taken from the journal's thread, so the app state must be thread-safe, e.g. a
+    SafeAppState.
+    """
+    def __init__(self, directory, flush_interval=PERSIST_FLUSH_INTERVAL,
+                 snapshot_interval=PERSIST_SNAPSHOT_INTERVAL, fsync=PERSIST_FSYNC):
+        """
+        Initialize Journal.
+
+        Args:
+            directory (str): The directory for the log and snapshot files.
+            flush_interval (float): The seconds between writes of the pending records.
+            snapshot_interval (int): The number of records after which a snapshot is written.
+            fsync (bool): Whether to `fsync` the log after each write.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.num_records = 0 # Records logged since the last snapshot
+
+        self._app = None
+        self._pending = [] # Records that are not written yet
+        self._lock = Lock() # Held to add or take the pending records
+        self._write_lock = Lock() # Held to write to the log or start a new one
+        self._snapshot_lock = Lock()
+        self._generation = max(self._generations("wal") + self._generations("snapshot"), default=0)
+        self._file = None
+        self._closed = Event()
+        self._thread = None
+
+    def _path(self, kind, generation):
+        extension = "log" if kind == "wal" else "bin"
+        return os.path.join(self.directory, f"{kind}-{generation}.{extension}")
+
+    def _generations(self, kind):
+        """Return the generations of the log or snapshot files in the directory, in order."""
+        prefix = f"{kind}-"
+        generations = []
+        for name in os.listdir(self.directory):
+            stem, extension = os.path.splitext(name)
+            if stem.startswith(prefix) and extension in (".log", ".bin"):
+                generations.append(int(stem[len(prefix):]))
+        return sorted(generations)
+
+    def recover(self):
+        """
+        Read the latest snapshot and replay the log files written after it.
+
+        Returns:
+            Tuple[List[str], Dict[str, List], Dict[str, Set[str]]]: The sorted usernames, a map
+                of usernames to the sequence number of the oldest queued message and the list of
+                queued frames, and a map of room names to their members.
+        """
+        snapshots = self._generations("snapshot")
+        snapshot_users, queues, rooms = (read_snapshot(self._path("snapshot", snapshots[-1])) if snapshots
+                                         else ([], {}, {}))
+        users = set(snapshot_users)
+        start = snapshots[-1] if snapshots else 0
+        for generation in self._generations("wal"):
+            if generation >= start:
+                with open(self._path("wal", generation), "rb") as f:
+                    replay(decode_records(f.read()), users, queues, rooms)
+
+        # The usernames in the snapshot are sorted, so only the usernames registered after it are sorted
+        sorted_users = [username for username in snapshot_users if username in users]
+        sorted_users += sorted(users.difference(sorted_users))
+        queues = {username: queue for username, queue in queues.items() if username in users}
+        rooms = {room: members & users for room, members in rooms.items()}
+        return sorted_users, queues, {room: members for room, members in rooms.items() if members}
+
+    def attach(self, app):
+        """
+        Restore the app state from the directory, then log its changes and start the
+        thread that writes them.
+
+        Args:
+            app (AppState): The app state, which should be empty.
+
+        Returns:
+            AppState: The app state.
+        """
+        # Recovery creates millions of objects that are kept, so garbage collection would
+        # repeatedly scan them without freeing anything
+        gc.disable()
+        try:
+            users, queues, rooms = self.recover()
+            app.restore(users, ((username, first_seq, [StoredMessage(frame) for frame in frames])
+                                for username, (first_seq, frames) in queues.items()), rooms.items())
+        finally:
+            gc.enable()
+        logging.info("Recovered %s users, %s message queues and %s rooms from %s.",
+                     len(users), len(queues), len(rooms), self.directory)
+
+        # Start a new log, since the latest one can end with a torn record
+        self._generation += 1
+        self._file = open(self._path("wal", self._generation), "ab")
+        self._app = app
+        app.set_journal(self)
+        self._thread = Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+        return app
+
+    def _log(self, record):
+        with self._lock:
+            self._pending.append(record)
+
+    def log_register(self, username):
+        self._log((OP_REGISTER, username, 0, None))
+
+    def log_delete(self, username):
+        self._log((OP_DELETE, username, 0, None))
+
+    def log_queue(self, username, seq, msg):
+        # The message is encoded by the journal's thread
+        self._log((OP_QUEUE, username, seq, msg))
+
+    def log_ack(self, username, seq):
+        self._log((OP_ACK, username, seq, None))
+
+    def log_join(self, username, room):
+        self._log((OP_JOIN, username, 0, room.encode()))
+
+    def log_leave(self, username, room):
+        self._log((OP_LEAVE, username, 0, room.encode()))
+
+    def flush(self):
+        """Write the pending records to the log in one batch."""
+        with self._write_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Write the pending records. Must be called while holding the write lock."""
+        with self._lock:
+            records, self._pending = self._pending, []
+        if not records or self._file is None:
+            return
+        self._file.write(b"".join(encode_record(op, username, seq, _payload(payload))
+                                  for op, username, seq, payload in records))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.num_records += len(records)
+
+    def snapshot(self):
+        """
+        Start a new log, and write a snapshot of the app state, after which the older
+        snapshots and logs are deleted.
+        """
+        with self._snapshot_lock:
+            # Changes logged from here on are in the new log, and replayed after the snapshot
+            with self._write_lock:
+                self._write_pending()
+                self._file.close()
+                self._generation += 1
+                generation = self._generation
+                self._file = open(self._path("wal", generation), "ab")
+                self.num_records = 0
+
+            users, queues, rooms = self._app.snapshot()
+            write_snapshot(self._path("snapshot", generation), users,
+                           [(username, first_seq, [msg.encode_(BINARY_FORMAT) for msg in msgs])
+                            for username, first_seq, msgs in queues], rooms)
+            for kind in ("snapshot", "wal"):
+                for old in self._generations(kind):
+                    if old < generation:
+                        os.remove(self._path(kind, old))
+
+    def _run(self):
+        """Write the pending records every interval, and a snapshot after enough records."""
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+                if self.num_records >= self.snapshot_interval:
+                    self.snapshot()
+            except OSError:
+                logging.exception("Failed to persist the app state.")
+
+    def close(self, snapshot=False):
+        """
+        Stop the journal's thread and write the pending records.
+
+        Args:
+            snapshot (bool): Whether to also write a snapshot, so the next start doesn't replay the log.
+        """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._file is None:
+            return
+        if snapshot:
+            self.snapshot()
+        self.flush()
+        self._file.close()
+        self._file = None
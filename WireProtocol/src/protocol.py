@@ -2,19 +2,102 @@
 Defines message schema. Each message has the format "[enc_header][sep_token]data...[sep_token][EOM]",
 where data is a variable length (dependent on message type) sequence of strings joined by `sep_token`.
 
-NOTE: We can modify these classes to encode header-body messages to handle potential buffer issues.
+Messages can also be encoded with a binary wire format. A binary frame starts with a fixed
+header `[magic][type_code][flags][num_fields][body_length]`, followed by a uint16 length for
+each field and then the UTF-8 encoded fields. Since the field lengths are explicit, user text
+can contain any tokens. The wire format is negotiated by the client when registering, and the
+decoding functions accept a mix of both formats in the same buffer.
+
+Client messages can carry an optional request ID, which the server copies to the response, so
+a client can pipeline many requests on one connection and match the responses that answer them.
+Text frames carry it after the encoding header, e.g. "MSG#7", and binary frames set the
+FLAG_REQUEST_ID flag and carry it as a uint32 between the header and the field lengths.
+
+Clients using the binary wire format can also negotiate zlib compression when registering.
+Frames of at least COMPRESSION_THRESHOLD bytes are then sent in a compressed frame, which
+sets the FLAG_COMPRESSED flag and whose body is one or more zlib compressed binary frames,
+so a batch of queued messages can be compressed together.
+
+Users can join named rooms with a JoinMessage. A ChatMessage whose recipient is a room name
+prefixed with ROOM_PREFIX, e.g. "#general", is sent to the room's active members.
 """
 import logging
+import struct
+import zlib
+from functools import lru_cache
 
 from src.config import config
 
 
-# Logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-9s) %(message)s',)
+MAX_BUFFER_SIZE = config["MAX_BUFFER_SIZE"]
+RECV_BUFFER_SIZE = config["RECV_BUFFER_SIZE"]
+COMPRESSION_THRESHOLD = config["COMPRESSION_THRESHOLD"]
 
 
-MAX_BUFFER_SIZE = config["MAX_BUFFER_SIZE"]
+# Wire formats
+TEXT_FORMAT = "text"
+BINARY_FORMAT = "binary"
+WIRE_FORMATS = (TEXT_FORMAT, BINARY_FORMAT)
+
+# Binary framing. The magic byte is not a valid first byte of a UTF-8 string, so
+# binary frames can be distinguished from text frames by their first byte.
+FRAME_MAGIC = 0xB7
+BINARY_HEADER = struct.Struct("!BBBBI") # magic, type code, flags, number of fields, body length
+FIELD_LENGTH = struct.Struct("!H")
+
+# Request IDs
+FLAG_REQUEST_ID = 0x01 # The binary frame has a request ID after the header
+REQUEST_ID = struct.Struct("!I")
+REQUEST_ID_SEPARATOR = "#" # Separates the request ID from the encoding header in text frames
+
+# Compression
+ZLIB_COMPRESSION = "zlib"
+COMPRESSIONS = (ZLIB_COMPRESSION,)
+# The encoding of messages to clients that negotiated compression with the binary wire format.
+# It is not a wire format that clients can request.
+COMPRESSED_FORMAT = "binary+zlib"
+FLAG_COMPRESSED = 0x02 # The body of the binary frame is zlib compressed binary frames
+COMPRESSED_TYPE_CODE = 0 # The type code of compressed frames
+MAX_DECOMPRESSED_SIZE = 16 * MAX_BUFFER_SIZE # Maximum byte length of the frames in a compressed frame
+
+# Rooms. Usernames are alphanumeric, so a recipient with the prefix is a room.
+ROOM_PREFIX = "#"
+
+
+# Message registries, filled by the `client_message` and `server_message` class decorators
+CLIENT_MESSAGES = {} # Map of encoding headers to client message classes
+SERVER_MESSAGES = {} # Map of encoding headers to server message classes
+TYPE_CODE_HEADERS = {} # Map of binary type codes to encoding headers
+
+
+def _registry(registry):
+    """Return a class decorator that registers a message class for decoding in `registry`."""
+    def register(cls):
+        registry[cls.enc_header] = cls
+        TYPE_CODE_HEADERS[cls.type_code] = cls.enc_header
+        return cls
+    return register
+
+
+# Class decorators that register a message class, so it is decoded with one dict lookup
+client_message = _registry(CLIENT_MESSAGES)
+server_message = _registry(SERVER_MESSAGES)
+
+
+@lru_cache(maxsize=None)
+def _field_lengths_struct(num_fields):
+    """Return the (cached) Struct for packing the lengths of `num_fields` fields."""
+    return struct.Struct(f"!{num_fields}H")
+
+
+@lru_cache(maxsize=None)
+def _frame_head_struct(num_fields, has_request_id):
+    """
+    Return the (cached) Struct for packing the header of a binary frame, its request ID
+    if it has one, and the lengths of its `num_fields` fields with one `pack()` call.
+    """
+    request_id = "I" if has_request_id else ""
+    return struct.Struct(f"{BINARY_HEADER.format}{request_id}{num_fields}H")
 
 
 class Message:
@@ -22,10 +105,19 @@ class Message:
     Base class for protocol messages. Handles the shared functionality
     for converting a Message object to an encoded string, and checking that
     the byte length is smaller than MAX_BUFFER_SIZE.
+
+    Messages are created and encoded for every chat, so each class lists its fields in
+    `__slots__` instead of keeping a `__dict__` for every instance. Subclasses call
+    `super().__init__()`, which initializes the slots shared by every message.
     """
+    __slots__ = ("request_id",)
     separator_token = "<SEP>"
     EOM_token = "<EOM>" # End of message token
     enc_header = None
+    type_code = None # Identifies the message type in binary frames
+
+    def __init__(self):
+        self.request_id = None # Set on pipelined requests and the responses that answer them
 
     def _data_items(self):
         """
@@ -39,39 +131,120 @@ class Message:
             List[str]: The items to concatenate in encoded string.    
         """
         raise NotImplementedError
+
+    @classmethod
+    def _from_content(cls, content):
+        """
+        Return the message for the items of a decoded frame. Implemented in each
+        child class that is registered for decoding.
+
+        Args:
+            content (List[str]): The encoding header, followed by the data items.
+
+        Returns:
+            Message: The decoded message.
+        """
+        raise NotImplementedError
     
-    def encode_(self):
-        """Returns the encoded string for the message."""
+    def _encode_binary(self):
+        """
+        Returns the binary frame for the message. The header, request ID and field lengths
+        are packed with one Struct. ASCII fields have as many bytes as characters, so they
+        are joined into one string and encoded at once, instead of encoding each field.
+        """
+        items = self._data_items()
+        num_fields = len(items)
+        if all(map(str.isascii, items)):
+            fields = "".join(items).encode()
+            lengths = list(map(len, items))
+        else:
+            encoded = [item.encode() for item in items]
+            fields = b"".join(encoded)
+            lengths = list(map(len, encoded))
+        body_length = FIELD_LENGTH.size * num_fields + len(fields)
+        if self.request_id is None:
+            head = _frame_head_struct(num_fields, False).pack(
+                FRAME_MAGIC, self.type_code, 0, num_fields, body_length, *lengths)
+        else:
+            head = _frame_head_struct(num_fields, True).pack(
+                FRAME_MAGIC, self.type_code, FLAG_REQUEST_ID, num_fields, body_length + REQUEST_ID.size,
+                self.request_id, *lengths)
+        return head + fields
+
+    def _encode_text(self):
+        """Returns the text frame for the message."""
         # Message items are the encoding header, any message data items, and EOM
-        msg_items = [self.enc_header] + self._data_items()
-        out_str = self.separator_token.join(msg_items) + self.EOM_token
-        out_str = out_str.encode()
-        # Check that the byte length is less than MAX_BUFFER_SIZE
-        if len(out_str) < MAX_BUFFER_SIZE:
-            return out_str
+        header = self.enc_header
+        if self.request_id is not None:
+            header = f"{header}{REQUEST_ID_SEPARATOR}{self.request_id}"
+        msg_items = [header] + self._data_items()
+        return (self.separator_token.join(msg_items) + self.EOM_token).encode()
+
+    def encode_(self, wire_format=TEXT_FORMAT):
+        """
+        Returns the encoded string for the message.
+
+        Args:
+            wire_format (str): Either TEXT_FORMAT, BINARY_FORMAT or COMPRESSED_FORMAT.
+
+        Returns:
+            bytes: The encoded message.
+        """
+        if wire_format == BINARY_FORMAT or wire_format == COMPRESSED_FORMAT:
+            out_str = self._encode_binary()
         else:
+            out_str = self._encode_text()
+        # Check that the byte length is less than MAX_BUFFER_SIZE
+        if len(out_str) >= MAX_BUFFER_SIZE:
             raise ValueError("Message byte length exceeds limit.")
+        if wire_format == COMPRESSED_FORMAT:
+            return compress_frame(out_str)
+        return out_str
 
 
 ####################
 ### Client Messages
 ####################
 
+@client_message
 class RegisterMessage(Message):
+    """
+    Client message for registering a username. The client can optionally request
+    a wire format for the rest of the session, and a compression for messages sent
+    with the binary wire format.
+    """
+    __slots__ = ("username", "wire_format", "compression")
     enc_header = "REG"
+    type_code = 1
     
-    def __init__(self, username):
+    def __init__(self, username, wire_format=None, compression=None):
+        super().__init__()
         self.username = username
+        self.wire_format = wire_format
+        self.compression = compression
 
     def _data_items(self):
-        return [self.username]
+        # Only include the wire format and compression if they were requested
+        if self.compression:
+            return [self.username, self.wire_format or "", self.compression]
+        return [self.username, self.wire_format] if self.wire_format else [self.username]
 
+    @classmethod
+    def _from_content(cls, content):
+        wire_format = content[2] if len(content) > 2 and content[2] else None
+        compression = content[3] if len(content) > 3 and content[3] else None
+        return cls(username=content[1], wire_format=wire_format, compression=compression)
 
+
+@client_message
 class ChatMessage(Message):
     """
-    Client message for sending a chat.
+    Client message for sending a chat. The recipient is a username, a room name prefixed
+    with ROOM_PREFIX, or None to send to every active user.
     """
+    __slots__ = ("sender", "text", "recipient")
     enc_header = "MSG"
+    type_code = 2
     text_char_lim = 280 # Maximum number of characters for each message
 
 
@@ -80,6 +253,7 @@ class ChatMessage(Message):
         if len(text) > self.text_char_lim:
             raise ValueError(f"Messages have a limit of {self.text_char_lim} characters.")
         
+        super().__init__()
         self.sender = sender
         self.text = text
         self.recipient = recipient
@@ -88,55 +262,166 @@ class ChatMessage(Message):
         # Use "^" as the string representation of sending to all active users
         recipient_str = self.recipient if self.recipient else "^"
         return [self.sender, recipient_str, self.text]
+
+    @classmethod
+    def _from_content(cls, content):
+        recipient = None if content[2] == "^" else content[2]
+        return cls(sender=content[1], recipient=recipient, text=content[3])
     
     def to_broadcast(self):
         """Return the corresponding BroadcastMessage."""
         return BroadcastMessage(sender=self.sender, direct=self.recipient, text=self.text)
 
         
+@client_message
 class ListMessage(Message):
-    """Client message for listing users."""
+    """
+    Client message for listing users. To continue a listing that exceeded the limit,
+    the client sends the `cursor` of the previous ListResponse, and only users after
+    it are listed.
+    """
+    __slots__ = ("wildcard", "cursor")
     enc_header = "LST"
+    type_code = 3
 
-    def __init__(self, wildcard=None):
+    def __init__(self, wildcard=None, cursor=None):
+        super().__init__()
         self.wildcard = wildcard
+        self.cursor = cursor
 
     def _data_items(self):
-        return [self.wildcard] if self.wildcard else ["*"]
+        items = [self.wildcard] if self.wildcard else ["*"]
+        # Only include the cursor if continuing a listing
+        return items + [self.cursor] if self.cursor else items
+
+    @classmethod
+    def _from_content(cls, content):
+        wildcard = content[1] if content[1] != "*" else None
+        cursor = content[2] if len(content) > 2 and content[2] else None
+        return cls(wildcard=wildcard, cursor=cursor)
 
 
+@client_message
 class DeleteMessage(Message):
     """Client message for deleting a user."""
+    __slots__ = ("username",)
     enc_header = "DEL"
+    type_code = 4
 
     def __init__(self, username):
+        super().__init__()
         self.username = username
 
     def _data_items(self):
         return [self.username]
 
+    @classmethod
+    def _from_content(cls, content):
+        return cls(username=content[1])
 
+
+@client_message
 class QueueMessage(Message):
-    """Client message for requesting queued messages."""
+    """
+    Client message for requesting queued messages. The server sends a window of the
+    oldest queued messages, and the client acknowledges them by sending the `last_seq`
+    of the QueueResponse as `ack` in its next QueueMessage, which frees the messages up
+    to that sequence number.
+    """
+    __slots__ = ("username", "ack")
     enc_header = "QUE"
+    type_code = 5
 
-    def __init__(self, username):
+    def __init__(self, username, ack=None):
+        super().__init__()
         self.username = username
+        self.ack = ack
 
     def _data_items(self):
-        return [self.username]
+        # Only include the acknowledged sequence number if there is one
+        return [self.username, str(self.ack)] if self.ack is not None else [self.username]
+
+    @classmethod
+    def _from_content(cls, content):
+        ack = int(content[2]) if len(content) > 2 and content[2] else None
+        return cls(username=content[1], ack=ack)
+
+
+@client_message
+class JoinMessage(Message):
+    """Client message for joining a room, which is created if it doesn't exist."""
+    __slots__ = ("username", "room")
+    enc_header = "JOI"
+    type_code = 6
+
+    def __init__(self, username, room):
+        super().__init__()
+        self.username = username
+        self.room = room
+
+    def _data_items(self):
+        return [self.username, self.room]
+
+    @classmethod
+    def _from_content(cls, content):
+        return cls(username=content[1], room=content[2])
+
+
+@client_message
+class LeaveMessage(Message):
+    """Client message for leaving a room."""
+    __slots__ = ("username", "room")
+    enc_header = "LEA"
+    type_code = 7
+
+    def __init__(self, username, room):
+        super().__init__()
+        self.username = username
+        self.room = room
+
+    def _data_items(self):
+        return [self.username, self.room]
+
+    @classmethod
+    def _from_content(cls, content):
+        return cls(username=content[1], room=content[2])
+
+
+@client_message
+class StatsMessage(Message):
+    """
+    Client message for requesting the server's live metrics, see StatsResponse. Only
+    answered for clients connected from localhost or registered as an admin user.
+    """
+    __slots__ = ()
+    enc_header = "STA"
+    type_code = 8
+
+    def __init__(self):
+        super().__init__()
+
+    def _data_items(self):
+        return []
+
+    @classmethod
+    def _from_content(cls, content):
+        return cls()
 
 
 ####################
 ### Server Messages
 ####################
 
+@server_message
 class BroadcastMessage(Message):
     """
-    Class for server's execution of ChatMessage requests.
+    Class for server's execution of ChatMessage requests. For a message to a room,
+    `direct` is the room name prefixed with ROOM_PREFIX.
     NOTE: Can add metadata like when the message was sent.
     """
+    __slots__ = ("sender", "text", "direct")
     enc_header = "BRO"
+    type_code = 16
 
     def __init__(self, sender, text, direct=None):
         """
@@ -145,8 +430,10 @@ class BroadcastMessage(Message):
         Args:
             sender (str): The username of the sender.
             text (str): The text of the chat message.
-            direct (str): The username of the recipient if direct message, else None.
+            direct (str): The username of the recipient if direct message, the prefixed
+                room name if sent to a room, else None.
         """
+        super().__init__()
         self.sender = sender
         self.text = text
         self.direct = direct
@@ -155,6 +442,31 @@ class BroadcastMessage(Message):
         # If `direct` is None, represent with empty string
         direct_str = self.direct if self.direct else "" 
         return [self.sender, direct_str, self.text]
+
+    # BroadcastMessages are encoded for every chat, so they are encoded without building
+    # lists of the items, directly into one string or one Struct and the encoded fields.
+    _BINARY_HEAD = _frame_head_struct(3, False)
+
+    def _encode_text(self):
+        if self.request_id is not None:
+            return super()._encode_text()
+        direct_str = self.direct if self.direct else ""
+        return f"BRO<SEP>{self.sender}<SEP>{direct_str}<SEP>{self.text}<EOM>".encode()
+
+    def _encode_binary(self):
+        if self.request_id is not None:
+            return super()._encode_binary()
+        sender = self.sender.encode()
+        direct = self.direct.encode() if self.direct else b""
+        text = self.text.encode()
+        body_length = 3 * FIELD_LENGTH.size + len(sender) + len(direct) + len(text)
+        head = self._BINARY_HEAD.pack(FRAME_MAGIC, self.type_code, 0, 3, body_length, len(sender), len(direct), len(text))
+        return b"".join((head, sender, direct, text))
+
+    @classmethod
+    def _from_content(cls, content):
+        direct = content[2] if content[2] != "" else None
+        return cls(sender=content[1], direct=direct, text=content[3])
     
 
 class Response(Message):
@@ -162,7 +474,9 @@ class Response(Message):
     Base class for server responses to messages. Each Response object has
     a `success` and `error` field.
     """
+    __slots__ = ("success", "error")
     enc_header = "RES"
+    type_code = 32
 
     def __init__(self, success, error=None):
         """
@@ -175,38 +489,67 @@ class Response(Message):
         Returns:
             Response
         """
+        super().__init__()
         self.success = success # Boolean
         self.error = error if error else ""
 
     def _data_items(self):
-        success_str = str(int(self.success)) # Convert bool to 1/0 string
+        success_str = "1" if self.success else "0" # Convert bool to 1/0 string
         return [success_str, self.error]
 
+    @classmethod
+    def _from_content(cls, content):
+        return cls(success=bool(int(content[1])), error=content[2])
 
+
+@server_message
 class RegisterResponse(Response):
     """
     Response format for registering username. Extends Response class with
     a boolean that is False if the user is a returning user, i.e. the username
-    has previously been registered.
+    has previously been registered, and the wire format and compression the server
+    accepted if the client requested them.
     """
+    __slots__ = ("is_new_user", "wire_format", "compression")
     enc_header = "RESR"
+    type_code = 33
 
-    def __init__(self, success, error=None, is_new_user=None):
+    def __init__(self, success, error=None, is_new_user=None, wire_format=None, compression=None):
         super().__init__(success, error)
         self.is_new_user = is_new_user
+        self.wire_format = wire_format
+        self.compression = compression
 
     def _data_items(self):
         # If `is_new_user` is None, it is an error response. Include an empty
         # string in place of this field.
         new_user_str = str(int(self.is_new_user)) if self.is_new_user != None else ""
-        return super()._data_items() + [new_user_str]
+        items = super()._data_items()
+        items.append(new_user_str)
+        if self.compression:
+            items += (self.wire_format or "", self.compression)
+        elif self.wire_format:
+            items.append(self.wire_format)
+        return items
+
+    @classmethod
+    def _from_content(cls, content):
+        is_new_user = bool(int(content[3])) if content[3] else None
+        wire_format = content[4] if len(content) > 4 and content[4] else None
+        compression = content[5] if len(content) > 5 and content[5] else None
+        return cls(success=bool(int(content[1])), error=content[2], is_new_user=is_new_user, wire_format=wire_format,
+                   compression=compression)
     
     
+@server_message
 class ChatResponse(Response):
     """Response format for chat messages."""
+    __slots__ = ()
     enc_header = "RESC"
+    type_code = 34
 
 
+@server_message
 class ListResponse(Response):
     """
     Response format for ListMessage. Extends Response class to 
@@ -214,7 +557,9 @@ class ListResponse(Response):
     client know that there are more users satisfying the wildcard that the response
     contains.
     """
+    __slots__ = ("users", "limit_exceeded")
     enc_header = "RESL"
+    type_code = 35
     max_num_users = 30 # The maximum number of users that will be sent in list response.
 
     def __init__(self, success, users, error=None, limit_exceeded=False):
@@ -233,119 +578,402 @@ class ListResponse(Response):
         super().__init__(success, error)
         self.users = users
         self.limit_exceeded = limit_exceeded
+
+    @property
+    def cursor(self):
+        """The cursor for listing the next users, or None if every user was listed."""
+        return self.users[-1] if self.limit_exceeded and self.users else None
     
     def _data_items(self):
         # In addition to success and error fields, we add users as a list of strings, and a flag
         # for if there are more users satisfying wildcard than can be listed.
-        return super()._data_items() + [str(int(self.limit_exceeded))] + self.users
+        items = super()._data_items()
+        items.append("1" if self.limit_exceeded else "0")
+        items += self.users
+        return items
+
+    @classmethod
+    def _from_content(cls, content):
+        users = content[4:] if len(content) > 3 else None
+        return cls(success=bool(int(content[1])), error=content[2], limit_exceeded=bool(int(content[3])), users=users)
     
 
+@server_message
 class DeleteResponse(Response):
     """Response format for delete messages."""
+    __slots__ = ()
     enc_header = "RESD"
+    type_code = 36
 
 
+@server_message
 class QueueResponse(Response):
     """Response for requesting queued messages. The actual messages
-    are sent separately."""
+    are sent separately, before the response. A successful response has the
+    sequence number of the last message sent, and the number of messages that
+    are still queued after it."""
+    __slots__ = ("last_seq", "remaining")
     enc_header = "RESQ"
+    type_code = 37
+
+    def __init__(self, success, error=None, last_seq=None, remaining=None):
+        super().__init__(success, error)
+        self.last_seq = last_seq
+        self.remaining = remaining
+
+    def _data_items(self):
+        items = super()._data_items()
+        # Only include the window if messages were sent
+        if self.last_seq is not None:
+            items += (str(self.last_seq), str(self.remaining))
+        return items
+
+    @classmethod
+    def _from_content(cls, content):
+        last_seq, remaining = (int(content[3]), int(content[4])) if len(content) > 4 else (None, None)
+        return cls(success=bool(int(content[1])), error=content[2], last_seq=last_seq, remaining=remaining)
 
 
-def encode_msg_queue(msgs):
+@server_message
+class JoinResponse(Response):
+    """Response format for join messages."""
+    __slots__ = ()
+    enc_header = "RESJ"
+    type_code = 38
+
+
+@server_message
+class LeaveResponse(Response):
+    """Response format for leave messages."""
+    __slots__ = ()
+    enc_header = "RESV"
+    type_code = 39
+
+
+@server_message
+class StatsResponse(Response):
     """
-    Function that takes a list of BroadcastMessage instances and returns
-    a list of byte strings, where each string is at most MAX_BUFFER_SIZE.
+    Response format for StatsMessage. Extends Response class with the server's metrics as
+    a map of names to string values, e.g. "connections" or "latency_us.MSG", which are
+    encoded as "name=value" items. The metrics that don't fit in MAX_BUFFER_SIZE are left
+    out, and the `truncated` flag lets the client know.
+    """
+    __slots__ = ("stats", "truncated")
+    enc_header = "RESS"
+    type_code = 40
+
+    def __init__(self, success, error=None, stats=None, truncated=False):
+        """
+        Initialize StatsResponse instance.
+
+        Args:
+            success (bool): True if the message was handled successfully.
+            error (str, Optional): Error message.
+            stats (Dict[str, str], Optional): Map of metric names to their values.
+            truncated (bool): True if metrics were left out to fit in MAX_BUFFER_SIZE.
+
+        Returns:
+            StatsResponse
+        """
+        super().__init__(success, error)
+        self.stats = stats if stats is not None else {}
+        self.truncated = truncated
+
+    def _data_items(self):
+        items = super()._data_items()
+        items.append("1" if self.truncated else "0")
+        items += (f"{name}={value}" for name, value in self.stats.items())
+        return items
+
+    @classmethod
+    def _from_content(cls, content):
+        stats = dict(item.split("=", 1) for item in content[4:])
+        truncated = bool(int(content[3])) if len(content) > 3 else False
+        return cls(success=bool(int(content[1])), error=content[2], stats=stats, truncated=truncated)
+
+
+def _compressed_frame(frames):
+    """Return a compressed frame that contains the binary frames."""
+    body = zlib.compress(b"".join(frames))
+    return BINARY_HEADER.pack(FRAME_MAGIC, COMPRESSED_TYPE_CODE, FLAG_COMPRESSED, 0, len(body)) + body
+
+
+def compress_frame(frame):
+    """
+    Return a compressed frame that contains the binary frame, if the frame has at least
+    COMPRESSION_THRESHOLD bytes and compressing it saves bytes. Otherwise, return the frame.
+    """
+    if len(frame) < COMPRESSION_THRESHOLD:
+        return frame
+    compressed = _compressed_frame([frame])
+    return compressed if len(compressed) < len(frame) else frame
+
+
+def _compress_batch(frames):
+    """
+    Return the binary frames as a list of frames of less than MAX_BUFFER_SIZE bytes each,
+    where the frames are compressed together, and split into halves until each compressed
+    frame fits. A frame that does not fit when compressed on its own is kept as is.
+    """
+    if sum(len(frame) for frame in frames) < COMPRESSION_THRESHOLD:
+        return frames
+    compressed = _compressed_frame(frames)
+    if len(compressed) < MAX_BUFFER_SIZE:
+        return [compressed]
+    if len(frames) == 1:
+        return frames
+    half = len(frames) // 2
+    return _compress_batch(frames[:half]) + _compress_batch(frames[half:])
+
+
+def encode_msg_batches(msgs, wire_format=TEXT_FORMAT):
+    """
+    Function that takes a list of BroadcastMessage instances and returns the
+    encoded messages grouped into batches, where the total byte length of each
+    batch is at most MAX_BUFFER_SIZE. The encoded messages are not concatenated,
+    so the batches can be sent with vectored I/O, e.g. `socket.sendmsg()`.
+
+    With COMPRESSED_FORMAT, the messages of up to MAX_DECOMPRESSED_SIZE bytes are
+    compressed together into frames of less than MAX_BUFFER_SIZE bytes, so each batch
+    has more messages.
 
     Args:
         msgs (List[BroadcastMessage]): The queued messages.
+        wire_format (str): The wire format to encode the messages with.
 
     Returns:
-        List[byte str]
+        List[List[byte str]]: The encoded messages in each batch.
     """
-    # List of byte strings 
+    compress = wire_format == COMPRESSED_FORMAT
+    # Encode every message into one list, and then slice it into batches
+    encoded = [msg.encode_(BINARY_FORMAT if compress else wire_format) for msg in msgs]
+    max_batch_size = MAX_DECOMPRESSED_SIZE if compress else MAX_BUFFER_SIZE
+
     out = []
+    batch_start = 0
+    batch_length = 0
+    for i, data in enumerate(encoded):
+        # Check that adding message doesn't exceed the maximum batch size,
+        # otherwise end the batch before the message
+        if batch_length + len(data) >= max_batch_size and i > batch_start:
+            out.append(encoded[batch_start:i])
+            batch_start = i
+            batch_length = 0
+        batch_length += len(data)
+
+    # Append remaining messages
+    if batch_start < len(encoded):
+        out.append(encoded[batch_start:])
+
+    if compress:
+        # Each compressed frame is sent as its own batch
+        return [[frame] for batch in out for frame in _compress_batch(batch)]
+    return out
 
-    data = b""
-    for msg in msgs:
-        # Add the encoded byte string to 
-        encoded = msg.encode_()
-        # Check that adding message doesn't exceed MAX_BUFFER_SIZE
-        if len(encoded) + len(data) < MAX_BUFFER_SIZE:
-            data += encoded
-        # Otherwise append `data` and start a new byte string
-        else:
-            out.append(data)
-            data = encoded
 
-    # Append remaining data
-    if data:
-        out.append(data)
-        
-    return out
+def encode_msg_queue(msgs, wire_format=TEXT_FORMAT):
+    """
+    Function that takes a list of BroadcastMessage instances and returns
+    a list of byte strings, where each string is at most MAX_BUFFER_SIZE.
+
+    Args:
+        msgs (List[BroadcastMessage]): The queued messages.
+        wire_format (str): The wire format to encode the messages with.
+
+    Returns:
+        List[byte str]
+    """
+    return [b"".join(batch) for batch in encode_msg_batches(msgs, wire_format)]
 
 
 ####################
 ### Decoding
 ####################
 
+def _unpack_binary_frame(frame):
+    """
+    Unpack a binary frame into a list of strings, where the first item
+    is the encoding header of the message type, and the request ID of the frame.
+
+    Args:
+        frame (bytes): A complete binary frame.
+
+    Returns:
+        Tuple[List[str], Optional[int]]: The header and data items, and the request ID if the frame has one.
+
+    Raises:
+        ValueError: If the frame is malformed.
+    """
+    try:
+        magic, type_code, flags, num_fields, body_length = BINARY_HEADER.unpack_from(frame)
+        request_id = None
+        fields_start = BINARY_HEADER.size
+        if flags & FLAG_REQUEST_ID:
+            request_id = REQUEST_ID.unpack_from(frame, fields_start)[0]
+            fields_start += REQUEST_ID.size
+        lengths = _field_lengths_struct(num_fields).unpack_from(frame, fields_start)
+    except struct.error as e:
+        raise ValueError(f"Malformed binary frame: {e}")
+    if magic != FRAME_MAGIC or len(frame) != BINARY_HEADER.size + body_length:
+        raise ValueError("Malformed binary frame.")
+
+    # The fields must fill the rest of the frame exactly
+    start = fields_start + FIELD_LENGTH.size * num_fields
+    if start + sum(lengths) != len(frame):
+        raise ValueError("Malformed binary frame: field lengths don't match the body length.")
+    if not isinstance(frame, bytes):
+        frame = bytes(frame)
+
+    # Unknown type codes are mapped to an empty header, which the
+    # deserialization functions reject
+    content = [TYPE_CODE_HEADERS.get(type_code, "")]
+    for length in lengths:
+        content.append(frame[start:start + length].decode())
+        start += length
+    return content, request_id
+
+
+def _message_content(msg):
+    """Split a text message string or binary frame into its header and data items, and its request ID."""
+    if isinstance(msg, (bytes, bytearray, memoryview)):
+        return _unpack_binary_frame(msg)
+    content = msg.split(Message.separator_token)
+    header, _, request_id = content[0].partition(REQUEST_ID_SEPARATOR)
+    if not request_id:
+        return content, None
+    try:
+        content[0] = header
+        return content, int(request_id)
+    except ValueError:
+        raise ValueError("Malformed request ID.")
+
+
 def deserialize_client_message(msg):
     """
-    Factory method for deserializing a message string to appropriate Message subclass.
+    Factory method for deserializing a message string to appropriate Message subclass,
+    which is looked up in the registry of client messages by its encoding header.
     
     Args:
-        msg (str): The decoded string.
+        msg (Union[str, bytes]): The decoded string, or a binary frame.
     
     Returns:
         Message: The deserialized Message instance.
     """
-    content = msg.split(Message.separator_token)
-
-    if content[0] == RegisterMessage.enc_header:
-        return RegisterMessage(username=content[1])
-    elif content[0] == ChatMessage.enc_header:
-        recipient = None if content[2] == "^" else content[2]
-        return ChatMessage(sender=content[1], recipient=recipient, text=content[3])
-    elif content[0] == ListMessage.enc_header:
-        wildcard = content[1] if content[1] != "*" else None
-        return ListMessage(wildcard=wildcard)
-    elif content[0] == DeleteMessage.enc_header:
-        return DeleteMessage(username=content[1])
-    elif content[0] == QueueMessage.enc_header:
-        return QueueMessage(username=content[1])
-    else:
-      raise ValueError("Unknown message type header received from client.")
+    content, request_id = _message_content(msg)
+    cls = CLIENT_MESSAGES.get(content[0])
+    if cls is None:
+        raise ValueError("Unknown message type header received from client.")
+    message = cls._from_content(content)
+    if request_id is not None:
+        message.request_id = request_id
+    return message
 
 
 def deserialize_server_message(msg):
     """
-    Factory method for deserializing a message string to appropriate Message subclass.
+    Factory method for deserializing a message string to appropriate Message subclass,
+    which is looked up in the registry of server messages by its encoding header.
     
     Args:
-        msg (str): The decoded string.
+        msg (Union[str, bytes]): The decoded string, or a binary frame.
     
     Returns:
         Message: The deserialized Message instance.
     """
-    content = msg.split(Message.separator_token)
-
-    if content[0] == RegisterResponse.enc_header:
-        is_new_user = content[3] if content[3] else None
-        return RegisterResponse(success=bool(int(content[1])), error=content[2], is_new_user=is_new_user)
-    elif content[0] == ChatResponse.enc_header:
-        return ChatResponse(success=bool(int(content[1])), error=content[2])
-    elif content[0] == DeleteResponse.enc_header:
-        return DeleteResponse(success=bool(int(content[1])), error=content[2])
-    elif content[0] == ListResponse.enc_header:
-        users = content[4:] if len(content) > 3 else None
-        return ListResponse(success=bool(int(content[1])), error=content[2], limit_exceeded=bool(int(content[3])), users=users)
-    elif content[0] == BroadcastMessage.enc_header:
-        direct = content[2] if content[2] != "" else None
-        return BroadcastMessage(sender=content[1], direct=direct, text=content[3])
-    elif content[0] == QueueResponse.enc_header:
-        return QueueResponse(success=bool(int(content[1])), error=content[2])
-    else:
+    content, request_id = _message_content(msg)
+    cls = SERVER_MESSAGES.get(content[0])
+    if cls is None:
         raise ValueError("Unknown message type header received from server.")
+    message = cls._from_content(content)
+    if request_id is not None:
+        message.request_id = request_id
+    return message
+
+
+def _decompress_frames(body):
+    """Return the frames in the body of a compressed frame, or an empty list if it is malformed."""
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        logging.error("Could not decompress frame: %s", e)
+        return []
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        logging.error("Compressed frame exceeds the maximum decompressed size.")
+        return []
+
+    # Compressed frames can't be nested
+    frames, consumed = split_frames(data, decompress=False)
+    if consumed != len(data):
+        logging.error("Compressed frame did not contain complete frames.")
+    return frames
+
+
+def split_frames(buffer, start=0, end=None, decompress=True):
+    """
+    Split a byte buffer into complete frames. Text frames are returned as decoded
+    strings without the EOM token, and binary frames are returned as bytes. Text
+    frames that are not valid UTF-8 are skipped, and compressed frames are replaced
+    by the frames they contain.
+
+    Args:
+        buffer (Union[bytes, bytearray]): The received bytes.
+        start (int): The position in the buffer to start splitting from.
+        end (int, optional): The end of the received bytes, defaults to the buffer length.
+        decompress (bool): Whether to decompress compressed frames, or skip them.
+
+    Returns:
+        Tuple[List[Union[str, bytes]], int]: The complete frames, and the position
+            in the buffer after the last complete frame.
+    """
+    eom = Message.EOM_token.encode()
+    frames = []
+    pos = start
+    end = len(buffer) if end is None else end
+
+    with memoryview(buffer) as view:
+        while pos < end:
+            if buffer[pos] == FRAME_MAGIC:
+                # Binary frame, wait until the header and body have been received
+                if end - pos < BINARY_HEADER.size:
+                    break
+                frame_end = pos + BINARY_HEADER.size + BINARY_HEADER.unpack_from(buffer, pos)[4]
+                if frame_end > end:
+                    break
+                if not buffer[pos + 2] & FLAG_COMPRESSED:
+                    frames.append(bytes(view[pos:frame_end]))
+                elif decompress:
+                    frames += _decompress_frames(view[pos + BINARY_HEADER.size:frame_end])
+                else:
+                    logging.error("Skipping nested compressed frame.")
+                pos = frame_end
+            else:
+                # Text frame, wait until the EOM token has been received
+                eom_index = buffer.find(eom, pos, end)
+                if eom_index == -1:
+                    break
+                try:
+                    frames.append(str(view[pos:eom_index], "utf-8"))
+                except UnicodeDecodeError as e:
+                    logging.error("Could not decode text frame: %s", e)
+                pos = eom_index + len(eom)
+
+    return frames, pos
+
+
+def _deserialize_frames(frames, deserialize_fn):
+    """Apply the deserialization function to each frame, ignoring frames that cannot be deserialized."""
+    out = []
+    for frame in frames:
+        try:
+            decoded = deserialize_fn(frame)
+        except ValueError as e:
+            logging.error("Could not decode message %s: %s", frame, e)
+        else:
+            out.append(decoded)
     
+    return out
+
 
 def _decode_buffer(deserialize_fn):
     """
@@ -364,27 +992,15 @@ def _decode_buffer(deserialize_fn):
             messages.
     """
     def inner(buffer):
-        decoded_str = buffer.decode()
-        msgs = decoded_str.split(Message.EOM_token)
+        msgs, consumed = split_frames(buffer)
 
-        # If we have received a sequence of valid messages, the last token
-        # should be EOM_token, so the last item returned by `split()` should
-        # be "". Otherwise, ignore the incomplete message.
-        if msgs[-1] != "":
+        # If we have received a sequence of valid messages, the whole buffer
+        # should be consumed. Otherwise, ignore the incomplete message.
+        if consumed != len(buffer):
             logging.warning("The buffer did not end with a complete message. Ignoring last message.")
-        msgs = msgs[:-1]
 
         # Loop through messages and try to decode, ignoring if decoding fails
-        out = []
-        for msg in msgs:
-            try:
-                decoded = deserialize_fn(msg)
-            except ValueError as e:
-                logging.error(f"Could not decode message {msg}: {e}")
-            else:
-                out.append(decoded)
-        
-        return out
+        return _deserialize_frames(msgs, deserialize_fn)
 
     return inner
 
@@ -397,4 +1013,104 @@ decode_client_buffer = _decode_buffer(deserialize_client_message)
 decode_server_buffer = _decode_buffer(deserialize_server_message)
 
 
+class StreamDecoder:
+    """
+    Stateful decoder for the stream of bytes received from one socket. Bytes are received
+    into a reusable buffer, and complete messages are decoded as they arrive. A trailing
+    partial message is kept in the buffer until the rest of it is received, so messages
+    that are split across `recv()` calls are not lost.
+
+    Only the unconsumed bytes of a partial message are moved to the start of the buffer
+    when more room is needed. Since every frame is smaller than MAX_BUFFER_SIZE, the
+    buffer never needs to grow.
+    """
+    def __init__(self, deserialize_fn, size=RECV_BUFFER_SIZE):
+        """
+        Initialize StreamDecoder.
+
+        Args:
+            deserialize_fn (Union[str, bytes] -> Message): Converts a frame into a Message instance, e.g.
+                `deserialize_client_message` on the server side.
+            size (int): The size of the receive buffer, must be larger than MAX_BUFFER_SIZE.
+        """
+        if size <= MAX_BUFFER_SIZE:
+            raise ValueError("The receive buffer must be larger than MAX_BUFFER_SIZE.")
+
+        self._deserialize_fn = deserialize_fn
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # Start of the bytes that have not been decoded
+        self._end = 0 # End of the received bytes
+
+    @property
+    def pending(self):
+        """The number of bytes received that are not part of a complete message yet."""
+        return self._end - self._start
+
+    def take_pending(self):
+        """Remove and return the received bytes that are not part of a complete message yet."""
+        pending = bytes(self._view[self._start:self._end])
+        self._start = self._end = 0
+        return pending
+
+    def _make_room(self):
+        """Make room at the end of the buffer for receiving more bytes."""
+        # If every byte has been decoded, start from the beginning of the buffer
+        if self._start == self._end:
+            self._start = self._end = 0
+        # Otherwise, move the partial message to the start if the remaining space is small
+        elif len(self._buffer) - self._end < len(self._buffer) // 2:
+            # If the buffer is filled without a complete message, the peer is
+            # not following the protocol. Drop the bytes.
+            if self.pending == len(self._buffer):
+                logging.error("Received more bytes than the maximum message length. Ignoring buffer.")
+                self._start = self._end = 0
+            elif self._start > 0:
+                pending = self.pending
+                self._view[:pending] = self._view[self._start:self._end]
+                self._start, self._end = 0, pending
+
+    def _decode(self):
+        """Decode the complete messages in the buffer."""
+        frames, self._start = split_frames(self._buffer, self._start, self._end)
+        return _deserialize_frames(frames, self._deserialize_fn)
+
+    def feed(self, data):
+        """
+        Add received bytes to the buffer and return the complete messages.
+
+        Args:
+            data (bytes): The received bytes.
+
+        Returns:
+            List[Message]: The messages completed by `data`.
+        """
+        out = []
+        with memoryview(data) as data:
+            while data:
+                self._make_room()
+                num_bytes = min(len(data), len(self._buffer) - self._end)
+                self._view[self._end:self._end + num_bytes] = data[:num_bytes]
+                self._end += num_bytes
+                data = data[num_bytes:]
+                out += self._decode()
+        return out
+
+    def recv(self, sock):
+        """
+        Receive bytes from the socket directly into the buffer and return the
+        complete messages.
+
+        Args:
+            sock (Socket): The socket to receive from.
 
+        Returns:
+            Union[List[Message], None]: The messages completed by the received bytes,
+                or None if the peer has disconnected.
+        """
+        self._make_room()
+        num_bytes = sock.recv_into(self._view[self._end:])
+        if not num_bytes:
+            return None
+        self._end += num_bytes
+        return self._decode()
@@ -0,0 +1,309 @@
+"""
+Defines the store for messages queued for inactive users. Each user's newest messages
+are kept in memory as encoded binary frames, and older messages are spilled to
+append-only segment files on disk, which are read back through `mmap`.
+
+A user's messages are spilled when more than QUEUE_TAIL_SIZE of them are in memory, and
+the messages of the least recently queued users are spilled when the messages in memory
+of every user exceed QUEUE_MEMORY_BUDGET bytes. For each user, the store only keeps an
+index of the segment, offset and length of each spilled message. A segment file is
+deleted once none of its messages are queued anymore. Segment files only hold spilled
+messages while the store is open, so each store writes them to its own new directory,
+which is removed on `close()`.
+
+Queued messages are returned as StoredMessage instances that hold the encoded frame, so
+they can be sent to clients using the binary wire format without being decoded.
+"""
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+from collections import OrderedDict, deque
+from threading import Lock
+
+from .protocol import *
+from .config import config
+
+
+QUEUE_DIR = config["QUEUE_DIR"]
+QUEUE_MEMORY_BUDGET = config["QUEUE_MEMORY_BUDGET"]
+QUEUE_TAIL_SIZE = config["QUEUE_TAIL_SIZE"]
+QUEUE_SEGMENT_SIZE = config["QUEUE_SEGMENT_SIZE"]
+
+
+class StoredMessage:
+    """
+    A queued BroadcastMessage stored as its binary frame. Encoding it with the binary
+    wire format returns the frame as is, and the message is only decoded when it is
+    encoded with the text format or one of its fields is accessed.
+    """
+    __slots__ = ("frame", "_message")
+
+    def __init__(self, frame):
+        self.frame = frame
+        self._message = None
+
+    @property
+    def message(self):
+        """The decoded BroadcastMessage."""
+        if self._message is None:
+            self._message = deserialize_server_message(self.frame)
+        return self._message
+
+    def __getattr__(self, name):
+        # Fields of the message, e.g. `sender` and `text`
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+    def __reduce__(self):
+        # Only the frame is pickled, e.g. when sent to another worker
+        return (StoredMessage, (self.frame,))
+
+    def encode_(self, wire_format=TEXT_FORMAT):
+        if wire_format == BINARY_FORMAT:
+            return self.frame
+        if wire_format == COMPRESSED_FORMAT:
+            return compress_frame(self.frame)
+        return self.message.encode_(wire_format)
+
+
+class _UserQueue:
+    """The queued messages of one user."""
+    def __init__(self):
+        # Index of the spilled messages, which are older than the messages in memory
+        self.segments = array("I")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.tail = deque() # Frames of the newest messages
+        self.tail_bytes = 0
+
+    def __len__(self):
+        return len(self.segments) + len(self.tail)
+
+
+class QueueStore:
+    """
+    Thread-safe store of the messages queued for each user, see the module docstring.
+    """
+    def __init__(self, directory=QUEUE_DIR, memory_budget=QUEUE_MEMORY_BUDGET,
+                 tail_size=QUEUE_TAIL_SIZE, segment_size=QUEUE_SEGMENT_SIZE):
+        """
+        Initialize QueueStore.
+
+        Args:
+            directory (str, optional): The directory to create the store's own directory of
+                segment files in, which is removed on `close()`. The system's temporary
+                directory if None.
+            memory_budget (int): The maximum bytes of messages kept in memory for all users.
+            tail_size (int): The maximum number of messages kept in memory for each user.
+            segment_size (int): The byte size after which a new segment file is started.
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        # Each store has its own directory, e.g. every worker of the sharded server mode
+        self.directory = tempfile.mkdtemp(prefix="queue-", dir=directory)
+        self.memory_budget = memory_budget
+        self.tail_size = tail_size
+        self.segment_size = segment_size
+        self.memory_bytes = 0 # Bytes of messages in memory for all users
+
+        self._queues = {} # Map of usernames to _UserQueue
+        # Map of the usernames with messages in memory to their _UserQueue, by least recently queued
+        self._in_memory = OrderedDict()
+        self._files = {} # Map of segment IDs to open files
+        self._maps = {} # Map of segment IDs to their latest mmap
+        self._sizes = {} # Map of segment IDs to their byte size
+        self._refs = {} # Map of segment IDs to their number of queued messages
+        self._segment_id = -1 # The segment that is appended to
+        self._lock = Lock()
+        self._new_segment()
+
+    def _path(self, segment_id):
+        return os.path.join(self.directory, f"segment-{segment_id}.log")
+
+    def _new_segment(self):
+        """Start appending to a new segment file. Must be called while holding the lock."""
+        previous_id = self._segment_id
+        self._segment_id += 1
+        self._files[self._segment_id] = open(self._path(self._segment_id), "a+b", buffering=0)
+        self._sizes[self._segment_id] = 0
+        self._refs[self._segment_id] = 0
+        # The previous segment is deleted if its messages were discarded while it was appended to
+        if previous_id in self._refs:
+            self._release(previous_id)
+
+    def _release(self, segment_id):
+        """Delete the segment if it has no queued messages. Must be called while holding the lock."""
+        if self._refs[segment_id] or segment_id == self._segment_id:
+            return
+        mm = self._maps.pop(segment_id, None)
+        if mm is not None:
+            mm.close()
+        self._files.pop(segment_id).close()
+        os.remove(self._path(segment_id))
+        del self._sizes[segment_id], self._refs[segment_id]
+
+    def _spill(self, queue, keep=0):
+        """Write the user's oldest messages in memory to disk, keeping `keep` of them. Must be called while holding the lock."""
+        frames = [queue.tail.popleft() for _ in range(len(queue.tail) - keep)]
+        if not frames:
+            return
+        if self._sizes[self._segment_id] >= self.segment_size:
+            self._new_segment()
+        segment_id = self._segment_id
+        offset = self._sizes[segment_id]
+        self._files[segment_id].write(b"".join(frames))
+
+        for frame in frames:
+            queue.segments.append(segment_id)
+            queue.offsets.append(offset)
+            queue.lengths.append(len(frame))
+            offset += len(frame)
+            queue.tail_bytes -= len(frame)
+            self.memory_bytes -= len(frame)
+        self._refs[segment_id] += len(frames)
+        self._sizes[segment_id] = offset
+
+    def _map(self, segment_id, end):
+        """Return an mmap of the segment that contains the bytes up to `end`. Must be called while holding the lock."""
+        mm = self._maps.get(segment_id)
+        # The segment that is appended to grows, so it is mapped again to read new messages
+        if mm is None or len(mm) < end:
+            if mm is not None:
+                mm.close()
+            mm = self._maps[segment_id] = mmap.mmap(self._files[segment_id].fileno(), 0, access=mmap.ACCESS_READ)
+        return mm
+
+    def append(self, username, msg):
+        """
+        Queue a message for the user.
+
+        Args:
+            username (str): The username of the recipient.
+            msg (Union[BroadcastMessage, StoredMessage]): The message to queue.
+
+        Returns:
+            None
+        """
+        frame = msg.encode_(BINARY_FORMAT)
+        with self._lock:
+            self._append(username, [frame])
+
+    def extend(self, username, msgs):
+        """Queue several messages for the user at once, e.g. when restoring persisted messages."""
+        frames = [msg.encode_(BINARY_FORMAT) for msg in msgs]
+        if frames:
+            with self._lock:
+                self._append(username, frames)
+
+    def _append(self, username, frames):
+        """Queue frames for the user. Must be called while holding the lock."""
+        queue = self._queues.get(username)
+        if queue is None:
+            queue = self._queues[username] = _UserQueue()
+        queue.tail.extend(frames)
+        num_bytes = sum(map(len, frames))
+        queue.tail_bytes += num_bytes
+        self.memory_bytes += num_bytes
+        self._in_memory[username] = queue
+        self._in_memory.move_to_end(username)
+
+        if len(queue.tail) > self.tail_size:
+            self._spill(queue, keep=self.tail_size)
+        # Spill the messages of the least recently queued users until under budget
+        while self.memory_bytes > self.memory_budget:
+            _, oldest = self._in_memory.popitem(last=False)
+            self._spill(oldest)
+
+    def usernames(self):
+        """Return the usernames with queued messages."""
+        with self._lock:
+            return list(self._queues)
+
+    def total_count(self):
+        """Return the number of messages queued for every user."""
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def count(self, username):
+        """Return the number of messages queued for the user."""
+        with self._lock:
+            queue = self._queues.get(username)
+            return len(queue) if queue else 0
+
+    def get(self, username, start=0, stop=None):
+        """
+        Return the user's queued messages, from oldest to newest. Spilled messages are read
+        through an mmap of their segment.
+
+        Args:
+            username (str): The username.
+            start (int): The index of the first message to return.
+            stop (int, optional): The index after the last message to return.
+
+        Returns:
+            List[StoredMessage]: The queued messages.
+        """
+        with self._lock:
+            queue = self._queues.get(username)
+            if queue is None:
+                return []
+            stop = len(queue) if stop is None else min(stop, len(queue))
+            num_spilled = len(queue.segments)
+
+            frames = []
+            for i in range(start, min(stop, num_spilled)):
+                offset = queue.offsets[i]
+                end = offset + queue.lengths[i]
+                frames.append(self._map(queue.segments[i], end)[offset:end])
+            tail_start, tail_stop = max(start - num_spilled, 0), max(stop - num_spilled, 0)
+            frames += [queue.tail[i] for i in range(tail_start, tail_stop)]
+        return [StoredMessage(frame) for frame in frames]
+
+    def _discard_spilled(self, queue, count):
+        """Remove the user's `count` oldest spilled messages. Must be called while holding the lock."""
+        segments = queue.segments[:count]
+        del queue.segments[:count], queue.offsets[:count], queue.lengths[:count]
+        for segment_id in set(segments):
+            self._refs[segment_id] -= segments.count(segment_id)
+            self._release(segment_id)
+
+    def discard(self, username, count):
+        """Remove the user's `count` oldest messages, e.g. once the user acknowledged them."""
+        with self._lock:
+            queue = self._queues.get(username)
+            if queue is None:
+                return
+            num_spilled = min(count, len(queue.segments))
+            self._discard_spilled(queue, num_spilled)
+            for _ in range(min(count - num_spilled, len(queue.tail))):
+                frame = queue.tail.popleft()
+                queue.tail_bytes -= len(frame)
+                self.memory_bytes -= len(frame)
+            if not queue.tail:
+                self._in_memory.pop(username, None)
+            if not len(queue):
+                del self._queues[username]
+
+    def delete(self, username):
+        """Remove every message queued for the user."""
+        with self._lock:
+            queue = self._queues.pop(username, None)
+            if queue is None:
+                return
+            self._in_memory.pop(username, None)
+            self.memory_bytes -= queue.tail_bytes
+            self._discard_spilled(queue, len(queue.segments))
+
+    def close(self):
+        """Close the segment files, and remove the store's directory."""
+        with self._lock:
+            for mm in self._maps.values():
+                mm.close()
+            for f in self._files.values():
+                f.close()
+            self._maps.clear()
+            self._files.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
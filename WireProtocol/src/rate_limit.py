@@ -0,0 +1,91 @@
+"""
+Defines the token-bucket rate limiter the server applies to client messages before they
+reach the services. Each connection has a bucket for each message type with a limit, which
+holds up to `burst` tokens and refills at `rate` tokens per second. Handling a message
+takes its cost in tokens from the bucket, and a message is rejected if there aren't enough.
+
+The cost of a message is 1 by default, so the limit is in messages per second. A service
+can register a cost function instead, e.g. chats cost one token for each recipient, so a
+broadcast to every active user uses up much more of the bucket than a direct message. A
+cost above the bucket's burst is reduced to the burst, so any message can be sent once the
+bucket is full.
+"""
+import time
+
+
+class TokenBucket:
+    """A bucket of tokens that refills at a constant rate."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        """
+        Initialize TokenBucket, which starts full.
+
+        Args:
+            rate (float): The tokens added per second.
+            burst (float): The maximum number of tokens.
+            now (float): The current time in seconds.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, cost, now):
+        """Take `cost` tokens and return True, or return False if the bucket has fewer tokens."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    """
+    Token buckets for each connection and message type, see the module docstring.
+
+    The messages of one connection are handled one at a time in every server mode, so a
+    connection's buckets are only used by one thread at a time and don't need a lock.
+    """
+    def __init__(self, limits, clock=time.monotonic):
+        """
+        Initialize RateLimiter.
+
+        Args:
+            limits (Dict[str, Tuple[float, float]]): Map of message encoding headers to the rate
+                and burst of their buckets. Message types without a limit are not limited.
+            clock (Callable[[], float], optional): Returns the current time in seconds.
+        """
+        self.limits = limits
+        self.clock = clock
+        self._buckets = {} # Map of connections to their buckets by encoding header
+
+    def allow(self, conn, header, cost=1):
+        """
+        Take the cost of a message from the connection's bucket for the message type.
+
+        Args:
+            conn (Socket): The connection that sent the message.
+            header (str): The encoding header of the message.
+            cost (float): The number of tokens the message costs.
+
+        Returns:
+            bool: True if the message can be handled, False if it is over the limit.
+        """
+        limit = self.limits.get(header)
+        if limit is None:
+            return True
+        now = self.clock()
+        buckets = self._buckets.get(conn)
+        if buckets is None:
+            buckets = self._buckets[conn] = {}
+        bucket = buckets.get(header)
+        if bucket is None:
+            bucket = buckets[header] = TokenBucket(*limit, now)
+        return bucket.take(cost, now)
+
+    def remove(self, conn):
+        """Remove the buckets of a connection, e.g. when it disconnects."""
+        self._buckets.pop(conn, None)
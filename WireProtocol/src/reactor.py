@@ -0,0 +1,303 @@
+"""
+Reactor mode for the chat server. A single thread owns every client socket, does
+non-blocking reads and writes with `selectors`, and decodes the received messages.
+The messages are handled by the existing synchronous services on a bounded pool of
+worker threads, so the number of threads does not grow with the number of connections.
+
+Messages from the same client are handled in the order they were received, one at a
+time, while messages from different clients are handled concurrently by the pool.
+
+Run with `SERVER_MODE` set to "reactor" in `config.py`.
+"""
+import logging
+import selectors
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from threading import Lock
+
+from .protocol import *
+from .config import config
+from .server import handle_messages, disconnect_client, disconnect_clients, set_tcp_nodelay
+from .fanout import DROP_POLICY, DISCONNECT_POLICY, IOV_MAX
+from .log import log_sampled
+from .stats import stats
+
+
+# Server config
+MAX_NUM_CONNECTIONS = config["MAX_NUM_CONNECTIONS"]
+OUTBOUND_HIGH_WATER_MARK = config["OUTBOUND_HIGH_WATER_MARK"]
+SLOW_CONSUMER_POLICY = config["SLOW_CONSUMER_POLICY"]
+WORKER_POOL_SIZE = config["WORKER_POOL_SIZE"]
+
+# The reactor only buffers a couple of messages for each connection at a time,
+# so connections use a smaller receive buffer than the threaded server.
+REACTOR_RECV_BUFFER_SIZE = 2 * MAX_BUFFER_SIZE
+
+# Inbox item that tells the worker to disconnect the client
+_DISCONNECT = object()
+
+
+class ReactorConnection:
+    """
+    Wraps a non-blocking client socket owned by the reactor, with the socket methods used
+    by the services. Sends from worker threads are written immediately if the socket can
+    take them, and otherwise buffered and flushed by the reactor when the socket is writable.
+
+    If the buffered bytes exceed OUTBOUND_HIGH_WATER_MARK, new messages are dropped or the
+    client is disconnected depending on the slow consumer policy. With the "spill" policy,
+    the messages keep being buffered in memory.
+    """
+    def __init__(self, sock, reactor):
+        self.sock = sock
+        self.reactor = reactor
+        self.decoder = StreamDecoder(deserialize_client_message, size=REACTOR_RECV_BUFFER_SIZE)
+        self.closed = False
+
+        # Received messages waiting for a worker, and whether a worker is scheduled for them
+        self.inbox = deque()
+        self.scheduled = False
+
+        self._out = deque() # Buffered bytes waiting for the socket to be writable
+        self._out_bytes = 0
+        self._lock = Lock()
+
+    def _is_full(self):
+        """Returns True if new messages should not be buffered. Must be called while holding the lock."""
+        if self._out_bytes <= OUTBOUND_HIGH_WATER_MARK:
+            return False
+
+        if SLOW_CONSUMER_POLICY == DROP_POLICY:
+            log_sampled("slow_consumer", logging.WARNING, "Outbound buffer is full, dropped message for %s.", self.sock)
+            return True
+        elif SLOW_CONSUMER_POLICY == DISCONNECT_POLICY:
+            logging.warning("Outbound buffer is full, disconnecting %s.", self.sock)
+            self.shutdown(socket.SHUT_RDWR)
+            return True
+        return False
+
+    def _write(self):
+        """
+        Write as much of the buffered bytes as the socket takes without blocking.
+        Must be called while holding the lock.
+
+        Returns:
+            bool: True if every buffered byte was written.
+        """
+        while self._out:
+            try:
+                sent = self.sock.sendmsg(list(islice(self._out, IOV_MAX)))
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError as e:
+                logging.error("[!] Error sending to %s: %s", self.sock, e)
+                self._out.clear()
+                self._out_bytes = 0
+                return True
+            self._out_bytes -= sent
+            # Remove the buffers that were completely sent, and the sent part of a partially sent buffer
+            while self._out and sent >= len(self._out[0]):
+                sent -= len(self._out.popleft())
+            if sent:
+                self._out[0] = memoryview(self._out[0])[sent:]
+        return True
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def sendmsg(self, buffers):
+        with self._lock:
+            if self.closed or self._is_full():
+                return 0
+            # If bytes are already waiting, the reactor flushes these after them
+            waiting = bool(self._out)
+            self._out.extend(buffers)
+            self._out_bytes += sum(len(buffer) for buffer in buffers)
+            if not waiting and not self._write():
+                self.reactor.request_write(self)
+        # Report every byte as sent, since the rest is flushed by the reactor
+        return sum(len(buffer) for buffer in buffers)
+
+    def flush(self):
+        """Write buffered bytes, returns True if every buffered byte was written."""
+        with self._lock:
+            return self._write()
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def shutdown(self, how):
+        try:
+            self.sock.shutdown(how)
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._out.clear()
+        self.sock.close()
+
+
+class Reactor:
+    """
+    Event loop that accepts connections and reads from every client socket on one
+    thread, and dispatches the decoded messages to a pool of worker threads.
+    """
+    def __init__(self, app, pool_size=WORKER_POOL_SIZE):
+        """
+        Initialize Reactor.
+
+        Args:
+            app (AppState): The app state shared by all connections.
+            pool_size (int): The number of worker threads running services.
+        """
+        self.app = app
+        self.selector = selectors.DefaultSelector()
+        self.pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="service")
+        self._stopped = False
+
+        # Worker threads wake up the reactor through this socket pair when a
+        # connection has bytes that could not be written immediately
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._wake_send.setblocking(False)
+        self._write_requests = deque()
+        self.selector.register(self._wake_recv, selectors.EVENT_READ, self._handle_wake)
+
+    def listen(self, host, port, backlog=MAX_NUM_CONNECTIONS):
+        """
+        Create a listening socket handled by the reactor.
+
+        Returns:
+            Socket: The listening socket.
+        """
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(backlog)
+        s.setblocking(False)
+        self.selector.register(s, selectors.EVENT_READ, self._handle_accept)
+        return s
+
+    def request_write(self, conn):
+        """Ask the reactor to flush the connection when its socket is writable. Called from worker threads."""
+        self._write_requests.append(conn)
+        self._wake()
+
+    def stop(self):
+        """Stop the reactor loop. Can be called from any thread."""
+        self._stopped = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_send.send(b"\0")
+        except BlockingIOError:
+            # The reactor already has pending wake ups
+            pass
+
+    def _handle_wake(self, key, events):
+        """Register the connections that have buffered bytes for write events."""
+        try:
+            while self._wake_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._write_requests:
+            conn = self._write_requests.popleft()
+            try:
+                self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+            except (KeyError, ValueError):
+                # The connection was disconnected
+                pass
+
+    def _handle_accept(self, key, events):
+        """Accept the waiting connections."""
+        while True:
+            try:
+                client_socket, client_address = key.fileobj.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            logging.info("%s has connected.", client_address)
+            client_socket.setblocking(False)
+            set_tcp_nodelay(client_socket)
+            stats.increment("connections")
+            conn = ReactorConnection(client_socket, self)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def _handle_connection(self, conn, events):
+        """Read from a client socket, or flush it when it is writable."""
+        if events & selectors.EVENT_WRITE:
+            if conn.flush():
+                self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+        if events & selectors.EVENT_READ:
+            try:
+                msgs = conn.decoder.recv(conn.sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error("[!] Error: %s", e)
+                msgs = None
+
+            # If no bytes were received, the client has disconnected. Stop reading from it,
+            # and disconnect it after the messages it already sent are handled.
+            if msgs is None:
+                logging.debug("Received 0 bytes from socket.")
+                self.selector.unregister(conn.sock)
+                self._dispatch(conn, _DISCONNECT)
+            elif msgs:
+                self._dispatch(conn, msgs)
+
+    def _dispatch(self, conn, item):
+        """Add messages to the connection's inbox, and schedule a worker if it has none."""
+        with conn._lock:
+            conn.inbox.append(item)
+            if conn.scheduled:
+                return
+            conn.scheduled = True
+        self.pool.submit(self._work, conn)
+
+    def _work(self, conn):
+        """Worker that handles the messages in a connection's inbox in order."""
+        while True:
+            with conn._lock:
+                if not conn.inbox:
+                    conn.scheduled = False
+                    return
+                item = conn.inbox.popleft()
+
+            if item is _DISCONNECT:
+                disconnect_client(conn, self.app)
+                return
+            try:
+                handle_messages(item, self.app, conn)
+            except Exception as e:
+                logging.error("[!] Error handling messages: %s", e)
+
+    def serve_forever(self):
+        """Run the reactor loop until `stop()` is called."""
+        while not self._stopped:
+            for key, events in self.selector.select():
+                if isinstance(key.data, ReactorConnection):
+                    self._handle_connection(key.data, events)
+                else:
+                    key.data(key, events)
+
+        # Disconnect every remaining client at once
+        conns = [key.data for key in self.selector.get_map().values() if isinstance(key.data, ReactorConnection)]
+        self.pool.shutdown(wait=False)
+        self.selector.close()
+        disconnect_clients(conns, self.app)
+
+
+def run_reactor(host, port, app, backlog=MAX_NUM_CONNECTIONS):
+    """Run the reactor server until the process is stopped."""
+    reactor = Reactor(app)
+    reactor.listen(host, port, backlog)
+    print(f"[*] Listening as {host}:{port}")
+    reactor.serve_forever()
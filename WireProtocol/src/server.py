@@ -1,34 +1,82 @@
 """
 Implementation of server for chat application.
 """
+import ipaddress
 import socket
+import time
 from threading import Thread
 import logging
 
 from .protocol import *
 from .config import config
-from .app import AppState, InvalidUserError
-
-
-# Logging config
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-9s) %(message)s',)
+from .app import AppState, SafeAppState, InvalidUserError
+from .queue_store import QueueStore
+from .persistence import Journal
+from .fanout import FanoutEngine
+from .rate_limit import RateLimiter
+from .stats import stats
+from .log import configure_logging, log_sampled
 
 
 # Server config
 SERVER_HOST = config["SERVER_HOST"]
 SERVER_PORT = config["SERVER_PORT"]
-MAX_BUFFER_SIZE = config["MAX_BUFFER_SIZE"]
 MAX_NUM_CONNECTIONS = config["MAX_NUM_CONNECTIONS"]
+QUEUE_WINDOW_SIZE = config["QUEUE_WINDOW_SIZE"]
+PERSIST_DIR = config["PERSIST_DIR"]
+COALESCE_WRITES = config["COALESCE_WRITES"]
+TCP_NODELAY = config["TCP_NODELAY"]
+ADMIN_USERS = set(config["ADMIN_USERS"])
+
+
+# Fan-out engine for sending to clients. Sockets registered with the engine are sent to
+# by their own writer thread, other sockets are sent to directly.
+fanout = FanoutEngine(high_water_mark=config["OUTBOUND_HIGH_WATER_MARK"], policy=config["SLOW_CONSUMER_POLICY"],
+                      max_batch_size=config["COALESCE_MAX_BYTES"])
+
+# Token buckets of each connection, checked before a message reaches its service
+rate_limiter = RateLimiter(config["RATE_LIMITS"])
+
 
+# Map of client message encoding headers to their service and response type, see `service`
+SERVICES = {}
+# Map of client message encoding headers to the function that returns the rate limit cost of a message
+COSTS = {}
 
-def broadcast(msg, recvs):
+
+def service(msg_cls, response_cls, cost=None):
     """
-    Broadcast a message to a list of clients.
+    Decorator that registers a function as the service for a client message type, so
+    `handle_message` routes each message with one dict lookup. The service is called with
+    the message, the app state and the client socket, and returns a `response_cls` instance.
+
+    Args:
+        msg_cls (type): The client message class.
+        response_cls (type): The response class that answers the message.
+        cost (Callable, optional): Called with the message and the app state, returns the number
+            of rate limit tokens the message costs. Each message costs 1 token if it is None.
+
+    Returns:
+        Callable: The decorator.
+    """
+    def register(func):
+        SERVICES[msg_cls.enc_header] = (func, response_cls)
+        if cost is not None:
+            COSTS[msg_cls.enc_header] = cost
+        return func
+    return register
+
+
+def broadcast(msg, recvs, app=None):
+    """
+    Broadcast a message to a list of clients. The message is encoded once
+    for each wire format used by the receiving clients, and the encoded bytes
+    are queued for each client by the fan-out engine.
 
     Args:
         msg (BroadcastMessage): The message to send to clients.
         recvs (List[Socket]): The sockets to send the message to.
+        app (AppState, optional): The app state, used to look up each client's wire format.
 
     Returns:
         None
@@ -37,8 +85,23 @@ def broadcast(msg, recvs):
     if not isinstance(msg, BroadcastMessage):
         raise TypeError("Server can only broadcast BroadcastMessage objects.")
 
+    # Map wire format to encoded message
+    encoded = {}
+    num_bytes = 0
     for conn in recvs:
-        conn.send(msg.encode_())
+        wire_format = get_wire_format(conn, app)
+        if wire_format not in encoded:
+            encoded[wire_format] = msg.encode_(wire_format)
+        data = encoded[wire_format]
+        fanout.send(conn, data)
+        num_bytes += len(data)
+    stats.increment("outbound_bytes", num_bytes)
+
+
+def get_wire_format(conn, app=None):
+    """Return the wire format negotiated by the client, defaulting to TEXT_FORMAT."""
+    wire_format = app.get_wire_format(conn) if app else None
+    return wire_format if wire_format else TEXT_FORMAT
 
 
 def register_service(msg, app):
@@ -47,7 +110,10 @@ def register_service(msg, app):
     error response if the username is currently being used or the 
     username contains non-alphanumeric characters. Otherwise return a
     success response where `is_new_user` field is false if the username
-    has previously been registered.
+    has previously been registered. If the client requested a wire format,
+    the response contains the accepted format, which falls back to TEXT_FORMAT
+    if the requested format is not supported. A requested compression is only
+    accepted with the binary wire format.
 
     Args:
         msg (ChatMessage): The message received from client.
@@ -59,22 +125,74 @@ def register_service(msg, app):
     try:
         is_new_user = app.register_user(msg.username)
     except InvalidUserError as e:
-        logging.debug(f"Cannot register username '{msg.username}': {e}")
+        logging.debug("Cannot register username '%s': %s", msg.username, e)
         res = RegisterResponse(success=False, error=str(e))
     except ValueError as e:
-        logging.debug(f"Cannot register username '{msg.username}': {e}")
+        logging.debug("Cannot register username '%s': %s", msg.username, e)
         res = RegisterResponse(success=False, error=str(e))
     else:
-        res = RegisterResponse(success=True, is_new_user=is_new_user)
+        wire_format = None
+        if msg.wire_format:
+            wire_format = msg.wire_format if msg.wire_format in WIRE_FORMATS else TEXT_FORMAT
+        compression = None
+        if wire_format == BINARY_FORMAT and msg.compression in COMPRESSIONS:
+            compression = msg.compression
+        res = RegisterResponse(success=True, is_new_user=is_new_user, wire_format=wire_format,
+                               compression=compression)
     finally:
         return res
 
 
-def chat_service(msg, app):
+@service(RegisterMessage, RegisterResponse)
+def connect_service(msg, app, socket):
+    """
+    Service for registering a client's username with `register_service`. If registering
+    succeeds, the socket is added as the user's connection, with the negotiated wire format,
+    or COMPRESSED_FORMAT if compression was negotiated.
+
+    Args:
+        msg (RegisterMessage): The message received from client.
+        app (AppState): The current app state.
+        socket (Socket): The client socket that sent the message.
+
+    Returns:
+        RegisterResponse: The response to client.
+    """
+    res = register_service(msg, app)
+    # If the response is a successful register response,
+    # add the current socket as the user's socket
+    if res.success:
+        try:
+            app.add_connection(msg.username, socket)
+        except (InvalidUserError, ValueError) as e:
+            # Another client connected with the username after it was registered
+            logging.debug("Cannot connect username '%s': %s", msg.username, e)
+            return RegisterResponse(success=False, error=str(e))
+        # Use the negotiated wire format for messages to this client
+        if res.compression:
+            app.set_wire_format(socket, COMPRESSED_FORMAT)
+        elif res.wire_format:
+            app.set_wire_format(socket, res.wire_format)
+    return res
+
+
+def chat_cost(msg, app):
+    """Return the rate limit cost of a ChatMessage, which is the number of clients it is sent to."""
+    if not msg.recipient:
+        return app.count_active_users()
+    if msg.recipient.startswith(ROOM_PREFIX):
+        return app.count_room_connections(msg.recipient[len(ROOM_PREFIX):])
+    # The sender and the recipient
+    return 2
+
+
+@service(ChatMessage, ChatResponse, cost=chat_cost)
+def chat_service(msg, app, socket=None):
     """
     Service for handling a ChatMessage from client. Returns an error response if the recipient
     does not exist. Otherwise, broadcasts to active recipients, queues the 
-    the message for inactive recipients, and returns a success response.
+    the message for inactive recipients, and returns a success response. A message to a
+    room is only sent to the room's active members, and the sender must be a member.
 
     Args:
         msg (ChatMessage): The message received from client.
@@ -83,6 +201,8 @@ def chat_service(msg, app):
     Returns:
         ChatResponse: The response to client.
     """
+    if msg.recipient and msg.recipient.startswith(ROOM_PREFIX):
+        return room_chat_service(msg, app)
     # If the recipient does not exist, return an error response
     if msg.recipient and not app.is_valid_user(msg.recipient):
         res = ChatResponse(success=False, error="User does not exist.")
@@ -107,19 +227,41 @@ def chat_service(msg, app):
             app.queue_message(msg.recipient, broadcast_msg)
     
     # Broadcast the message to recipients
-    broadcast(broadcast_msg, recv_conns)
+    broadcast(broadcast_msg, recv_conns, app=app)
 
     # Return success response
     return ChatResponse(success=True)
 
 
-def list_service(msg, app):
+def room_chat_service(msg, app):
+    """
+    Send a ChatMessage to the active members of a room, which are looked up in the room's
+    precomputed connections, so the cost depends on the size of the room rather than on the
+    number of users.
+
+    Args:
+        msg (ChatMessage): The message received from client, whose recipient is a prefixed room name.
+        app (AppState): The current app state.
+
+    Returns:
+        ChatResponse: The response to client.
+    """
+    room = msg.recipient[len(ROOM_PREFIX):]
+    if not app.is_room_member(msg.sender, room):
+        return ChatResponse(success=False, error=f"Not a member of room '{room}'.")
+    broadcast(msg.to_broadcast(), app.get_room_connections(room), app=app)
+    return ChatResponse(success=True)
+
+
+@service(ListMessage, ListResponse)
+def list_service(msg, app, socket=None):
     """
     Service for handling ListMessage. Will match the wildcard as a regex
     expression, or return all users if wildcard is None. If there are more
     users that match the wildcard than the limit, only send the first `max_num_users` 
     usernames and set the `limit_exceeded` flag to True so the client knows that the 
-    list is incomplete.
+    list is incomplete. Users are listed in sorted order, starting after the message's
+    cursor if it has one.
 
     Args:
         msg (ListMessage): The message from client.
@@ -128,7 +270,8 @@ def list_service(msg, app):
     Returns:
         ListResponse: The response to send to client.
     """
-    users = app.list_users(wildcard=msg.wildcard)
+    # Find one more user than the limit, to know if the limit is exceeded
+    users = app.list_users(wildcard=msg.wildcard, limit=ListResponse.max_num_users + 1, after=msg.cursor)
     # Only return up to `max_num_users` users in response
     # Flag lets the client know that there are more users
     if len(users) > ListResponse.max_num_users:
@@ -139,7 +282,8 @@ def list_service(msg, app):
     return res
 
 
-def delete_service(msg, app):
+@service(DeleteMessage, DeleteResponse)
+def delete_service(msg, app, socket=None):
     """
     Service for handling DeleteMessage from client. Will return an error response if
     the username does not exist or the user is active.
@@ -160,45 +304,217 @@ def delete_service(msg, app):
     except ValueError as e2:
         res = DeleteResponse(success=False, error=str(e2))
     else:
-        logging.info(f"User {msg.username} deleted.")
+        logging.info("User %s deleted.", msg.username)
         res = DeleteResponse(success=True)
     finally:
         return res
 
 
-def queue_service(msg, app):
+@service(QueueMessage, QueueResponse)
+def queue_service(msg, app, socket):
     """
-    Service for delivering queued messages to a user. If there are queued messages,
-    send them as BroadcastMessages, making sure that each `cs.send()` call is passed a 
-    byte string smaller than `MAX_BUFFER_SIZE`, and then return a success response.
+    Service for delivering queued messages to a user. Clients can only request and
+    acknowledge the queued messages of the user they registered as, so an error response
+    is returned if the message's username is not the connection's user. If the message acknowledges a
+    sequence number, the queued messages up to it are removed first. If there are queued
+    messages, send a window of at most `QUEUE_WINDOW_SIZE` of the oldest ones as
+    BroadcastMessages, and then return a success response with the sequence number of
+    the last message sent, which the client acknowledges in its next QueueMessage.
     Otherwise, return an error response.
 
+    The messages are encoded into batches of at most `MAX_BUFFER_SIZE` bytes without
+    concatenating them. Each batch is queued for the client separately, so a long queue
+    is not treated as a slow consumer as a whole, and an error response is returned if a
+    batch is dropped. Unqueued sockets get every batch with vectored I/O.
+
     Args:
         msg (QueueMessage): The message from client containing the user to get queued messages for.
         app (AppState): The current app state.
+        socket (Socket): The client socket that sent the message.
     
     Returns:
         QueueResponse: True if there are messages in the queue, False otherwise.
     """
-    queued_msgs = app.get_queued_messages(msg.username)
-
-    # If no messages, return error response
-    if not queued_msgs:
+    if msg.username != app.get_connection_user(socket):
+        return QueueResponse(success=False, error="Can only request your own queued messages.")
+    if msg.ack is not None:
+        app.ack_queued_messages(msg.username, msg.ack)
+    res = send_queue_window(msg.username, app)
+
+    # If no messages, return error response, or confirm the acknowledgement
+    if res is None:
+        if msg.ack is not None:
+            return QueueResponse(success=True)
         return QueueResponse(success=False, error="No messages in queue.")
-    
+    return res
+
+
+@service(JoinMessage, JoinResponse)
+def join_service(msg, app, socket=None):
+    """
+    Service for handling JoinMessage from client. Adds the user to the room, creating it
+    if it doesn't exist. Returns an error response if the room name is invalid.
+
+    Args:
+        msg (JoinMessage): The message from client.
+        app (AppState): The app state.
+
+    Returns:
+        JoinResponse: The response to send to client.
+    """
+    try:
+        app.join_room(msg.username, msg.room)
+    except (InvalidUserError, ValueError) as e:
+        logging.debug("Cannot join room '%s': %s", msg.room, e)
+        return JoinResponse(success=False, error=str(e))
+    return JoinResponse(success=True)
+
+
+@service(LeaveMessage, LeaveResponse)
+def leave_service(msg, app, socket=None):
+    """
+    Service for handling LeaveMessage from client. Returns an error response if the user
+    is not a member of the room.
+
+    Args:
+        msg (LeaveMessage): The message from client.
+        app (AppState): The app state.
+
+    Returns:
+        LeaveResponse: The response to send to client.
+    """
+    try:
+        app.leave_room(msg.username, msg.room)
+    except ValueError as e:
+        logging.debug("Cannot leave room '%s': %s", msg.room, e)
+        return LeaveResponse(success=False, error=str(e))
+    return LeaveResponse(success=True)
+
+
+@service(StatsMessage, StatsResponse)
+def stats_service(msg, app, socket):
+    """
+    Service for handling StatsMessage from an admin client, see `is_admin`. Returns an error
+    response for other clients. The response has these metrics:
+
+    - connections: the number of open client connections
+    - outbound_bytes: the bytes sent to clients
+    - the other counters in `stats`, e.g. rate_limited.MSG
+    - active_users: the number of users with a connection
+    - queued_messages: the number of messages queued for every user
+    - rate.<header>: the messages of each type handled per second since the last StatsMessage
+    - latency_us.<header>: the latency histogram of each service, as the comma separated
+      counts of the buckets bounded by `LATENCY_BUCKETS_US` in `stats.py`, without the
+      empty buckets at the end
+
+    The metrics that don't fit in MAX_BUFFER_SIZE are left out, from the last one. In the
+    sharded mode, the metrics are those of the worker that the client is connected to.
+
+    Args:
+        msg (StatsMessage): The message from client.
+        app (AppState): The app state.
+        socket (Socket): The client socket that sent the message.
+
+    Returns:
+        StatsResponse: The response to send to client.
+    """
+    if not is_admin(app, socket):
+        return StatsResponse(success=False, error="Only admins can request stats.")
+
+    metrics = {name: str(value) for name, value in sorted(stats.snapshot().items())}
+    metrics["active_users"] = str(app.count_active_users())
+    metrics["queued_messages"] = str(app.count_queued_messages())
+    for header, rate in sorted(stats.message_rates().items()):
+        metrics[f"rate.{header}"] = f"{rate:.1f}"
+    for header, counts in sorted(stats.latency_histograms().items()):
+        while counts and not counts[-1]:
+            counts.pop()
+        metrics[f"latency_us.{header}"] = ",".join(map(str, counts))
+
+    res = StatsResponse(success=True, stats=metrics)
+    res.request_id = msg.request_id
+    # Leave out the last metrics until the response fits, text frames being the longest
+    while True:
+        try:
+            res.encode_(TEXT_FORMAT)
+            return res
+        except ValueError:
+            metrics.popitem()
+            res.truncated = True
+
+
+def is_admin(app, socket):
+    """
+    Returns True if the client is registered as one of the `ADMIN_USERS`, or connected
+    from a loopback address.
+    """
+    if app.get_connection_user(socket) in ADMIN_USERS:
+        return True
+    try:
+        return ipaddress.ip_address(socket.getpeername()[0]).is_loopback
+    except (OSError, ValueError, TypeError, IndexError):
+        # e.g. a Unix socket, which has no IP address
+        return False
+
+
+def send_queue_window(username, app):
+    """
+    Send a window of the user's oldest queued messages to the user's connection, see
+    `queue_service`.
+
+    Args:
+        username (str): The user to send queued messages to.
+        app (AppState): The current app state.
+
+    Returns:
+        Optional[QueueResponse]: The response for the window, or None if the queue is empty.
+    """
     # Roundabout way of getting client socket
-    cs = app.get_user_connection(msg.username)
+    cs = app.get_user_connection(username)
+    if cs is None:
+        return QueueResponse(success=False, error="User is not connected.")
 
-    # Encode the messages into concantenated byte strings with max length
-    for data in encode_msg_queue(queued_msgs):
-        cs.send(data)
+    first_seq, queued_msgs, remaining = app.get_queued_window(username, QUEUE_WINDOW_SIZE)
+    if not queued_msgs:
+        return None
+
+    # Encode the messages into batches with max length, and send all of the batches
+    batches = encode_msg_batches(queued_msgs, get_wire_format(cs, app))
+    stats.increment("outbound_bytes", sum(len(data) for batch in batches for data in batch))
+    if not fanout.send_batches(cs, batches):
+        return QueueResponse(success=False, error="Queued messages could not be delivered, try again later.")
+
+    return QueueResponse(success=True, last_seq=first_seq + len(queued_msgs) - 1, remaining=remaining)
 
-    return QueueResponse(success=True)
+
+def push_queued_messages(username, app, cs):
+    """
+    Push the queued messages of a returning user right after its successful RegisterResponse,
+    so the client doesn't have to request them. Only the first window is sent, followed by
+    its QueueResponse. The client acknowledges each window to get the next one, as with
+    QueueMessages, so a long queue is delivered in the background and the client's other
+    requests are answered between the windows.
+
+    Args:
+        username (str): The user that registered.
+        app (AppState): The current app state.
+        cs (Socket): The client socket that registered.
+
+    Returns:
+        None
+    """
+    res = send_queue_window(username, app)
+    if res is not None:
+        send_response(res, app, cs)
 
 
 def handle_message(msg, app, socket):
     """
-    Route a Message instance to the appropriate service.
+    Route a Message instance to the service registered for its encoding header. The response
+    has the request ID of the message, so clients that pipeline requests can match it. A
+    message over the connection's rate limit gets an error response without reaching the
+    service, and is counted in `stats`. The number and latency of the messages handled by
+    each service are counted in `stats` as well.
 
     Args:
         msg (str): The string to be deserialized.
@@ -211,28 +527,38 @@ def handle_message(msg, app, socket):
     Raises:
         NotImplementedError: If there is no service for handling the type of the Message instance.
     """
-    logging.debug(f"Handling message from {socket.getsockname()}")
+    log_sampled("message", logging.DEBUG, "Handling %s from %s", msg.enc_header, socket)
 
-    if isinstance(msg, RegisterMessage):
-        res = register_service(msg, app)
-        # If the response is a successful register response,
-        # add the current socket as the user's socket
-        if res.success:
-            app.add_connection(msg.username, socket)
-    elif isinstance(msg, ChatMessage):
-        res = chat_service(msg, app)
-    elif isinstance(msg, ListMessage):
-        res = list_service(msg, app)
-    elif isinstance(msg, DeleteMessage):
-        res = delete_service(msg, app)
-    elif isinstance(msg, QueueMessage):
-        res = queue_service(msg, app)
-    else:
+    try:
+        service_fn, _ = SERVICES[msg.enc_header]
+    except KeyError:
         raise NotImplementedError
-    
+    try:
+        cost_fn = COSTS.get(msg.enc_header)
+        if rate_limiter.allow(socket, msg.enc_header, cost_fn(msg, app) if cost_fn else 1):
+            start = time.perf_counter()
+            res = service_fn(msg, app, socket)
+            stats.record_message(msg.enc_header, time.perf_counter() - start)
+        else:
+            stats.increment(f"rate_limited.{msg.enc_header}")
+            res = error_response(msg, "Rate limit exceeded, please slow down.")
+    except TimeoutError as e:
+        # The app state could not answer in time, e.g. another worker of the sharded server is busy
+        logging.error("[!] Timed out handling message: %s", e)
+        res = error_response(msg, "Server is busy, please try again.")
+    if msg.request_id is not None:
+        res.request_id = msg.request_id
     return res
 
 
+def error_response(msg, error):
+    """Return a failed response of the type that answers the message."""
+    if isinstance(msg, ListMessage):
+        return ListResponse(success=False, users=[], error=error)
+    _, response_cls = SERVICES[msg.enc_header]
+    return response_cls(success=False, error=error)
+
+
 def disconnect_client(socket, app):
     """
     Handle a disconnected client. Remove it from active connections in 
@@ -245,76 +571,212 @@ def disconnect_client(socket, app):
     Returns:
         None
     """
-    logging.info(f"Removing {socket.getsockname()}")
-    # Remove the socket from active connections in app state
-    app.remove_connection(socket)
+    logging.info("Removing %s", socket.getsockname())
+    stats.increment("connections", -1)
+    # Stop sending to the socket and remove it from active connections in app state
+    fanout.unregister(socket)
+    rate_limiter.remove(socket)
+    try:
+        app.remove_connection(socket)
+    except KeyError:
+        # The client disconnected before registering a username
+        pass
     socket.close()
 
 
-def client_thread(cs, app):
+def disconnect_clients(sockets, app):
+    """
+    Handle many disconnected clients at once, e.g. when the server stops. Removes them
+    from active connections in app state with one bulk update, and closes the sockets.
+
+    Args:
+        sockets (List[Socket]): The clients to remove.
+        app (AppState): The app state.
+
+    Returns:
+        None
+    """
+    logging.info("Removing %s clients", len(sockets))
+    stats.increment("connections", -len(sockets))
+    for socket in sockets:
+        fanout.unregister(socket)
+        rate_limiter.remove(socket)
+    app.remove_connections(sockets)
+    for socket in sockets:
+        socket.close()
+
+
+def handle_messages(msgs, app, cs):
+    """
+    Handle each message received from a client and send the responses back to it.
+    This is shared by every server mode.
+
+    If `COALESCE_WRITES` is set, everything sent to the client while handling the messages,
+    e.g. the echo of its chat, the response and queued messages, is collected and written
+    with one send, instead of one small write each.
+
+    Args:
+        msgs (List[Message]): The decoded messages, in the order they were received.
+        app (AppState): The app state.
+        cs (Socket): The client socket that sent the messages.
+
+    Returns:
+        None
+    """
+    if not COALESCE_WRITES:
+        _handle_messages(msgs, app, cs)
+        return
+    with fanout.coalesce(cs):
+        _handle_messages(msgs, app, cs)
+
+
+def _handle_messages(msgs, app, cs):
+    """Handle the messages and send the responses, see `handle_messages`."""
+    for msg in msgs:
+        # Handle message and return response to client
+        res = handle_message(msg, app, cs)
+        # Send the response in byte format
+        send_response(res, app, cs)
+        # A returning user gets its queued messages after the response
+        if isinstance(res, RegisterResponse) and res.success and not res.is_new_user:
+            push_queued_messages(msg.username, app, cs)
+
+
+def send_response(res, app, cs):
+    """Send a response to the client in its wire format."""
+    data = res.encode_(get_wire_format(cs, app))
+    stats.increment("outbound_bytes", len(data))
+    fanout.send(cs, data)
+
+
+def set_tcp_nodelay(sock):
+    """
+    Set TCP_NODELAY on an accepted client socket to the `TCP_NODELAY` config value. With
+    Nagle's algorithm, a small write waits until the previous one is acknowledged, which
+    adds the client's delayed ACK to the latency of a response that follows an echo. Other
+    sockets, e.g. socket pairs, are left as they are.
+    """
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if TCP_NODELAY else 0)
+
+
+def client_thread(cs, app, decoder=None):
     """
     This function keeps listening for a message from `cs` socket.
-    If data is received, decode the buffer into one or more Message
-    instances, pass them to them appropriate service, and send response
+    If data is received, decode the complete messages with a StreamDecoder
+    that keeps any partial message for the next `recv()`, pass them to the appropriate service, and send response
     back to client. If the client has disconnnected, remove them from 
     active connections and app state.
 
     Args:
         cs (Socket): The socket to listen to.
         app (AppState): The app state.
+        decoder (StreamDecoder, optional): The decoder to continue with, if bytes were already received.
 
     Returns:
         None
     """
+    # Decoder that keeps partial messages between `recv()` calls
+    if decoder is None:
+        decoder = StreamDecoder(deserialize_client_message)
+
     while True:
         try:
-            # Listen for a message from `cs` socket
-            buffer = cs.recv(MAX_BUFFER_SIZE)
+            # Listen for messages from `cs` socket
+            msgs = decoder.recv(cs)
         except Exception as e:
-            logging.error(f"[!] Error: {e}")
+            logging.error("[!] Error: %s", e)
             disconnect_client(cs, app)
+            return
         else:
-            # If buffer is 0, the client has disconnected
-            if not buffer:
+            # If no bytes were received, the client has disconnected
+            if msgs is None:
                 logging.debug("Received 0 bytes from socket.")
                 disconnect_client(cs, app)
                 return
-            # Otherwise, decode the buffer and handle each message
+            # Otherwise, handle each complete message
             else:
-                msgs = decode_client_buffer(buffer)
-                for msg in msgs:
-                    # Handle message and return response to client
-                    res = handle_message(msg, app, cs)
-                    # Send the response in byte format
-                    cs.send(res.encode_())
+                handle_messages(msgs, app, cs)
 
 
-if __name__ == "__main__":
+def serve_threaded(host, port, app, backlog=MAX_NUM_CONNECTIONS):
     """
     Sets up the server socket and listens for connections. For each client that connects,
-    create a daemon thread that handles messages from the socket. `app_state` is shared between
-    all threads.
+    create a daemon thread that handles messages from the socket, and register it with the fan-out
+    engine so that a writer thread sends to it. `app` is shared between all threads.
+
+    Args:
+        host (str): The address to bind to.
+        port (int): The port to bind to.
+        app (AppState): The app state.
+        backlog (int): The listen backlog.
+
+    Returns:
+        None
     """
     # Create a TCP socket
     s = socket.socket()
     # Make the port reusable
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     # Bind the socket
-    s.bind((SERVER_HOST, SERVER_PORT))
+    s.bind((host, port))
     # Listen for connections
-    s.listen(MAX_NUM_CONNECTIONS)
-    print(f"[*] Listening as {SERVER_HOST}:{SERVER_PORT}")
-
-    # Initialize app state
-    app_state = AppState() 
+    s.listen(backlog)
+    print(f"[*] Listening as {host}:{port}")
 
     while True:
         # Listen for new connections to accept
         client_socket, client_address = s.accept()
-        logging.info(f"{client_address} has connected.")
+        logging.info("%s has connected.", client_address)
+        stats.increment("connections")
+        set_tcp_nodelay(client_socket)
+        # Create an outbound queue and writer thread for the client
+        fanout.register(client_socket)
         # Create a thread for each client
-        t = Thread(target=client_thread, args=(client_socket, app_state))
+        t = Thread(target=client_thread, args=(client_socket, app))
         # Make the thread a daemon so it ends when the main thread does
         t.daemon = True
         # Start the thread
-        t.start()
\ No newline at end of file
+        t.start()
+
+
+def persist(app, directory=PERSIST_DIR):
+    """
+    Restore the app state from the directory and log its changes there, if the directory
+    is set. Returns the app state.
+    """
+    if directory is not None:
+        Journal(directory).attach(app)
+    return app
+
+
+def main():
+    """
+    Start the server in the mode given by the `SERVER_MODE` config value, where
+    "threaded" uses a thread for each client, "asyncio" uses an asyncio event loop,
+    "reactor" uses a `selectors` event loop with a pool of service worker threads, and
+    "sharded" forks worker processes that each own a partition of the usernames.
+    """
+    configure_logging()
+    server_mode = config["SERVER_MODE"]
+    if server_mode == "threaded":
+        serve_threaded(SERVER_HOST, SERVER_PORT, persist(SafeAppState(queue_store=QueueStore())))
+    elif server_mode == "asyncio":
+        # Every service runs on the event loop thread, so the app state only needs locks
+        # for the snapshots the journal takes from its own thread
+        from .aio_server import run_asyncio
+        app = AppState if PERSIST_DIR is None else SafeAppState
+        run_asyncio(SERVER_HOST, SERVER_PORT, persist(app(queue_store=QueueStore())))
+    elif server_mode == "reactor":
+        from .reactor import run_reactor
+        run_reactor(SERVER_HOST, SERVER_PORT, persist(SafeAppState(queue_store=QueueStore())))
+    elif server_mode == "sharded":
+        # Each worker process creates its own app state
+        from .sharding import run_sharded
+        run_sharded(SERVER_HOST, SERVER_PORT)
+    else:
+        raise ValueError(f"Unknown server mode '{server_mode}'.")
+
+
+if __name__ == "__main__":
+    main()
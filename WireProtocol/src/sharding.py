@@ -0,0 +1,549 @@
+"""
+Sharded mode for the chat server. Forks NUM_WORKERS worker processes that each listen on
+the server port with SO_REUSEPORT, so the kernel spreads new connections between them.
+Usernames are hash-partitioned between the workers, and each worker keeps the users it
+owns in its own AppState.
+
+When a connection registers a username owned by another worker, the connection is handed
+off to the owner by passing its file descriptor over a Unix socket, so every client ends up
+connected to the worker that owns its username. Operations on users owned by other workers,
+e.g. direct messages, broadcasts and listing users, are routed to them over the same Unix
+sockets by a ShardedAppState, so the services work unchanged.
+
+Run with `SERVER_MODE` set to "sharded" in `config.py`.
+"""
+import heapq
+import logging
+import os
+import pickle
+import selectors
+import signal
+import socket
+import sys
+import zlib
+from itertools import count, islice
+from multiprocessing import get_context
+from queue import SimpleQueue
+from threading import Event, Lock, Thread
+
+from .protocol import *
+from .config import config
+from .app import SafeAppState
+from .queue_store import QueueStore
+from .stats import stats
+from .server import (broadcast, client_thread, disconnect_client, fanout, handle_messages, persist, rate_limiter,
+                     set_tcp_nodelay)
+
+
+# Server config
+MAX_NUM_CONNECTIONS = config["MAX_NUM_CONNECTIONS"]
+NUM_WORKERS = config["NUM_WORKERS"]
+PERSIST_DIR = config["PERSIST_DIR"]
+
+# Seconds to wait for another worker to reply to a request
+ROUTER_TIMEOUT = 5
+
+# Maximum byte length of a packet between workers. Larger messages are split into several
+# packets, where the first byte of each packet says if more packets of the message follow.
+MAX_ROUTER_PACKET_SIZE = RECV_BUFFER_SIZE
+_LAST_PACKET, _MORE_PACKETS = b"\0", b"\1"
+
+# AppState methods that other workers can call for users owned by this worker
+ROUTED_METHODS = ("is_valid_user", "is_active_user", "list_users", "register_user", "delete_user",
+                  "queue_message", "get_queued_messages", "get_queued_window", "ack_queued_messages",
+                  "join_room", "leave_room", "is_room_member", "get_room_members")
+
+
+def owner_of(username, num_workers):
+    """Return the index of the worker that owns the username."""
+    return zlib.crc32(username.encode()) % num_workers
+
+
+class Router:
+    """
+    Sends requests and messages to the other workers over SOCK_SEQPACKET Unix sockets, and
+    handles the ones they send to this worker on a background thread.
+
+    Messages are sent by a sender thread for each other worker, so the router thread never
+    blocks sending a response while the other worker is blocked sending to this one.
+    """
+    def __init__(self, worker_id, channels):
+        """
+        Initialize Router.
+
+        Args:
+            worker_id (int): The index of this worker.
+            channels (Dict[int, Socket]): Map of other worker indices to the socket connected to them.
+        """
+        self.worker_id = worker_id
+        self.channels = channels
+        self.app = None # The ShardedAppState, set before starting
+        self._request_ids = count()
+        self._pending = {} # Map of request IDs to [Event, result, error]
+        self._pending_lock = Lock()
+        self._outboxes = {worker_id: SimpleQueue() for worker_id in channels} # Messages waiting to be sent
+
+    def start(self, app):
+        """Start handling messages from the other workers."""
+        self.app = app
+        Thread(target=self._run, daemon=True, name="router").start()
+        for worker_id in self.channels:
+            Thread(target=self._send_loop, args=(worker_id,), daemon=True, name=f"router-send-{worker_id}").start()
+
+    def send(self, worker_id, item, fds=()):
+        """
+        Send a message to another worker without waiting for it to be sent or replied to.
+        The file descriptors are passed to the other worker, and closed in this one after
+        they are sent.
+        """
+        self._outboxes[worker_id].put((pickle.dumps(item), fds))
+
+    def _send_loop(self, worker_id):
+        """Sender thread that sends the queued messages to another worker in packets."""
+        channel, outbox = self.channels[worker_id], self._outboxes[worker_id]
+        size = MAX_ROUTER_PACKET_SIZE - 1
+        while True:
+            data, fds = outbox.get()
+            try:
+                # The file descriptors are sent with the last packet
+                for start in range(0, len(data), size):
+                    is_last = start + size >= len(data)
+                    packet = (_LAST_PACKET if is_last else _MORE_PACKETS) + data[start:start + size]
+                    if is_last and fds:
+                        socket.send_fds(channel, [packet], list(fds))
+                    else:
+                        channel.send(packet)
+            except OSError as e:
+                logging.error("[!] Could not send to worker %s: %s", worker_id, e)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def call(self, worker_id, method, *args):
+        """
+        Call a method of another worker's local AppState and return the result.
+
+        Raises:
+            Exception: The exception raised by the method in the other worker.
+            TimeoutError: If the other worker does not reply in ROUTER_TIMEOUT seconds.
+        """
+        request_id = next(self._request_ids)
+        waiting = [Event(), None, None]
+        with self._pending_lock:
+            self._pending[request_id] = waiting
+        try:
+            self.send(worker_id, ("request", self.worker_id, request_id, method, args))
+            if not waiting[0].wait(ROUTER_TIMEOUT):
+                raise TimeoutError(f"Worker {worker_id} did not reply to '{method}'.")
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+
+        if waiting[2] is not None:
+            raise waiting[2]
+        return waiting[1]
+
+    def _run(self):
+        """Receive and handle messages from every other worker."""
+        selector = selectors.DefaultSelector()
+        for channel in self.channels.values():
+            selector.register(channel, selectors.EVENT_READ, [])
+
+        while True:
+            for key, _ in selector.select():
+                # The packets received so far of the channel's next message
+                packets = key.data
+                try:
+                    packet, fds, _, _ = socket.recv_fds(key.fileobj, MAX_ROUTER_PACKET_SIZE, 1)
+                except OSError as e:
+                    logging.error("[!] Router error: %s", e)
+                    continue
+                if not packet:
+                    # The other worker has exited
+                    selector.unregister(key.fileobj)
+                    continue
+                packets.append(packet[1:])
+                if packet[:1] == _MORE_PACKETS:
+                    continue
+                data = b"".join(packets)
+                packets.clear()
+                try:
+                    self._handle(pickle.loads(data), fds)
+                except Exception as e:
+                    logging.error("[!] Could not handle message from worker: %s", e)
+
+    def _handle(self, item, fds):
+        """Handle one message from another worker."""
+        kind = item[0]
+        if kind == "request":
+            _, worker_id, request_id, method, args = item
+            result, error = None, None
+            try:
+                result = self.app.handle_request(method, args)
+            except Exception as e:
+                error = e
+            self.send(worker_id, ("response", request_id, result, error))
+        elif kind == "response":
+            _, request_id, result, error = item
+            with self._pending_lock:
+                waiting = self._pending.get(request_id, None)
+            if waiting:
+                waiting[1], waiting[2] = result, error
+                waiting[0].set()
+        elif kind == "deliver":
+            _, username, data = item
+            self.app.deliver(username, data)
+        elif kind == "broadcast":
+            _, data = item
+            self.app.deliver_broadcast(data)
+        elif kind == "room":
+            _, room, data = item
+            self.app.deliver_room(room, data)
+        elif kind == "handoff":
+            _, data = item
+            start_client(socket.socket(fileno=fds[0]), self.app, data)
+
+
+class RemoteConnection:
+    """
+    Stands in for the socket of an active user connected to another worker. Bytes sent
+    to it are forwarded to that worker, which sends them to the user.
+    """
+    def __init__(self, router, worker_id, username, wire_format):
+        self.router = router
+        self.worker_id = worker_id
+        self.username = username
+        self.wire_format = wire_format
+
+    def sendall(self, data):
+        self.router.send(self.worker_id, ("deliver", self.username, data))
+
+    def sendmsg(self, buffers):
+        data = b"".join(buffers)
+        self.sendall(data)
+        return len(data)
+
+
+class RemoteBroadcast:
+    """
+    Stands in for the sockets of every active user connected to another worker. Broadcast
+    messages sent to it are forwarded to that worker, which sends them to all of its users.
+    """
+    wire_format = BINARY_FORMAT
+
+    def __init__(self, router, worker_id):
+        self.router = router
+        self.worker_id = worker_id
+
+    def sendall(self, data):
+        self.router.send(self.worker_id, ("broadcast", data))
+
+
+class RemoteRoomBroadcast(RemoteBroadcast):
+    """
+    Stands in for the sockets of a room's active members connected to another worker.
+    Messages sent to it are forwarded to that worker, which sends them to its members.
+    """
+    def __init__(self, router, worker_id, room):
+        super().__init__(router, worker_id)
+        self.room = room
+
+    def sendall(self, data):
+        self.router.send(self.worker_id, ("room", self.room, data))
+
+
+class ShardedAppState:
+    """
+    App state for one worker. Users owned by this worker are kept in a local AppState, and
+    calls for users owned by other workers are routed to them. Has the same interface as
+    AppState, so it can be passed to the services.
+    """
+    def __init__(self, local, router, num_workers):
+        """
+        Initialize ShardedAppState.
+
+        Args:
+            local (AppState): The state of the users owned by this worker.
+            router (Router): The router to the other workers.
+            num_workers (int): The total number of workers.
+        """
+        self.local = local
+        self.router = router
+        self.worker_id = router.worker_id
+        self.num_workers = num_workers
+
+    def owner_of(self, username):
+        """Return the index of the worker that owns the username."""
+        return owner_of(username, self.num_workers)
+
+    def is_local(self, username):
+        """Returns True if the username is owned by this worker."""
+        return self.owner_of(username) == self.worker_id
+
+    def _route(self, username, method, *args):
+        """Call the AppState method of the worker that owns the username."""
+        owner = self.owner_of(username)
+        if owner == self.worker_id:
+            return getattr(self.local, method)(*args)
+        return self.router.call(owner, method, *args)
+
+    def handle_request(self, method, args):
+        """Handle a request routed from another worker."""
+        if method == "user_connection_info":
+            # Return whether the user is active, and its wire format
+            conn = self.local.get_user_connection(*args)
+            return (conn is not None, self.local.get_wire_format(conn) if conn is not None else None)
+        elif method in ROUTED_METHODS:
+            return getattr(self.local, method)(*args)
+        raise ValueError(f"Unknown routed method '{method}'.")
+
+    def deliver(self, username, data):
+        """Send bytes forwarded by another worker to a local user, or queue them if the user is inactive."""
+        conn = self.local.get_user_connection(username)
+        if conn is not None:
+            stats.increment("outbound_bytes", len(data))
+            fanout.send(conn, data)
+        else:
+            for msg in decode_server_buffer(data):
+                self.local.queue_message(username, msg)
+
+    def deliver_broadcast(self, data):
+        """Broadcast messages forwarded by another worker to every local active user."""
+        for msg in decode_server_buffer(data):
+            broadcast(msg, self.local.get_all_connections(), app=self.local)
+
+    def deliver_room(self, room, data):
+        """Send messages to a room forwarded by another worker to the room's local active members."""
+        for msg in decode_server_buffer(data):
+            broadcast(msg, self.local.get_room_connections(room), app=self.local)
+
+    def is_valid_user(self, username):
+        return self._route(username, "is_valid_user", username)
+
+    def get_all_connections(self):
+        """Return the sockets of local active users, and a RemoteBroadcast for every other worker."""
+        remotes = [RemoteBroadcast(self.router, i) for i in range(self.num_workers) if i != self.worker_id]
+        return self.local.get_all_connections() + remotes
+
+    def get_user_connection(self, username):
+        """Return the socket of a local user, a RemoteConnection for an active user of another worker, or None."""
+        owner = self.owner_of(username)
+        if owner == self.worker_id:
+            return self.local.get_user_connection(username)
+
+        is_active, wire_format = self.router.call(owner, "user_connection_info", username)
+        return RemoteConnection(self.router, owner, username, wire_format) if is_active else None
+
+    def list_users(self, wildcard=None, limit=None, after=None):
+        """Return up to `limit` matching usernames of every worker in sorted order."""
+        # Each worker returns its first `limit` matches, and the sorted lists are merged
+        results = [self.local.list_users(wildcard, limit, after)]
+        for i in range(self.num_workers):
+            if i != self.worker_id:
+                results.append(self.router.call(i, "list_users", wildcard, limit, after))
+        return list(islice(heapq.merge(*results), limit))
+
+    def register_user(self, username):
+        return self._route(username, "register_user", username)
+
+    def delete_user(self, username):
+        return self._route(username, "delete_user", username)
+
+    def add_connection(self, username, socket):
+        self.local.add_connection(username, socket)
+
+    def remove_connection(self, socket):
+        self.local.remove_connection(socket)
+
+    def remove_connections(self, sockets):
+        return self.local.remove_connections(sockets)
+
+    def is_active_user(self, username):
+        return self._route(username, "is_active_user", username)
+
+    def queue_message(self, username, msg):
+        return self._route(username, "queue_message", username, msg)
+
+    def get_queued_messages(self, username):
+        return self._route(username, "get_queued_messages", username)
+
+    def get_queued_window(self, username, size):
+        return self._route(username, "get_queued_window", username, size)
+
+    def ack_queued_messages(self, username, seq):
+        return self._route(username, "ack_queued_messages", username, seq)
+
+    def join_room(self, username, room):
+        return self._route(username, "join_room", username, room)
+
+    def leave_room(self, username, room):
+        return self._route(username, "leave_room", username, room)
+
+    def is_room_member(self, username, room):
+        return self._route(username, "is_room_member", username, room)
+
+    def get_room_members(self, room):
+        """Return the members of the room owned by every worker."""
+        members = self.local.get_room_members(room)
+        for i in range(self.num_workers):
+            if i != self.worker_id:
+                members += self.router.call(i, "get_room_members", room)
+        return members
+
+    def count_active_users(self):
+        # Users are spread evenly over the workers, so this estimates the total without routing
+        return self.local.count_active_users() * self.num_workers
+
+    def count_room_connections(self, room):
+        # Estimated like `count_active_users`
+        return self.local.count_room_connections(room) * self.num_workers
+
+    def get_connection_user(self, socket):
+        return self.local.get_connection_user(socket)
+
+    def count_queued_messages(self):
+        # Only the messages queued for the users of this worker, like the other metrics of a StatsMessage
+        return self.local.count_queued_messages()
+
+    def get_room_connections(self, room):
+        """
+        Return the sockets of the room's local active members, and a RemoteRoomBroadcast for
+        every other worker, since room members are owned by any worker.
+        """
+        remotes = [RemoteRoomBroadcast(self.router, i, room) for i in range(self.num_workers) if i != self.worker_id]
+        return self.local.get_room_connections(room) + remotes
+
+    def set_wire_format(self, socket, wire_format):
+        self.local.set_wire_format(socket, wire_format)
+
+    def get_wire_format(self, socket):
+        if isinstance(socket, (RemoteConnection, RemoteBroadcast)):
+            return socket.wire_format
+        return self.local.get_wire_format(socket)
+
+
+def sharded_client_thread(cs, app, data=b""):
+    """
+    Client thread for a worker. Handles messages like `client_thread`, except that a
+    connection that has not registered yet is handed off to the owner of the username in
+    its RegisterMessage if that is another worker.
+
+    Args:
+        cs (Socket): The socket to listen to.
+        app (ShardedAppState): The worker's app state.
+        data (bytes): Bytes that were received by the worker that handed off the connection.
+
+    Returns:
+        None
+    """
+    decoder = StreamDecoder(deserialize_client_message)
+    msgs = decoder.feed(data)
+    registered = False
+
+    while True:
+        for i, msg in enumerate(msgs):
+            if not registered and isinstance(msg, RegisterMessage):
+                # Hand off the connection with the messages that have not been handled
+                if not app.is_local(msg.username):
+                    pending = b"".join(m.encode_(BINARY_FORMAT) for m in msgs[i:]) + decoder.take_pending()
+                    handoff(cs, app, app.owner_of(msg.username), pending)
+                    return
+                handle_messages([msg], app, cs)
+                # Registering fails for invalid usernames, which are not registered in the local state
+                registered = app.local.is_valid_user(msg.username) and app.local.get_user_connection(msg.username) is cs
+            else:
+                handle_messages([msg], app, cs)
+
+        # Once registered, the connection stays with this worker
+        if registered:
+            client_thread(cs, app, decoder)
+            return
+
+        try:
+            msgs = decoder.recv(cs)
+        except Exception as e:
+            logging.error("[!] Error: %s", e)
+            msgs = None
+        if msgs is None:
+            disconnect_client(cs, app)
+            return
+
+
+def handoff(cs, app, worker_id, data):
+    """Pass the client socket and its unhandled bytes to another worker, and close it in this one."""
+    logging.debug("Handing off %s to worker %s.", cs.getpeername(), worker_id)
+    fanout.unregister(cs)
+    rate_limiter.remove(cs)
+    stats.increment("connections", -1)
+    # The router closes the duplicate after sending it, and the other worker has its own
+    # file descriptor for the connection, so closing these doesn't disconnect the client
+    app.router.send(worker_id, ("handoff", data), fds=[os.dup(cs.fileno())])
+    cs.close()
+
+
+def start_client(cs, app, data=b""):
+    """Register the socket with the fan-out engine and start a client thread for it."""
+    stats.increment("connections")
+    fanout.register(cs)
+    Thread(target=sharded_client_thread, args=(cs, app, data), daemon=True).start()
+
+
+def run_worker(worker_id, num_workers, channels, host, port, backlog):
+    """
+    Worker process that accepts connections on its own SO_REUSEPORT socket.
+
+    Args:
+        worker_id (int): The index of this worker.
+        num_workers (int): The total number of workers.
+        channels (Dict[int, Socket]): Map of other worker indices to the socket connected to them.
+        host (str): The address to bind to.
+        port (int): The port to bind to.
+        backlog (int): The listen backlog.
+    """
+    router = Router(worker_id, channels)
+    # Each worker persists the users it owns in its own directory, so the server must be
+    # restarted with the same number of workers
+    local = SafeAppState(queue_store=QueueStore())
+    if PERSIST_DIR is not None:
+        persist(local, os.path.join(PERSIST_DIR, f"worker-{worker_id}"))
+    app = ShardedAppState(local, router, num_workers)
+    router.start(app)
+
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((host, port))
+    s.listen(backlog)
+
+    while True:
+        client_socket, client_address = s.accept()
+        logging.info("%s has connected to worker %s.", client_address, worker_id)
+        set_tcp_nodelay(client_socket)
+        start_client(client_socket, app)
+
+
+def run_sharded(host, port, num_workers=NUM_WORKERS, backlog=MAX_NUM_CONNECTIONS):
+    """
+    Fork the worker processes and wait for them. Terminating this process terminates the workers.
+    """
+    # Create a socket pair between every two workers
+    channels = [{} for _ in range(num_workers)]
+    for i in range(num_workers):
+        for j in range(i + 1, num_workers):
+            channels[i][j], channels[j][i] = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    ctx = get_context("fork")
+    workers = [ctx.Process(target=run_worker, args=(i, num_workers, channels[i], host, port, backlog), daemon=True)
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    print(f"[*] Listening as {host}:{port} with {num_workers} workers")
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,160 @@
+"""
+Defines the counters of server events, e.g. requests rejected by the rate limiter, and the
+number and latency of the messages handled by each service. The server counts events in
+the module-level `stats`, which can be read while it runs, e.g. by a StatsMessage.
+
+Counters are updated for every message, so each thread updates its own counters without a
+lock, and reading them adds up the counters of every thread. The counters of a thread are
+only written by that thread, so the only lock is held while a thread starts counting and
+while the counters are read.
+
+Latencies are counted in a histogram for each message type, whose buckets are bounded by
+the powers of 4 in LATENCY_BUCKETS_US: bucket `i` counts the latencies below
+`LATENCY_BUCKETS_US[i]` microseconds that are not in a lower bucket, and the last bucket
+counts every longer latency.
+"""
+import time
+from collections import Counter
+from threading import Lock, current_thread, local
+
+
+# Upper bounds of the latency histogram buckets in microseconds, from 1 us to about 1 s
+LATENCY_BUCKETS_US = tuple(4 ** i for i in range(11))
+NUM_LATENCY_BUCKETS = len(LATENCY_BUCKETS_US) + 1
+
+
+def latency_bucket(seconds):
+    """Return the index of the histogram bucket of a latency."""
+    # Microseconds in [4^(i-1), 4^i) have a bit length of 2i - 1 or 2i
+    return min((int(seconds * 1e6).bit_length() + 1) // 2, NUM_LATENCY_BUCKETS - 1)
+
+
+class ThreadCounts:
+    """The counters of one thread."""
+    __slots__ = ("counters", "messages", "latencies")
+
+    def __init__(self):
+        self.counters = {} # Map of counter names to their values
+        self.messages = {} # Map of message encoding headers to the number of messages handled
+        self.latencies = {} # Map of message encoding headers and latency buckets to their counts
+
+    def merge_into(self, counters, messages, latencies):
+        """Add the counts to Counters of each kind."""
+        # Copying a dict is atomic, so the thread can keep counting while it is read
+        counters.update(dict(self.counters))
+        messages.update(dict(self.messages))
+        latencies.update(dict(self.latencies))
+
+    def clear(self):
+        self.counters.clear()
+        self.messages.clear()
+        self.latencies.clear()
+
+
+class Stats:
+    """Named counters, and the number and latency of handled messages, counted by each thread."""
+    def __init__(self):
+        self._local = local()
+        self._threads = [] # The threads that counted, and their ThreadCounts
+        self._prune_at = 16 # Number of threads after which the ended threads are merged
+        self._ended = ThreadCounts() # The counts of the threads that ended
+        self._lock = Lock()
+        self._rates_read = (time.monotonic(), Counter()) # Time and message counts of the last `message_rates` call
+
+    def _counts(self):
+        """Return the ThreadCounts of the calling thread."""
+        try:
+            return self._local.counts
+        except AttributeError:
+            counts = self._local.counts = ThreadCounts()
+            with self._lock:
+                self._threads.append((current_thread(), counts))
+                # A thread is created for each client in the threaded server, so the list is
+                # pruned whenever it doubled, which keeps adding a thread O(1) on average
+                if len(self._threads) >= self._prune_at:
+                    self._prune()
+                    self._prune_at = 2 * len(self._threads) + 16
+            return counts
+
+    def _prune(self):
+        """Merge the counts of the threads that ended. Must be called while holding the lock."""
+        alive = []
+        for thread, counts in self._threads:
+            if thread.is_alive():
+                alive.append((thread, counts))
+            else:
+                for name, count in counts.counters.items():
+                    self._ended.counters[name] = self._ended.counters.get(name, 0) + count
+                for header, count in counts.messages.items():
+                    self._ended.messages[header] = self._ended.messages.get(header, 0) + count
+                for key, count in counts.latencies.items():
+                    self._ended.latencies[key] = self._ended.latencies.get(key, 0) + count
+        self._threads = alive
+
+    def _read(self):
+        """Return Counters of the counters, messages and latencies of every thread."""
+        counters, messages, latencies = Counter(), Counter(), Counter()
+        with self._lock:
+            self._prune()
+            self._ended.merge_into(counters, messages, latencies)
+            for _, counts in self._threads:
+                counts.merge_into(counters, messages, latencies)
+        return counters, messages, latencies
+
+    def increment(self, name, count=1):
+        """Add `count` to the counter with the name."""
+        counters = self._counts().counters
+        counters[name] = counters.get(name, 0) + count
+
+    def record_message(self, header, seconds):
+        """Count a message handled by a service, and its latency in seconds."""
+        counts = self._counts()
+        counts.messages[header] = counts.messages.get(header, 0) + 1
+        key = (header, latency_bucket(seconds))
+        counts.latencies[key] = counts.latencies.get(key, 0) + 1
+
+    def get(self, name):
+        """Return the value of the counter with the name, 0 if it was never incremented."""
+        return self._read()[0][name]
+
+    def snapshot(self):
+        """Return a dict of the counter names to their current values."""
+        return dict(self._read()[0])
+
+    def message_counts(self):
+        """Return a dict of message encoding headers to the number of messages handled."""
+        return dict(self._read()[1])
+
+    def message_rates(self):
+        """
+        Return a dict of message encoding headers to the messages handled per second since
+        the previous call, or since the counters were created.
+        """
+        now = time.monotonic()
+        messages = self._read()[1]
+        with self._lock:
+            last_time, last_messages = self._rates_read
+            self._rates_read = (now, messages)
+        elapsed = max(now - last_time, 1e-9)
+        return {header: (count - last_messages[header]) / elapsed for header, count in messages.items()}
+
+    def latency_histograms(self):
+        """Return a dict of message encoding headers to the counts of each latency bucket."""
+        histograms = {}
+        for (header, bucket), count in self._read()[2].items():
+            histograms.setdefault(header, [0] * NUM_LATENCY_BUCKETS)[bucket] += count
+        return histograms
+
+    def reset(self):
+        """
+        Set every counter to 0. Counts of messages that are being handled by other threads
+        at the same time may be lost, so this is meant for tests and benchmarks.
+        """
+        with self._lock:
+            self._ended.clear()
+            for _, counts in self._threads:
+                counts.clear()
+            self._rates_read = (time.monotonic(), Counter())
+
+
+stats = Stats()
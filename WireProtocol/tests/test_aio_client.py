@@ -0,0 +1,92 @@
+"""
+Testing the asyncio client API against an asyncio server on localhost.
+"""
+import asyncio
+
+import pytest
+from testfixtures import compare
+
+from src.aio_client import AsyncClient
+from src.aio_server import serve_asyncio
+from src.app import AppState
+from src.protocol import *
+
+
+def run_with_server(test_fn, app=None):
+    """Run the coroutine function `test_fn(port, app)` with an asyncio server on a free port."""
+    async def run():
+        server = await serve_asyncio("127.0.0.1", 0, app if app is not None else AppState(set(), {}, {}))
+        async with server:
+            await asyncio.wait_for(test_fn(server.sockets[0].getsockname()[1], app), timeout=10)
+
+    asyncio.run(run())
+
+
+def test_requests():
+    async def test_fn(port, app):
+        async with await AsyncClient.connect("127.0.0.1", port) as client:
+            res = await client.register("John", wire_format=BINARY_FORMAT)
+            assert res.success and res.wire_format == BINARY_FORMAT
+            assert (await client.list()).users == ["Bob", "John"]
+            assert (await client.send("Hi", recipient="Nobody")).error == "User does not exist."
+            assert (await client.delete("Bob")).success
+            assert (await client.list()).users == ["John"]
+
+    run_with_server(test_fn, AppState(set(["Bob"]), {}, {}))
+
+
+def test_send_many_and_messages():
+    async def test_fn(port, app):
+        async with await AsyncClient.connect("127.0.0.1", port) as john, \
+                   await AsyncClient.connect("127.0.0.1", port) as jane:
+            await john.register("John", wire_format=BINARY_FORMAT)
+            await jane.register("Jane")
+            msgs = [ChatMessage(sender="John", recipient="Jane", text=f"Hello {i}") for i in range(500)]
+            responses = await john.send_many(msgs)
+            assert all(res.success for res in responses)
+            compare([res.request_id for res in responses], expected=[msg.request_id for msg in msgs])
+
+            # The recipient gets every chat in order
+            received = []
+            async for msg in jane.messages():
+                received.append(msg.text)
+                if len(received) == len(msgs):
+                    break
+            compare(received, expected=[msg.text for msg in msgs])
+
+    run_with_server(test_fn)
+
+
+def test_queue():
+    async def test_fn(port, app):
+        for i in range(25):
+            app.queue_message("John", BroadcastMessage(sender="Jane", direct="John", text=f"Hello {i}"))
+        async with await AsyncClient.connect("127.0.0.1", port) as client:
+            # Registering pushes the first window, which the client acknowledges to get the rest
+            await client.register("John")
+            received = []
+            async for msg in client.messages():
+                received.append(msg.text)
+                if len(received) == 25:
+                    break
+            compare(received, expected=[f"Hello {i}" for i in range(25)])
+            assert not (await client.queue()).success
+
+    run_with_server(test_fn, AppState(set(["John", "Jane"]), {}, {}))
+
+
+def test_disconnect_fails_requests():
+    async def test_fn(port, app):
+        client = await AsyncClient.connect("127.0.0.1", port)
+        await client.register("John")
+        future = client.request_many([ListMessage()])[0]
+        app.get_user_connection("John").shutdown(None)
+        with pytest.raises(ConnectionError):
+            await future
+        # The messages iterator stops once the server disconnected
+        assert [msg async for msg in client.messages()] == []
+        with pytest.raises(ConnectionError):
+            await client.send("Hi")
+        await client.close()
+
+    run_with_server(test_fn, AppState(set(), {}, {}))
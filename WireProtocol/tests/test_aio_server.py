@@ -0,0 +1,84 @@
+"""
+Testing the asyncio server mode with real connections on localhost.
+"""
+import asyncio
+
+from testfixtures import compare
+
+from src.aio_server import serve_asyncio
+from src.app import AppState
+from src.protocol import *
+
+
+async def register(port, username, wire_format=None):
+    """Connect and register a user, returning the stream reader, writer and register response."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(RegisterMessage(username=username, wire_format=wire_format).encode_())
+    msgs = await read_messages(reader, 1)
+    return reader, writer, msgs[0]
+
+
+async def read_messages(reader, num_msgs):
+    """Read from the stream until `num_msgs` messages are decoded."""
+    decoder = StreamDecoder(deserialize_server_message)
+    msgs = []
+    while len(msgs) < num_msgs:
+        msgs += decoder.feed(await asyncio.wait_for(reader.read(4096), timeout=5))
+    return msgs
+
+
+def run_with_server(test_fn):
+    """Run the coroutine function `test_fn(port, app)` with an asyncio server on a free port."""
+    async def run():
+        app = AppState(set(), {}, {})
+        server = await serve_asyncio("127.0.0.1", 0, app)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            await test_fn(port, app)
+
+    asyncio.run(run())
+
+
+def test_register():
+    async def test_fn(port, app):
+        _, writer, res = await register(port, "John", BINARY_FORMAT)
+        assert res.success and res.is_new_user
+        assert res.wire_format == BINARY_FORMAT
+        assert app.get_user_connection("John") is not None
+        writer.close()
+
+    run_with_server(test_fn)
+
+
+def test_broadcast():
+    async def test_fn(port, app):
+        reader1, writer1, _ = await register(port, "John", BINARY_FORMAT)
+        reader2, writer2, _ = await register(port, "Jane")
+        writer1.write(ChatMessage(sender="John", text="Hello all!").encode_(BINARY_FORMAT))
+
+        # The sender receives the broadcast and a response, the other user the broadcast
+        msgs1 = await read_messages(reader1, 2)
+        msgs2 = await read_messages(reader2, 1)
+        expected = BroadcastMessage(sender="John", text="Hello all!")
+        compare(msgs1[0], expected)
+        assert isinstance(msgs1[1], ChatResponse) and msgs1[1].success
+        compare(msgs2[0], expected)
+        writer1.close()
+        writer2.close()
+
+    run_with_server(test_fn)
+
+
+def test_disconnect():
+    async def test_fn(port, app):
+        _, writer, _ = await register(port, "John")
+        writer.close()
+        await writer.wait_closed()
+        # Wait for the server to handle the disconnect
+        for _ in range(100):
+            if app.get_user_connection("John") is None:
+                break
+            await asyncio.sleep(0.01)
+        assert app.get_user_connection("John") is None
+
+    run_with_server(test_fn)
@@ -4,20 +4,22 @@ Testing AppState functionality.
 NOTE: Using integers in place of Socket objects for connections.
 NOTE: Using strings instead of BroadcastMessage objects for message queue values.
 """
+from threading import Thread
+
 import pytest
 from testfixtures import compare
 
-from src.app import AppState, InvalidUserError
+from src.app import AppState, SafeAppState, InvalidUserError, literal_prefix
 
 
-@pytest.fixture
-def app_state():
-    """Returns an AppState instance with some populated data."""
+@pytest.fixture(params=[AppState, SafeAppState])
+def app_state(request):
+    """Returns an AppState and a SafeAppState instance with some populated data."""
     users = set(["John", "Jane", "Bob"])
     connections = {"John": 1, "Jane": 2}
     msg_queue = {"Bob": ["Hello", "What's up?"]}
 
-    return AppState(users, connections, msg_queue)
+    return request.param(users, connections, msg_queue)
 
 
 @pytest.fixture
@@ -62,6 +64,38 @@ def test_list_users_wildcard(app_state):
     assert_elements_equal(listed, expected)
 
 
+def test_list_users_sorted(app_state):
+    assert app_state.list_users() == ["Bob", "Jane", "John"]
+    # Registered users are added to the index, and deleted users removed
+    app_state.register_user("Adam")
+    app_state.delete_user("Bob")
+    assert app_state.list_users() == ["Adam", "Jane", "John"]
+
+
+def test_list_users_limit_and_cursor(app_state):
+    assert app_state.list_users(limit=2) == ["Bob", "Jane"]
+    assert app_state.list_users(limit=2, after="Jane") == ["John"]
+    assert app_state.list_users("J.*", after="Bob") == ["Jane", "John"]
+
+
+def test_list_users_prefix(app_state):
+    for username in ["Jo", "Joe", "Jon", "Jp"]:
+        app_state.register_user(username)
+    assert app_state.list_users("Jo") == ["Jo", "Joe", "John", "Jon"]
+    assert app_state.list_users("Jo.n") == ["John"]
+    assert app_state.list_users("Jo?n") == ["Jon"]
+    assert app_state.list_users("Jo|B") == ["Bob", "Jo", "Joe", "John", "Jon"]
+
+
+def test_literal_prefix():
+    assert literal_prefix("Jo.*") == "Jo"
+    assert literal_prefix("Joh?n") == "Jo"
+    assert literal_prefix("Jo+") == "Jo"
+    assert literal_prefix("Jo{2}") == "J"
+    assert literal_prefix("[JB]ob") == ""
+    assert literal_prefix("Jo|Bo") == ""
+
+
 def test_register_invalid_username(app_state):
     # Check that the correct exceptions are raised
     with pytest.raises(InvalidUserError) as excinfo1:
@@ -140,6 +174,29 @@ def test_remove_connection(app_state):
     app_state._connections == {"John": 1}
 
 
+def test_remove_connection_unknown(app_state):
+    with pytest.raises(KeyError):
+        app_state.remove_connection(3)
+
+
+def test_remove_connections(app_state):
+    # Unknown sockets are ignored
+    removed = app_state.remove_connections([1, 2, 3])
+    assert_elements_equal(removed, ["John", "Jane"])
+    assert app_state.get_all_connections() == []
+    # The sockets can be connected again
+    app_state.add_connection("Bob", 1)
+    assert app_state._get_connection_username(1) == "Bob"
+
+
+def test_is_active_user(app_state):
+    assert app_state.is_active_user("John")
+    assert not app_state.is_active_user("Bob")
+    app_state.remove_connection(1)
+    assert not app_state.is_active_user("John")
+    compare(set(app_state.get_active_users()), {"Jane"})
+
+
 def test_queue_message_invalid(app_state):
     # Test exception for invalid username
     with pytest.raises(InvalidUserError) as excinfo:
@@ -161,4 +218,142 @@ def test_queue_message_existing(app_state):
 def test_get_queued_messages(app_state):
     res = app_state.get_queued_messages("Bob")
 
-    assert res == ["Hello", "What's up?"]
\ No newline at end of file
+    assert res == ["Hello", "What's up?"]
+
+def test_queued_window_and_ack(app_state):
+    for i in range(5):
+        app_state.queue_message("Bob", str(i))
+    assert app_state.get_queued_window("Bob", 3) == (1, ["Hello", "What's up?", "0"], 4)
+
+    # Acknowledged messages are removed, and sequence numbers keep increasing
+    app_state.ack_queued_messages("Bob", 3)
+    assert app_state.get_queued_window("Bob", 3) == (4, ["1", "2", "3"], 1)
+    # Acknowledging old sequence numbers again has no effect
+    app_state.ack_queued_messages("Bob", 2)
+    app_state.ack_queued_messages("Bob", 7)
+    assert app_state.get_queued_window("Bob", 3) == (8, [], 0)
+
+
+def test_count_queued_messages(app_state):
+    assert app_state.count_queued_messages() == 2
+    app_state.queue_message("John", "Hello")
+    assert app_state.count_queued_messages() == 3
+
+
+def test_get_connection_user(app_state):
+    assert app_state.get_connection_user(2) == "Jane"
+    assert app_state.get_connection_user(3) is None
+
+
+def test_default_state_not_shared():
+    app_state = AppState()
+    app_state.register_user("John")
+    assert not AppState().is_valid_user("John")
+
+
+def run_threads(target, num_threads=16):
+    """Run `target(i)` on `num_threads` threads and wait for them."""
+    threads = [Thread(target=target, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_safe_concurrent_queue_message():
+    app_state = SafeAppState(set(["Bob"]))
+
+    def queue_messages(i):
+        for j in range(1000):
+            app_state.queue_message("Bob", (i, j))
+
+    # No messages are lost when threads queue messages for the same user
+    run_threads(queue_messages)
+    assert len(app_state.get_queued_messages("Bob")) == 16 * 1000
+
+
+def test_safe_concurrent_register_user():
+    app_state = SafeAppState()
+    results = []
+
+    def register(i):
+        results.append(app_state.register_user("John"))
+
+    # Exactly one thread registers the user as new
+    run_threads(register)
+    assert sorted(results) == [False] * 15 + [True]
+
+
+def test_safe_concurrent_connections():
+    app_state = SafeAppState()
+
+    def connect(i):
+        for j in range(100):
+            username = f"user{i}x{j}"
+            app_state.register_user(username)
+            app_state.add_connection(username, (i, j))
+        for j in range(0, 100, 2):
+            app_state.remove_connection((i, j))
+
+    run_threads(connect)
+    assert len(app_state.get_all_connections()) == 16 * 50
+
+
+def test_safe_concurrent_delete_user():
+    app_state = SafeAppState(set(f"user{i}" for i in range(16)))
+
+    def delete(i):
+        app_state.delete_user(f"user{i}")
+
+    run_threads(delete)
+    assert app_state.list_users() == []
+
+
+def test_safe_concurrent_remove_connections():
+    app_state = SafeAppState()
+
+    def connect_and_remove(i):
+        sockets = [(i, j) for j in range(100)]
+        for j, socket in enumerate(sockets):
+            username = f"user{i}x{j}"
+            app_state.register_user(username)
+            app_state.add_connection(username, socket)
+        assert len(app_state.remove_connections(sockets)) == 100
+
+    run_threads(connect_and_remove)
+    assert app_state.get_all_connections() == []
+
+
+def test_room_membership(app_state):
+    assert app_state.join_room("John", "general")
+    assert app_state.join_room("Bob", "general")
+    assert not app_state.join_room("John", "general")
+    assert app_state.is_room_member("John", "general")
+    compare(sorted(app_state.get_room_members("general")), ["Bob", "John"])
+
+    app_state.leave_room("John", "general")
+    assert not app_state.is_room_member("John", "general")
+    with pytest.raises(ValueError):
+        app_state.leave_room("John", "general")
+    with pytest.raises(InvalidUserError):
+        app_state.join_room("Jill", "general")
+    with pytest.raises(ValueError):
+        app_state.join_room("John", "no_room")
+
+    # Rooms are removed once they have no members, e.g. when a member is deleted
+    app_state.delete_user("Bob")
+    compare(app_state.get_room_members("general"), [])
+
+
+def test_room_connections(app_state):
+    # Only the sockets of active members are sent to, and they follow members connecting
+    app_state.join_room("John", "general")
+    app_state.join_room("Bob", "general")
+    compare(app_state.get_room_connections("general"), [1])
+    app_state.add_connection("Bob", 3)
+    compare(sorted(app_state.get_room_connections("general")), [1, 3])
+    app_state.remove_connection(1)
+    compare(app_state.get_room_connections("general"), [3])
+    app_state.remove_connections([3])
+    compare(app_state.get_room_connections("general"), [])
+    compare(app_state.get_room_connections("random"), [])
@@ -0,0 +1,61 @@
+"""
+Testing the pipelined client API against a server thread.
+"""
+import socket
+from threading import Thread
+
+import pytest
+
+from src.app import AppState
+from src.client import PipelinedClient
+from src.protocol import *
+from src.server import client_thread
+
+
+@pytest.fixture
+def client():
+    """Returns a PipelinedClient connected to a client thread of the server."""
+    server_side, client_side = socket.socketpair()
+    app_state = AppState(set(["Bob"]))
+    Thread(target=client_thread, args=(server_side, app_state), daemon=True).start()
+    client = PipelinedClient(client_side)
+    yield client
+    client.close()
+
+
+def test_pipelined_requests(client):
+    res = client.register("John", wire_format=BINARY_FORMAT, compression=ZLIB_COMPRESSION)
+    assert res.success and res.compression == ZLIB_COMPRESSION
+    assert client.wire_format == COMPRESSED_FORMAT
+
+    # Many requests are in flight at once, and each future gets the response to its request
+    msgs = [ListMessage() if i % 2 else ChatMessage(sender="John", recipient="Nobody", text=str(i)) for i in range(200)]
+    futures = client.request_many(msgs)
+    for msg, future in zip(msgs, futures):
+        res = future.result(timeout=5)
+        assert res.request_id == msg.request_id
+        if isinstance(msg, ListMessage):
+            assert res.users == ["Bob", "John"]
+        else:
+            assert res.error == "User does not exist."
+
+
+def test_unsolicited_messages():
+    server_side, client_side = socket.socketpair()
+    received = []
+    client = PipelinedClient(client_side, on_message=received.append)
+    msg = BroadcastMessage(sender="John", text="Hello all!")
+    server_side.sendall(msg.encode_())
+    server_side.close()
+    client.close()
+    assert len(received) == 1 and received[0].text == "Hello all!"
+
+
+def test_disconnect_fails_requests():
+    server_side, client_side = socket.socketpair()
+    client = PipelinedClient(client_side)
+    future = client.request(ListMessage())
+    server_side.close()
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5)
+    client.close()
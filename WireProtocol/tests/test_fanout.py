@@ -0,0 +1,186 @@
+"""
+Testing the fan-out engine.
+
+NOTE: Using a fake socket that blocks in `sendmsg()` to simulate a slow client.
+"""
+import socket
+import time
+from threading import Event, Thread
+
+import pytest
+
+from src.fanout import *
+
+
+class SlowSocket:
+    """Socket that blocks every send until `release` is set."""
+    def __init__(self):
+        self.sending = Event() # Set when a send has started
+        self.release = Event()
+        self.received = b""
+        self.is_shutdown = False
+
+    def sendmsg(self, buffers):
+        self.sending.set()
+        self.release.wait()
+        data = b"".join(buffers)
+        self.received += data
+        return len(data)
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def shutdown(self, how):
+        self.is_shutdown = True
+
+
+def blocked_queue(policy):
+    """Return an OutboundQueue with a small high-water mark whose writer is blocked sending b"first"."""
+    sock = SlowSocket()
+    queue = OutboundQueue(sock, high_water_mark=10, policy=policy)
+    queue.start()
+    queue.put(b"first")
+    sock.sending.wait()
+    return queue, sock
+
+
+def wait_for(sock, num_bytes):
+    """Release the socket and wait until it received `num_bytes`."""
+    sock.release.set()
+    for _ in range(1000):
+        if len(sock.received) >= num_bytes:
+            return
+        time.sleep(0.005)
+
+
+def test_sendmsg_all_partial_sends():
+    # Partially sent buffers are resent from the right position
+    class PartialSocket:
+        received = b""
+        def sendmsg(self, buffers):
+            data = bytes(buffers[0][:3])
+            self.received += data
+            return len(data)
+
+    sock = PartialSocket()
+    sendmsg_all(sock, [b"Hello", b"", b"World"])
+    assert sock.received == b"HelloWorld"
+
+
+def test_sendmsg_all_socketpair():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        sendmsg_all(sender, [b"Hello", b" ", b"World"])
+        assert receiver.recv(100) == b"Hello World"
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError) as excinfo:
+        _ = FanoutEngine(high_water_mark=10, policy="ignore")
+    assert str(excinfo.value) == "Unknown slow consumer policy 'ignore'."
+
+
+def test_drop_policy():
+    queue, sock = blocked_queue(DROP_POLICY)
+    assert queue.put(b"12345678")
+    # Exceeds the high-water mark
+    assert not queue.put(b"123")
+    assert queue.dropped == 1
+    wait_for(sock, 13)
+    assert sock.received == b"first12345678"
+    queue.close()
+
+
+def test_disconnect_policy():
+    queue, sock = blocked_queue(DISCONNECT_POLICY)
+    assert queue.put(b"1")
+    # Exceeds the high-water mark with a byte pending
+    assert not queue.put(b"1234567890")
+    assert sock.is_shutdown
+    # The queue is closed after disconnecting
+    assert not queue.put(b"1")
+    sock.release.set()
+
+
+def test_large_message_without_backlog():
+    # A message larger than the high-water mark is queued if nothing is pending
+    queue, sock = blocked_queue(DISCONNECT_POLICY)
+    assert queue.put(b"12345678901")
+    assert not sock.is_shutdown
+    wait_for(sock, 16)
+    assert sock.received == b"first12345678901"
+    queue.close()
+
+
+def test_spill_policy():
+    queue, sock = blocked_queue(SPILL_POLICY)
+    queue.put(b"12345678")
+    # These are spilled to disk, and sent in order after the queue drains
+    queue.put(b"abcdefghij")
+    queue.put(b"k")
+    wait_for(sock, 24)
+    assert sock.received == b"first12345678abcdefghijk"
+    # After the spill file drains, messages are queued in memory again
+    queue.put(b"l")
+    wait_for(sock, 25)
+    assert sock.received.endswith(b"l")
+    queue.close()
+
+
+def test_engine_send_batches():
+    # Each batch is queued separately, and the batches after a dropped batch are not sent
+    engine = FanoutEngine(high_water_mark=10, policy=DROP_POLICY)
+    sock = SlowSocket()
+    engine.register(sock)
+    engine.send(sock, b"first")
+    sock.sending.wait()
+    assert engine.send_batches(sock, [[b"1234", b"5678"], [b"9"]])
+    assert not engine.send_batches(sock, [[b"abc"], [b"d"]])
+    wait_for(sock, 14)
+    assert sock.received == b"first123456789"
+    engine.unregister(sock)
+
+
+def test_engine_publish():
+    # The same bytes are sent to registered and unregistered sockets
+    engine = FanoutEngine(high_water_mark=1 << 20, policy=DROP_POLICY)
+    sender1, receiver1 = socket.socketpair()
+    sender2, receiver2 = socket.socketpair()
+    with sender1, receiver1, sender2, receiver2:
+        engine.register(sender1)
+        engine.publish(b"Hello", [sender1, sender2])
+        assert receiver1.recv(100) == b"Hello"
+        assert receiver2.recv(100) == b"Hello"
+        engine.unregister(sender1)
+
+
+def test_engine_coalesce():
+    # Sends from the thread in the block are written at once when it exits
+    engine = FanoutEngine(high_water_mark=1 << 20, policy=DROP_POLICY)
+    sock = SlowSocket()
+    sock.release.set()
+    with engine.coalesce(sock):
+        engine.send(sock, b"echo")
+        with engine.coalesce(sock):
+            assert engine.send_batches(sock, [[b"1", b"2"], [b"3"]])
+        # Sends from another thread are not held back
+        other = Thread(target=engine.send, args=(sock, b"other"))
+        other.start()
+        other.join()
+        assert sock.received == b"other"
+        engine.send(sock, b"response")
+    assert sock.received == b"otherecho123response"
+
+
+def test_engine_coalesce_max_batch_size():
+    # Coalesced bytes are written before the end of the block once they reach the maximum
+    engine = FanoutEngine(high_water_mark=1 << 20, policy=DROP_POLICY, max_batch_size=8)
+    sock = SlowSocket()
+    sock.release.set()
+    with engine.coalesce(sock):
+        engine.send(sock, b"1234")
+        assert sock.received == b""
+        engine.send_buffers(sock, [b"5678", b"9"])
+        assert sock.received == b"123456789"
+        engine.send(sock, b"0")
+    assert sock.received == b"1234567890"
@@ -0,0 +1,58 @@
+"""
+Testing the logging pipeline.
+"""
+import io
+import logging
+from unittest.mock import patch
+
+import pytest
+
+from src.log import *
+
+
+class CountingArg:
+    """Log argument that counts how many times it was formatted."""
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "arg"
+
+
+@pytest.fixture
+def stream():
+    """Configure logging at INFO to a string stream, and stop it after the test."""
+    stream = io.StringIO()
+    configure_logging(level=logging.INFO, fmt="%(levelname)s %(message)s", stream=stream)
+    yield stream
+    stop_logging()
+
+
+def test_configure_logging(stream):
+    # Records are written by the listener, and configuring again keeps the first configuration
+    configure_logging(level=logging.DEBUG)
+    logging.info("Hello %s", "world")
+    arg = CountingArg()
+    logging.debug("Not logged %s", arg)
+    stop_logging()
+    assert stream.getvalue() == "INFO Hello world\n"
+    # Records below the level are never formatted
+    assert arg.formatted == 0
+
+
+def test_log_sampled(stream):
+    with patch.dict(LOG_SAMPLE_RATES, {"test_sampled": 3}):
+        for i in range(7):
+            log_sampled("test_sampled", logging.INFO, "Event %s", i)
+        log_sampled("test_unsampled", logging.INFO, "Other event")
+        # Events below the level are not counted
+        log_sampled("test_sampled", logging.DEBUG, "Debug event")
+        log_sampled("test_sampled", logging.INFO, "Event %s", 7)
+        stop_logging()
+    assert stream.getvalue().splitlines() == [
+        "INFO Event 0 (1 in 3 test_sampled events)",
+        "INFO Event 3 (1 in 3 test_sampled events)",
+        "INFO Event 6 (1 in 3 test_sampled events)",
+        "INFO Other event",
+    ]
@@ -0,0 +1,196 @@
+"""
+Testing the write-ahead log and snapshots of the app state.
+"""
+import os
+import time
+
+import pytest
+from testfixtures import compare
+
+from src.app import AppState, SafeAppState
+from src.persistence import *
+from src.protocol import *
+from src.queue_store import QueueStore
+
+
+def messages(username, num_msgs):
+    """Return `num_msgs` direct messages for the user."""
+    return [BroadcastMessage(sender="John", direct=username, text=f"Hello {i}") for i in range(num_msgs)]
+
+
+def frames(msgs):
+    return [msg.encode_(BINARY_FORMAT) for msg in msgs]
+
+
+def queued_frames(app, username):
+    return frames(app.get_queued_messages(username))
+
+
+@pytest.fixture
+def journal_dir(tmp_path):
+    return str(tmp_path / "journal")
+
+
+def open_app(directory, queue_store=None, flush_interval=60, **kwargs):
+    """Return a SafeAppState restored from the directory, and its journal."""
+    journal = Journal(directory, flush_interval=flush_interval, **kwargs)
+    app = journal.attach(SafeAppState(queue_store=queue_store))
+    return app, journal
+
+
+def test_records_round_trip():
+    records = [(OP_REGISTER, "John", 0, b""), (OP_QUEUE, "Bob", 3, b"frame"), (OP_ACK, "Bob", 3, b"")]
+    data = b"".join(encode_record(*record) for record in records)
+    compare(list(decode_records(data)), expected=records)
+
+    # A torn record at the end is ignored
+    compare(list(decode_records(data[:-2])), expected=records[:2])
+    corrupt = bytearray(data)
+    corrupt[-1] ^= 0xFF
+    compare(list(decode_records(bytes(corrupt))), expected=records[:2])
+
+
+def test_replay_skips_changes_in_snapshot():
+    users, queues, rooms = {"Bob"}, {"Bob": [2, [b"m2", b"m3"]]}, {}
+    replay([
+        (OP_QUEUE, "Bob", 3, b"m3"), # Already in the snapshot
+        (OP_QUEUE, "Bob", 4, b"m4"),
+        (OP_ACK, "Bob", 2, b""),
+        (OP_REGISTER, "John", 0, b""),
+        (OP_QUEUE, "John", 5, b"j5"), # Queued after the snapshot, once earlier messages were acked
+        (OP_JOIN, "Bob", 0, b"general"),
+        (OP_JOIN, "John", 0, b"general"),
+        (OP_LEAVE, "John", 0, b"general"),
+    ], users, queues, rooms)
+    compare(users, expected={"Bob", "John"})
+    compare(queues, expected={"Bob": [3, [b"m3", b"m4"]], "John": [5, [b"j5"]]})
+    compare(rooms, expected={"general": {"Bob"}})
+
+    # Deleting a user resets its sequence numbers, and removes it from its rooms
+    replay([(OP_DELETE, "Bob", 0, b""), (OP_REGISTER, "Bob", 0, b""), (OP_QUEUE, "Bob", 1, b"n1")],
+           users, queues, rooms)
+    compare(queues["Bob"], expected=[1, [b"n1"]])
+    compare(rooms, expected={"general": set()})
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot")
+    write_snapshot(path, ["Bob", "John"], [("Bob", 4, [b"m4", b"m5"])], [("general", ["Bob", "John"])])
+    compare(read_snapshot(path), expected=(["Bob", "John"], {"Bob": [4, [b"m4", b"m5"]]},
+                                           {"general": {"Bob", "John"}}))
+
+    write_snapshot(path, [], [])
+    compare(read_snapshot(path), expected=([], {}, {}))
+
+
+@pytest.mark.parametrize("use_store", [False, True])
+def test_restart_replays_log(journal_dir, use_store):
+    store = QueueStore(tail_size=2) if use_store else None
+    app, journal = open_app(journal_dir, store)
+    for username in ["John", "Bob", "Alice", "Eve"]:
+        app.register_user(username)
+    app.delete_user("Eve")
+    msgs = messages("Bob", 5)
+    for msg in msgs:
+        app.queue_message("Bob", msg)
+    app.ack_queued_messages("Bob", 2)
+    journal.close()
+
+    restarted_store = QueueStore() if use_store else None
+    restarted, journal = open_app(journal_dir, restarted_store)
+    compare(restarted.list_users(), expected=["Alice", "Bob", "John"])
+    compare(queued_frames(restarted, "Bob"), expected=frames(msgs[2:]))
+    # Sequence numbers continue from the acknowledged messages
+    compare(restarted.get_queued_window("Bob", 1)[0], expected=3)
+    journal.close()
+    if use_store:
+        store.close()
+        restarted_store.close()
+
+
+def test_snapshot_replaces_log(journal_dir):
+    app, journal = open_app(journal_dir)
+    app.register_user("John")
+    app.register_user("Bob")
+    msgs = messages("Bob", 3)
+    app.queue_message("Bob", msgs[0])
+    journal.snapshot()
+    # Only the latest snapshot and the log after it are kept
+    compare(sorted(os.listdir(journal_dir)), expected=["snapshot-2.bin", "wal-2.log"])
+
+    # Changes after the snapshot are replayed on top of it
+    app.queue_message("Bob", msgs[1])
+    app.queue_message("Bob", msgs[2])
+    app.ack_queued_messages("Bob", 1)
+    app.register_user("Alice")
+    journal.close()
+
+    restarted, journal = open_app(journal_dir)
+    compare(restarted.list_users(), expected=["Alice", "Bob", "John"])
+    compare(queued_frames(restarted, "Bob"), expected=frames(msgs[1:]))
+    journal.close()
+
+
+def test_changes_during_snapshot_are_not_duplicated(journal_dir):
+    app, journal = open_app(journal_dir)
+    app.register_user("Bob")
+    msgs = messages("Bob", 2)
+    app.queue_message("Bob", msgs[0])
+
+    # The message is queued after the new log was started, but before the state was copied
+    snapshot = app.snapshot
+    def snapshot_after_change():
+        app.queue_message("Bob", msgs[1])
+        return snapshot()
+    app.snapshot = snapshot_after_change
+    journal.snapshot()
+    journal.close()
+
+    restarted, journal = open_app(journal_dir)
+    compare(queued_frames(restarted, "Bob"), expected=frames(msgs))
+    journal.close()
+
+
+def test_snapshot_after_interval(journal_dir):
+    app, journal = open_app(journal_dir, flush_interval=0.01, snapshot_interval=3)
+    for username in ["John", "Bob", "Alice"]:
+        app.register_user(username)
+    # The journal's thread writes the records, then a snapshot
+    deadline = time.monotonic() + 5
+    while "snapshot-2.bin" not in os.listdir(journal_dir) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    journal.close()
+    compare(sorted(os.listdir(journal_dir)), expected=["snapshot-2.bin", "wal-2.log"])
+    compare(read_snapshot(os.path.join(journal_dir, "snapshot-2.bin")), expected=(["Alice", "Bob", "John"], {}, {}))
+
+
+def test_restore():
+    app = AppState()
+    msgs = messages("Bob", 2)
+    app.restore(["John", "Bob"], [("Bob", 4, msgs)])
+    compare(app.list_users(), expected=["Bob", "John"])
+    compare(app.get_queued_window("Bob", 10), expected=(4, msgs, 0))
+    compare(app.snapshot(), expected=(["Bob", "John"], [("Bob", 4, msgs)], []))
+
+    app.restore(["John", "Bob"], [], [("general", ["John", "Bob"])])
+    compare(sorted(app.get_room_members("general")), expected=["Bob", "John"])
+    compare(app.snapshot()[2], expected=[("general", app.get_room_members("general"))])
+
+
+def test_rooms_survive_restart(journal_dir):
+    app, journal = open_app(journal_dir)
+    for username in ["John", "Bob", "Alice"]:
+        app.register_user(username)
+    app.join_room("John", "general")
+    app.join_room("Bob", "general")
+    app.join_room("Alice", "random")
+    journal.snapshot()
+    app.join_room("Alice", "general")
+    app.leave_room("Bob", "general")
+    app.delete_user("John")
+    journal.close()
+
+    restarted, journal = open_app(journal_dir)
+    compare(restarted.get_room_members("general"), expected=["Alice"])
+    compare(restarted.get_room_members("random"), expected=["Alice"])
+    journal.close()
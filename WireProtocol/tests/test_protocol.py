@@ -1,3 +1,5 @@
+import socket
+
 import pytest
 from testfixtures import compare
 
@@ -161,6 +163,15 @@ def test_encode_msg_queue(max_length_broadcast):
     assert all([len(buffer) <= MAX_BUFFER_SIZE for buffer in res])
 
 
+def test_encode_msg_batches(max_length_broadcast, queued_msgs):
+    msgs = [max_length_broadcast for _ in range(20)] + queued_msgs
+    res = encode_msg_batches(msgs)
+    # The batches are not concatenated, and contain every message in order
+    assert len(res) == 7
+    assert all([sum(len(data) for data in batch) <= MAX_BUFFER_SIZE for batch in res])
+    assert [data for batch in res for data in batch] == [msg.encode_() for msg in msgs]
+
+
 def test_decode_msg_queue(max_length_broadcast):
     queued_msgs = [max_length_broadcast for _ in range(20)] # 10 max length messages
     res = encode_msg_queue(queued_msgs)
@@ -171,4 +182,245 @@ def test_decode_msg_queue(max_length_broadcast):
 
     assert len(msgs) == 20
     for msg in msgs:
-        compare(max_length_broadcast, msg)
\ No newline at end of file
+        compare(max_length_broadcast, msg)
+
+def test_encode_binary_register_msg():
+    msg = RegisterMessage(username="John", wire_format=BINARY_FORMAT)
+    encoded = msg.encode_(BINARY_FORMAT)
+    # Header, two field lengths, then the fields
+    expected = BINARY_HEADER.pack(FRAME_MAGIC, RegisterMessage.type_code, 0, 2, 14) + b"\x00\x04\x00\x06Johnbinary"
+    assert encoded == expected
+
+
+def test_decode_binary_chat_msg():
+    # User text containing the text format tokens is decoded correctly
+    msg = ChatMessage(sender="John", recipient="Bob", text="Hi<SEP>Bob<EOM>")
+    res = deserialize_client_message(msg.encode_(BINARY_FORMAT))
+    compare(res, msg)
+
+
+def test_decode_binary_register_response():
+    res = RegisterResponse(success=True, is_new_user=False, wire_format=BINARY_FORMAT)
+    decoded = deserialize_server_message(res.encode_(BINARY_FORMAT))
+    compare(decoded, res)
+
+
+def test_decode_binary_unknown_type():
+    frame = BINARY_HEADER.pack(FRAME_MAGIC, 99, 0, 0, 0)
+    with pytest.raises(ValueError) as excinfo:
+        _ = deserialize_client_message(frame)
+    assert str(excinfo.value) == "Unknown message type header received from client."
+
+
+def test_decode_binary_bad_field_lengths():
+    # Field lengths that don't add up to the body length are rejected
+    frame = BINARY_HEADER.pack(FRAME_MAGIC, RegisterMessage.type_code, 0, 2, 14) + b"\x00\x04\x00\x03Johnbinary"
+    with pytest.raises(ValueError) as excinfo:
+        _ = deserialize_client_message(frame)
+    assert str(excinfo.value) == "Malformed binary frame: field lengths don't match the body length."
+
+
+def test_list_msg_cursor():
+    msg = ListMessage(wildcard="Jo.*", cursor="John")
+    compare(deserialize_client_message(msg.encode_().decode()[:-len(Message.EOM_token)]), msg)
+    compare(deserialize_client_message(msg.encode_(BINARY_FORMAT)), msg)
+    # The cursor is only encoded when continuing a listing
+    assert ListMessage().encode_() == b"LST<SEP>*<EOM>"
+
+
+def test_list_response_cursor():
+    assert ListResponse(success=True, users=["Bob", "John"], limit_exceeded=True).cursor == "John"
+    assert ListResponse(success=True, users=["Bob", "John"]).cursor is None
+
+
+def test_queue_msg_ack():
+    msg = QueueMessage(username="John", ack=64)
+    compare(deserialize_client_message(msg.encode_().decode()[:-len(Message.EOM_token)]), msg)
+    compare(deserialize_client_message(msg.encode_(BINARY_FORMAT)), msg)
+    # The ack is only encoded when acknowledging a window
+    assert QueueMessage(username="John").encode_() == b"QUE<SEP>John<EOM>"
+
+
+def test_queue_response_window():
+    res = QueueResponse(success=True, error="", last_seq=64, remaining=10)
+    compare(deserialize_server_message(res.encode_().decode()[:-len(Message.EOM_token)]), res)
+    compare(deserialize_server_message(res.encode_(BINARY_FORMAT)), res)
+    # The window is only encoded when messages were sent
+    assert QueueResponse(success=False, error="No messages in queue.").encode_() == b"RESQ<SEP>0<SEP>No messages in queue.<EOM>"
+
+
+def test_room_msgs():
+    for msg in [JoinMessage(username="John", room="general"), LeaveMessage(username="John", room="general")]:
+        compare(deserialize_client_message(msg.encode_().decode()[:-len(Message.EOM_token)]), msg)
+        compare(deserialize_client_message(msg.encode_(BINARY_FORMAT)), msg)
+    assert JoinMessage(username="John", room="general").encode_() == b"JOI<SEP>John<SEP>general<EOM>"
+    # A message to a room is a chat whose recipient has the room prefix
+    msg = BroadcastMessage(sender="John", direct=f"{ROOM_PREFIX}general", text="Hello room!")
+    compare(deserialize_server_message(msg.encode_(BINARY_FORMAT)), msg)
+
+
+def test_stats_msgs():
+    compare(deserialize_client_message(StatsMessage().encode_().decode()[:-len(Message.EOM_token)]), StatsMessage())
+    compare(deserialize_client_message(StatsMessage().encode_(BINARY_FORMAT)), StatsMessage())
+    res = StatsResponse(success=True, stats={"connections": "2", "latency_us.MSG": "0,3,1"}, truncated=True)
+    for wire_format in WIRE_FORMATS:
+        compare(decode_server_buffer(res.encode_(wire_format))[0], res)
+    res = StatsResponse(success=False, error="Only admins can request stats.")
+    compare(deserialize_server_message(res.encode_(BINARY_FORMAT)), res)
+
+
+def test_request_id():
+    msg = ChatMessage(sender="John", text="Hi")
+    msg.request_id = 7
+    assert msg.encode_() == b"MSG#7<SEP>John<SEP>^<SEP>Hi<EOM>"
+    for wire_format in WIRE_FORMATS:
+        decoded = decode_client_buffer(msg.encode_(wire_format))[0]
+        compare(decoded, msg)
+        assert decoded.request_id == 7
+
+    res = ListResponse(success=True, users=["John"])
+    res.request_id = 2 ** 32 - 1
+    for wire_format in WIRE_FORMATS:
+        assert decode_server_buffer(res.encode_(wire_format))[0].request_id == 2 ** 32 - 1
+    # Messages without a request ID are unchanged
+    assert ChatMessage(sender="John", text="Hi").encode_(BINARY_FORMAT)[2] == 0
+
+
+def test_decode_bad_request_id():
+    with pytest.raises(ValueError) as excinfo:
+        _ = deserialize_client_message("MSG#x<SEP>John<SEP>^<SEP>Hi")
+    assert str(excinfo.value) == "Malformed request ID."
+
+
+def test_register_compression():
+    msg = RegisterMessage(username="John", compression=ZLIB_COMPRESSION)
+    assert msg.encode_() == b"REG<SEP>John<SEP><SEP>zlib<EOM>"
+    compare(decode_client_buffer(msg.encode_(BINARY_FORMAT))[0], msg)
+    res = RegisterResponse(success=True, is_new_user=True, wire_format=BINARY_FORMAT, compression=ZLIB_COMPRESSION)
+    compare(decode_server_buffer(res.encode_(BINARY_FORMAT))[0], res)
+
+
+def test_compressed_frame():
+    res = ListResponse(success=True, users=[f"johnathan_smith{i}" for i in range(30)])
+    encoded = res.encode_(COMPRESSED_FORMAT)
+    assert encoded[2] & FLAG_COMPRESSED
+    assert len(encoded) < len(res.encode_(BINARY_FORMAT))
+    compare(decode_server_buffer(encoded), [res])
+    # Small frames are not compressed
+    assert ChatResponse(success=True).encode_(COMPRESSED_FORMAT) == ChatResponse(success=True).encode_(BINARY_FORMAT)
+
+
+def test_compressed_batches():
+    msgs = [BroadcastMessage(sender="John", direct="Bob", text=f"Hello Bob, this is message {i}") for i in range(200)]
+    batches = encode_msg_batches(msgs, COMPRESSED_FORMAT)
+    # Fewer batches are needed, and each one still fits in MAX_BUFFER_SIZE
+    assert len(batches) < len(encode_msg_batches(msgs, BINARY_FORMAT))
+    assert all(sum(len(data) for data in batch) < MAX_BUFFER_SIZE for batch in batches)
+    compare(decode_server_buffer(b"".join(b"".join(batch) for batch in batches)), msgs)
+
+
+def compressed_frame(data):
+    """Return a compressed frame with the data as its decompressed body."""
+    body = zlib.compress(data)
+    return BINARY_HEADER.pack(FRAME_MAGIC, COMPRESSED_TYPE_CODE, FLAG_COMPRESSED, 0, len(body)) + body
+
+
+def test_compressed_frame_limits():
+    msg = BroadcastMessage(sender="John", text="Hi")
+    # Nested compressed frames are skipped
+    nested = compressed_frame(compressed_frame(msg.encode_(BINARY_FORMAT)))
+    compare(decode_server_buffer(nested + msg.encode_(BINARY_FORMAT)), [msg])
+    # Frames that decompress to more than MAX_DECOMPRESSED_SIZE bytes are skipped
+    assert decode_server_buffer(compressed_frame(b"\0" * (MAX_DECOMPRESSED_SIZE + 1))) == []
+
+
+def test_binary_non_ascii_fields():
+    # Field lengths are byte lengths, which differ from the number of characters
+    msgs = [BroadcastMessage(sender="Jöhn", direct="Bób", text="Héllo ✓"),
+            ListResponse(success=True, users=["Jöhn", "Bob"])]
+    for msg in msgs:
+        msg.request_id = 3
+    compare(decode_server_buffer(b"".join(msg.encode_(BINARY_FORMAT) for msg in msgs)), msgs)
+
+
+def test_messages_have_no_dict():
+    # Messages only have the fields listed in their slots
+    for msg in [BroadcastMessage(sender="John", text="Hi"), ChatMessage(sender="John", text="Hi"),
+                RegisterResponse(success=True, is_new_user=True), ListResponse(success=True, users=[])]:
+        assert not hasattr(msg, "__dict__")
+
+
+def test_decode_mixed_format_buffer(queued_msgs):
+    # Text and binary frames can be decoded from the same buffer
+    buffer = queued_msgs[0].encode_() + queued_msgs[1].encode_(BINARY_FORMAT) + queued_msgs[2].encode_()
+    msgs = decode_server_buffer(buffer)
+
+    assert len(msgs) == 3
+    for msg, expected in zip(msgs, queued_msgs):
+        compare(msg, expected)
+
+
+def test_split_frames_incomplete(queued_msgs):
+    # Incomplete frames are not consumed
+    encoded = queued_msgs[0].encode_(BINARY_FORMAT)
+    buffer = encoded + queued_msgs[1].encode_(BINARY_FORMAT)[:5]
+    frames, consumed = split_frames(buffer)
+
+    assert len(frames) == 1
+    assert consumed == len(encoded)
+
+
+def test_decode_binary_msg_queue(max_length_broadcast):
+    queued_msgs = [max_length_broadcast for _ in range(20)]
+    res = encode_msg_queue(queued_msgs, BINARY_FORMAT)
+
+    msgs = []
+    for buffer in res:
+        assert len(buffer) <= MAX_BUFFER_SIZE
+        msgs += decode_server_buffer(buffer)
+
+    assert len(msgs) == 20
+    for msg in msgs:
+        compare(max_length_broadcast, msg)
+
+
+def test_stream_decoder_partial_frames(queued_msgs):
+    # Messages split across `feed` calls are decoded once they are complete
+    decoder = StreamDecoder(deserialize_server_message)
+    buffer = queued_msgs[0].encode_() + queued_msgs[1].encode_(BINARY_FORMAT) + queued_msgs[2].encode_()
+
+    msgs = []
+    for i in range(len(buffer)):
+        msgs += decoder.feed(buffer[i:i + 1])
+
+    assert len(msgs) == 3
+    for msg, expected in zip(msgs, queued_msgs):
+        compare(msg, expected)
+    assert decoder.pending == 0
+
+
+def test_stream_decoder_wraps_buffer(max_length_broadcast):
+    # Feeding more bytes than the buffer size keeps the partial messages
+    decoder = StreamDecoder(deserialize_server_message, size=MAX_BUFFER_SIZE + 1)
+    buffer = max_length_broadcast.encode_(BINARY_FORMAT) * 50
+
+    msgs = []
+    for i in range(0, len(buffer), 700):
+        msgs += decoder.feed(buffer[i:i + 700])
+
+    assert len(msgs) == 50
+    compare(msgs[-1], max_length_broadcast)
+
+
+def test_stream_decoder_recv(queued_msgs):
+    # Messages are received directly from the socket
+    decoder = StreamDecoder(deserialize_server_message)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        encoded = queued_msgs[0].encode_()
+        sender.sendall(encoded + encoded[:5])
+        assert len(decoder.recv(receiver)) == 1
+        sender.sendall(encoded[5:])
+        compare(decoder.recv(receiver), [queued_msgs[0]])
+        sender.close()
+        assert decoder.recv(receiver) is None
@@ -0,0 +1,126 @@
+"""
+Testing the queue store for messages of inactive users.
+"""
+import os
+import pickle
+
+import pytest
+from testfixtures import compare
+
+from src.app import AppState
+from src.protocol import *
+from src.queue_store import QueueStore, StoredMessage
+
+
+@pytest.fixture
+def store():
+    """Returns a QueueStore with a small tail and memory budget."""
+    store = QueueStore(memory_budget=1000, tail_size=2, segment_size=500)
+    yield store
+    store.close()
+
+
+def messages(username, num_msgs):
+    """Return `num_msgs` direct messages for the user."""
+    return [BroadcastMessage(sender="John", direct=username, text=f"Hello {i}") for i in range(num_msgs)]
+
+
+def test_stored_message():
+    msg = BroadcastMessage(sender="John", direct="Bob", text="Hello")
+    stored = StoredMessage(msg.encode_(BINARY_FORMAT))
+    # The frame is sent as is with the binary format, and decoded for the text format
+    assert stored.encode_(BINARY_FORMAT) == msg.encode_(BINARY_FORMAT)
+    assert stored.encode_(TEXT_FORMAT) == msg.encode_(TEXT_FORMAT)
+    assert stored.sender == "John" and stored.text == "Hello"
+    compare(pickle.loads(pickle.dumps(stored)).message, msg)
+
+
+def test_spill_keeps_order(store):
+    msgs = messages("Bob", 20)
+    for msg in msgs:
+        store.append("Bob", msg)
+
+    # Only the tail is kept in memory, and the rest is read from the segment files
+    assert store.count("Bob") == 20
+    assert store.memory_bytes == sum(len(msg.encode_(BINARY_FORMAT)) for msg in msgs[-2:])
+    compare([stored.message for stored in store.get("Bob")], msgs)
+    compare([stored.message for stored in store.get("Bob", 5, 19)], msgs[5:19])
+
+
+def test_memory_budget(store):
+    # The least recently queued users are spilled when the budget is exceeded
+    for username in ["Bob", "Jane", "Jim", "Joe", "John", "Jill", "Jack", "Jake", "Jeff", "Jen", "Jay", "Jo"]:
+        for msg in messages(username, 2):
+            store.append(username, msg)
+    assert store.memory_bytes <= store.memory_budget
+    compare([stored.message for stored in store.get("Bob")], messages("Bob", 2))
+
+
+def test_delete_removes_segments(store):
+    for msg in messages("Bob", 50):
+        store.append("Bob", msg)
+    for msg in messages("Jane", 3):
+        store.append("Jane", msg)
+    assert len(os.listdir(store.directory)) > 1
+
+    store.delete("Bob")
+    assert store.get("Bob") == []
+    # Only segments with messages for other users, and the segment being appended to, are kept
+    assert len(os.listdir(store.directory)) <= 2
+    compare([stored.message for stored in store.get("Jane")], messages("Jane", 3))
+
+
+def test_discard_oldest(store):
+    msgs = messages("Bob", 20)
+    for msg in msgs:
+        store.append("Bob", msg)
+
+    # Spilled and in memory messages are discarded from the front
+    store.discard("Bob", 5)
+    compare([stored.message for stored in store.get("Bob")], msgs[5:])
+    store.discard("Bob", 14)
+    compare([stored.message for stored in store.get("Bob")], msgs[19:])
+    store.discard("Bob", 1)
+    assert store.count("Bob") == 0 and store.memory_bytes == 0
+
+
+def test_close_removes_temporary_directory():
+    store = QueueStore(tail_size=0)
+    store.append("Bob", messages("Bob", 1)[0])
+    store.close()
+    assert not os.path.exists(store.directory)
+
+
+def test_stores_in_same_directory(tmp_path):
+    # Stores created with the same directory, e.g. by the sharded workers, don't share segments
+    stores = [QueueStore(directory=str(tmp_path), tail_size=0) for _ in range(2)]
+    for i, store in enumerate(stores):
+        store.append("Bob", messages("Bob", i + 1)[i])
+    for i, store in enumerate(stores):
+        assert os.path.dirname(store.directory) == str(tmp_path)
+        compare([stored.message for stored in store.get("Bob")], messages("Bob", i + 1)[i:])
+        store.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_rollover_removes_discarded_segment():
+    # Messages discarded before their segment is full are deleted when the next segment starts
+    store = QueueStore(tail_size=0, segment_size=500)
+    for msg in messages("Bob", 40):
+        store.append("Bob", msg)
+        store.discard("Bob", 1)
+    assert store.count("Bob") == 0
+    assert len(os.listdir(store.directory)) == 1
+    store.close()
+
+
+def test_app_state_with_store(store):
+    app_state = AppState(set(["Bob"]), queue_store=store)
+    msgs = messages("Bob", 10)
+    for msg in msgs:
+        app_state.queue_message("Bob", msg)
+    compare([stored.message for stored in app_state.get_queued_messages("Bob")], msgs)
+    assert store.total_count() == app_state.count_queued_messages() == 10
+
+    app_state.delete_user("Bob")
+    assert store.count("Bob") == 0
@@ -0,0 +1,48 @@
+"""
+Testing the token-bucket rate limiter.
+"""
+from src.rate_limit import RateLimiter, TokenBucket
+
+
+class FakeClock:
+    """Clock that only moves when told to."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refills():
+    bucket = TokenBucket(rate=2, burst=4, now=0)
+    assert bucket.take(3, now=0)
+    assert not bucket.take(2, now=0)
+    # Half a second adds a token
+    assert bucket.take(2, now=0.5)
+    # The bucket doesn't refill beyond the burst
+    assert bucket.take(4, now=100)
+    assert not bucket.take(1, now=100)
+
+
+def test_token_bucket_cost_above_burst():
+    # A message that costs more than the burst takes the whole bucket
+    bucket = TokenBucket(rate=1, burst=10, now=0)
+    assert bucket.take(1000, now=0)
+    assert not bucket.take(1000, now=5)
+    assert bucket.take(1000, now=10)
+
+
+def test_rate_limiter_buckets():
+    clock = FakeClock()
+    limiter = RateLimiter({"MSG": (1, 2)}, clock=clock)
+    # Each connection has its own bucket, and unlimited types are always allowed
+    assert limiter.allow(1, "MSG") and limiter.allow(1, "MSG")
+    assert not limiter.allow(1, "MSG")
+    assert limiter.allow(2, "MSG")
+    assert all(limiter.allow(1, "LST") for _ in range(100))
+
+    clock.now += 1
+    assert limiter.allow(1, "MSG")
+    # A connection that reconnects gets a new bucket
+    limiter.remove(2)
+    assert limiter.allow(2, "MSG", cost=2)
@@ -0,0 +1,97 @@
+"""
+Testing the reactor server mode with real connections on localhost.
+"""
+import socket
+from threading import Thread
+
+import pytest
+from testfixtures import compare
+
+from src.reactor import Reactor
+from src.app import AppState
+from src.protocol import *
+
+
+@pytest.fixture
+def reactor():
+    """Yields a running Reactor listening on a free port."""
+    reactor = Reactor(AppState(set(), {}, {}), pool_size=4)
+    listener = reactor.listen("127.0.0.1", 0)
+    reactor.port = listener.getsockname()[1]
+    thread = Thread(target=reactor.serve_forever, daemon=True)
+    thread.start()
+    yield reactor
+    reactor.stop()
+    thread.join(timeout=5)
+    listener.close()
+
+
+def read_messages(sock, decoder, num_msgs):
+    """Receive from the socket until `num_msgs` messages are decoded."""
+    msgs = []
+    while len(msgs) < num_msgs:
+        msgs += decoder.recv(sock)
+    return msgs
+
+
+def register(port, username):
+    """Connect and register a user, returning the socket, decoder and register response."""
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    decoder = StreamDecoder(deserialize_server_message)
+    sock.sendall(RegisterMessage(username=username, wire_format=BINARY_FORMAT).encode_())
+    return sock, decoder, read_messages(sock, decoder, 1)[0]
+
+
+def test_register(reactor):
+    sock, _, res = register(reactor.port, "John")
+    with sock:
+        assert res.success and res.wire_format == BINARY_FORMAT
+
+
+def test_pipelined_messages_in_order(reactor):
+    # Messages from one client are handled in the order they were sent
+    sock, decoder, _ = register(reactor.port, "John")
+    with sock:
+        msgs = [ChatMessage(sender="John", text=str(i)) for i in range(50)]
+        sock.sendall(b"".join(msg.encode_(BINARY_FORMAT) for msg in msgs))
+        received = read_messages(sock, decoder, 100)
+        texts = [msg.text for msg in received if isinstance(msg, BroadcastMessage)]
+        assert texts == [str(i) for i in range(50)]
+
+
+def test_direct_message(reactor):
+    sock1, decoder1, _ = register(reactor.port, "John")
+    sock2, decoder2, _ = register(reactor.port, "Jane")
+    with sock1, sock2:
+        sock1.sendall(ChatMessage(sender="John", recipient="Jane", text="Hi").encode_(BINARY_FORMAT))
+        compare(read_messages(sock2, decoder2, 1)[0], BroadcastMessage(sender="John", direct="Jane", text="Hi"))
+
+
+def test_disconnect(reactor):
+    sock, _, _ = register(reactor.port, "John")
+    sock.close()
+    # Registering the same username succeeds once the disconnect is handled
+    for _ in range(100):
+        sock, _, res = register(reactor.port, "John")
+        sock.close()
+        if res.success:
+            break
+    assert res.success
+
+
+def test_stop_disconnects_clients():
+    app = AppState(set(), {}, {})
+    reactor = Reactor(app, pool_size=2)
+    listener = reactor.listen("127.0.0.1", 0)
+    thread = Thread(target=reactor.serve_forever, daemon=True)
+    thread.start()
+    socks = [register(listener.getsockname()[1], f"user{i}")[0] for i in range(3)]
+
+    # Every remaining client is removed from the app state when the reactor stops
+    reactor.stop()
+    thread.join(timeout=5)
+    listener.close()
+    assert app.get_all_connections() == []
+    for sock in socks:
+        assert sock.recv(1) == b""
+        sock.close()
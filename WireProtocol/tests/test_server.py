@@ -7,6 +7,8 @@ from unittest.mock import MagicMock, patch, call
 from testfixtures import compare
 
 from src.server import *
+from src.rate_limit import RateLimiter
+from src.stats import stats
 from src.app import AppState
 
 
@@ -52,6 +54,26 @@ def test_register_previous_user(app_state):
     assert not res.is_new_user
 
 
+def test_register_wire_format(app_state):
+    # The requested wire format is accepted if supported, otherwise fall back to text
+    res = register_service(RegisterMessage(username="Jill", wire_format=BINARY_FORMAT), app_state)
+    assert res.wire_format == BINARY_FORMAT
+    res = register_service(RegisterMessage(username="Jack", wire_format="morse"), app_state)
+    assert res.wire_format == TEXT_FORMAT
+    res = register_service(RegisterMessage(username="Jim"), app_state)
+    assert res.wire_format is None
+
+
+def test_register_compression(app_state):
+    # Compression is only accepted with the binary wire format
+    msg = RegisterMessage(username="Jill", wire_format=BINARY_FORMAT, compression=ZLIB_COMPRESSION)
+    assert register_service(msg, app_state).compression == ZLIB_COMPRESSION
+    msg = RegisterMessage(username="Jack", wire_format=TEXT_FORMAT, compression=ZLIB_COMPRESSION)
+    assert register_service(msg, app_state).compression is None
+    msg = RegisterMessage(username="Jim", wire_format=BINARY_FORMAT, compression="lzma")
+    assert register_service(msg, app_state).compression is None
+
+
 def test_register_invalid_username(app_state):
     # Registering an invalid username should return error response
     msg = RegisterMessage(username="John_1")
@@ -135,6 +157,37 @@ def test_chat_inactive_user(mock_broadcast, app_state_data):
     assert res.success
 
 
+@patch('src.server.broadcast')
+def test_chat_to_room(mock_broadcast, app_state):
+    # Only the room's active members receive the message
+    assert join_service(JoinMessage(username="John", room="general"), app_state).success
+    assert join_service(JoinMessage(username="Bob", room="general"), app_state).success
+    msg = ChatMessage(sender="John", recipient="#general", text="Hello room!")
+    res = chat_service(msg, app_state)
+
+    actual_call_msg, actual_call_recvs = mock_broadcast.call_args[0]
+    compare(actual_call_msg, BroadcastMessage(sender="John", direct="#general", text="Hello room!"))
+    compare(actual_call_recvs, [1])
+    assert res.success
+
+    # Only members can send to the room
+    res = chat_service(ChatMessage(sender="Jane", recipient="#general", text="Hi"), app_state)
+    assert not res.success
+    assert res.error == "Not a member of room 'general'."
+
+
+def test_join_and_leave_room(app_state):
+    res = join_service(JoinMessage(username="John", room="bad_room"), app_state)
+    assert not res.success
+    assert res.error == "Room name must contain only alphanumeric characters."
+
+    assert join_service(JoinMessage(username="John", room="general"), app_state).success
+    assert leave_service(LeaveMessage(username="John", room="general"), app_state).success
+    res = leave_service(LeaveMessage(username="John", room="general"), app_state)
+    assert not res.success
+    assert res.error == "Not a member of room 'general'."
+
+
 def test_list_users(app_state):
     msg = ListMessage(wildcard=".*o")
     res = list_service(msg, app_state)
@@ -143,6 +196,23 @@ def test_list_users(app_state):
     assert_elements_equal(res.users, ["John", "Bob"])
 
 
+def test_list_users_pages():
+    # Listings beyond the limit are continued from the response's cursor
+    usernames = sorted(f"user{i}" for i in range(70))
+    app_state = AppState(set(usernames))
+    listed = []
+    msg = ListMessage(wildcard="user")
+    while True:
+        res = list_service(msg, app_state)
+        listed += res.users
+        if not res.cursor:
+            break
+        assert res.limit_exceeded and len(res.users) == ListResponse.max_num_users
+        msg = ListMessage(wildcard="user", cursor=res.cursor)
+
+    assert listed == usernames
+
+
 def test_delete_valid_user(app_state):
     # Delete an inactive user
     msg = DeleteMessage(username="Bob")
@@ -171,18 +241,75 @@ def test_delete_active_user(app_state):
 def test_msg_queue(app_state_data):
     # Make message queue contain 20 max length messages
     queued_msgs = [BroadcastMessage(sender="John", text="A"*280) for _ in range(20)]
-    # Mock socket
+    # Mock socket that sends every buffer it is passed
     socket = MagicMock()
+    socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
     msg = QueueMessage(username="John")
     # Patch the calls to AppState instance
-    with patch.object(AppState, 'get_queued_messages', return_value=queued_msgs):
+    with patch.object(AppState, 'get_queued_window', return_value=(1, queued_msgs, 0)):
         with patch.object(AppState, 'get_user_connection', return_value=socket):
-            app_state = AppState(**app_state_data)
-            res = queue_service(msg, app_state)
-
-    # `socket.send` should be called 7 times
-    assert socket.send.call_count == 7
+            with patch.object(AppState, 'get_connection_user', return_value="John"):
+                app_state = AppState(**app_state_data)
+                res = queue_service(msg, app_state, socket)
+
+    # All of the messages should be sent with one `socket.sendmsg` call
+    assert socket.sendmsg.call_count == 1
+    sent = b"".join(socket.sendmsg.call_args[0][0])
+    assert len(decode_server_buffer(sent)) == 20
     assert res.success
+    assert res.last_seq == 20 and res.remaining == 0
+
+
+def test_msg_queue_dropped(app_state_data):
+    # An error response is returned if the client's queue dropped the messages
+    queued_msgs = [BroadcastMessage(sender="John", text="Hello")]
+    msg = QueueMessage(username="John")
+    with patch.object(AppState, 'get_queued_window', return_value=(1, queued_msgs, 0)):
+        with patch.object(fanout, 'send_batches', return_value=False):
+            res = queue_service(msg, AppState(**app_state_data), 1)
+
+    assert not res.success
+    assert res.error == "Queued messages could not be delivered, try again later."
+
+
+def test_msg_queue_windows(app_state_data):
+    # The queue is delivered in windows, and acknowledged messages are removed
+    app_state = AppState(**app_state_data)
+    socket = MagicMock()
+    socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+    app_state.add_connection("Bob", socket)
+    for i in range(QUEUE_WINDOW_SIZE + 10):
+        app_state.queue_message("Bob", BroadcastMessage(sender="John", direct="Bob", text=str(i)))
+    app_state._msg_queue["Bob"] = app_state._msg_queue["Bob"][2:] # Remove the fixture's messages
+
+    res = queue_service(QueueMessage(username="Bob"), app_state, socket)
+    assert res.last_seq == QUEUE_WINDOW_SIZE and res.remaining == 10
+    # Without an acknowledgement, the same window is sent again
+    res = queue_service(QueueMessage(username="Bob"), app_state, socket)
+    assert res.last_seq == QUEUE_WINDOW_SIZE
+
+    res = queue_service(QueueMessage(username="Bob", ack=res.last_seq), app_state, socket)
+    assert res.last_seq == QUEUE_WINDOW_SIZE + 10 and res.remaining == 0
+    res = queue_service(QueueMessage(username="Bob", ack=res.last_seq), app_state, socket)
+    assert res.success and res.last_seq is None
+    assert app_state.get_queued_messages("Bob") == []
+
+
+def test_msg_queue_other_user(app_state):
+    # A client can't request or acknowledge another user's queued messages, John is connection 1
+    res = queue_service(QueueMessage(username="Bob", ack=1), app_state, 1)
+    assert not res.success
+    assert res.error == "Can only request your own queued messages."
+    assert app_state.get_queued_messages("Bob") == ["Hello", "What's up?"]
+
+
+def test_msg_queue_not_connected(app_state):
+    # Unregistered connections and offline users get an error response instead of a crash
+    res = queue_service(QueueMessage(username="Bob"), app_state, MagicMock())
+    assert not res.success
+    res = queue_service(QueueMessage(username="Nobody"), app_state, MagicMock())
+    assert not res.success
+    assert send_queue_window("Bob", app_state).error == "User is not connected."
 
 
 def test_handle_register_user(app_state_data):
@@ -198,6 +325,156 @@ def test_handle_register_user(app_state_data):
     assert res.success
 
 
+def test_register_pushes_queued_messages(app_state_data):
+    # A returning user gets the first window of its queue after the register response
+    app_state = AppState(**app_state_data)
+    socket = MagicMock()
+    socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+    msgs = [BroadcastMessage(sender="John", direct="Bob", text=str(i)) for i in range(QUEUE_WINDOW_SIZE + 1)]
+    app_state._msg_queue["Bob"] = list(msgs)
+
+    handle_messages([RegisterMessage(username="Bob")], app_state, socket)
+    # The response, the window and its QueueResponse are coalesced into one write
+    assert socket.sendmsg.call_count == 1 and not socket.sendall.called
+    received = decode_server_buffer(b"".join(socket.sendmsg.call_args[0][0]))
+    assert received[0].success and not received[0].is_new_user
+    compare(received[1:-1], msgs[:QUEUE_WINDOW_SIZE])
+    assert received[-1].last_seq == QUEUE_WINDOW_SIZE and received[-1].remaining == 1
+
+
+@patch('src.server.COALESCE_WRITES', False)
+def test_handle_messages_without_coalescing(app_state):
+    # Each response is written separately
+    socket = MagicMock()
+    handle_messages([RegisterMessage(username="Jill"), ListMessage()], app_state, socket)
+    assert socket.sendall.call_count == 2 and not socket.sendmsg.called
+
+
+def test_handle_messages_coalesces_echo():
+    # The echo of a chat, its response and the next response are written to the sender at once
+    app_state = AppState()
+    socket = MagicMock()
+    socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+    handle_messages([RegisterMessage(username="Jill", wire_format=BINARY_FORMAT)], app_state, socket)
+    socket.reset_mock()
+
+    handle_messages([ChatMessage(sender="Jill", text="Hi all"), ListMessage()], app_state, socket)
+    assert socket.sendmsg.call_count == 1 and not socket.sendall.called
+    received = decode_server_buffer(b"".join(socket.sendmsg.call_args[0][0]))
+    compare([type(msg) for msg in received], expected=[BroadcastMessage, ChatResponse, ListResponse])
+    assert received[0].text == "Hi all"
+
+
+def test_register_new_user_no_push(app_state):
+    socket = MagicMock()
+    handle_messages([RegisterMessage(username="Jill")], app_state, socket)
+    # Only the register response is sent
+    assert socket.sendall.call_count == 1 and not socket.sendmsg.called
+
+
+def test_handle_register_connected_user(app_state):
+    # Registering a username that another client connected with after it was
+    # registered should return an error response
+    socket = MagicMock()
+    with patch.object(AppState, 'add_connection', side_effect=InvalidUserError("Username is already connected to a socket.")):
+        res = handle_message(RegisterMessage(username="Jill"), app_state, socket)
+
+    assert not res.success
+    assert res.error == "Username is already connected to a socket."
+
+
+def test_handle_message_timeout(app_state):
+    # A timeout in the app state returns an error response of the right type
+    socket = MagicMock()
+    with patch.object(AppState, 'list_users', side_effect=TimeoutError("Worker 1 did not reply.")):
+        res = handle_message(ListMessage(), app_state, socket)
+
+    assert isinstance(res, ListResponse)
+    assert not res.success
+    assert res.error == "Server is busy, please try again."
+
+
+@patch('src.server.broadcast')
+def test_handle_message_rate_limited(mock_broadcast, app_state):
+    limiter = RateLimiter({"LST": (1, 2), "MSG": (1, 3)}, clock=lambda: 0)
+    stats.reset()
+    conn, other_conn = MagicMock(), MagicMock()
+    with patch('src.server.rate_limiter', limiter):
+        assert handle_message(ListMessage(), app_state, conn).success
+        assert handle_message(ListMessage(), app_state, conn).success
+        res = handle_message(ListMessage(), app_state, conn)
+        assert isinstance(res, ListResponse) and not res.success
+        assert res.error == "Rate limit exceeded, please slow down."
+        # Other connections and message types have their own buckets
+        assert handle_message(ListMessage(), app_state, other_conn).success
+
+        # A broadcast costs a token for each active user, so the second one is rejected
+        assert handle_message(ChatMessage(sender="John", text="Hello all!"), app_state, conn).success
+        assert not handle_message(ChatMessage(sender="John", text="Hello all!"), app_state, conn).success
+    compare(stats.snapshot(), expected={"rate_limited.LST": 1, "rate_limited.MSG": 1})
+
+
+def test_handle_message_request_id(app_state):
+    # The response has the request ID of the message
+    msg = ListMessage()
+    msg.request_id = 42
+    assert handle_message(msg, app_state, MagicMock()).request_id == 42
+    assert handle_message(ListMessage(), app_state, MagicMock()).request_id is None
+
+
+def test_registered_service(app_state):
+    # A new message type is decoded and routed once its class and service are registered
+    @client_message
+    class PingMessage(Message):
+        enc_header = "PNG"
+        type_code = 15
+
+        def _data_items(self):
+            return []
+
+        @classmethod
+        def _from_content(cls, content):
+            return cls()
+
+    @service(PingMessage, Response)
+    def ping_service(msg, app, socket=None):
+        return Response(success=True)
+
+    try:
+        msg = decode_client_buffer(PingMessage().encode_(BINARY_FORMAT))[0]
+        assert handle_message(msg, app_state, MagicMock()).success
+    finally:
+        del CLIENT_MESSAGES["PNG"], TYPE_CODE_HEADERS[15], SERVICES["PNG"]
+
+
+def test_handle_register_wire_format(app_state):
+    # The negotiated wire format is stored for the socket
+    socket = MagicMock()
+    msg = RegisterMessage(username="Jill", wire_format=BINARY_FORMAT)
+    res = handle_message(msg, app_state, socket)
+
+    assert res.success
+    assert app_state.get_wire_format(socket) == BINARY_FORMAT
+
+
+def test_broadcast_encodes_per_format(app_state):
+    # Each client receives the message in its own wire format
+    text_socket, binary_socket = MagicMock(), MagicMock()
+    app_state.set_wire_format(binary_socket, BINARY_FORMAT)
+    msg = BroadcastMessage(sender="John", text="Hello")
+    broadcast(msg, [text_socket, binary_socket], app=app_state)
+
+    text_socket.sendall.assert_called_with(msg.encode_())
+    binary_socket.sendall.assert_called_with(msg.encode_(BINARY_FORMAT))
+
+
+@pytest.mark.parametrize("nodelay", [False, True])
+def test_set_tcp_nodelay(nodelay):
+    with patch('src.server.TCP_NODELAY', nodelay), socket.socket() as tcp_socket:
+        set_tcp_nodelay(tcp_socket)
+        assert bool(tcp_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)) == nodelay
+
+
 def test_disconnect_client(app_state_data):
     with patch.object(AppState, 'remove_connection', return_value=None) as mock_method:
         app_state = AppState(**app_state_data)
@@ -206,3 +483,40 @@ def test_disconnect_client(app_state_data):
         disconnect_client(socket, app_state)
 
     mock_method.assert_called_with(socket)
+
+
+def test_stats_service_admin(app_state):
+    stats.reset()
+    local, remote = MagicMock(), MagicMock()
+    local.getpeername.return_value = ("127.0.0.1", 5000)
+    remote.getpeername.return_value = ("10.0.0.2", 5000)
+    assert handle_message(ListMessage(), app_state, local).success
+
+    res = handle_message(StatsMessage(), app_state, local)
+    assert res.success and not res.truncated
+    assert res.stats["active_users"] == "2"
+    assert res.stats["queued_messages"] == "2"
+    assert "rate.LST" in res.stats and "latency_us.LST" in res.stats
+    # The histogram has no empty buckets at the end
+    assert not res.stats["latency_us.LST"].endswith(",0")
+
+    res = handle_message(StatsMessage(), app_state, remote)
+    assert not res.success
+    assert res.error == "Only admins can request stats."
+    # Users in ADMIN_USERS can request stats from anywhere
+    app_state.add_connection("Bob", remote)
+    with patch('src.server.ADMIN_USERS', {"Bob"}):
+        assert handle_message(StatsMessage(), app_state, remote).success
+
+
+def test_stats_service_truncated(app_state):
+    stats.reset()
+    for i in range(200):
+        stats.increment(f"counter.{i}")
+    socket = MagicMock()
+    socket.getpeername.return_value = ("::1", 5000, 0, 0)
+    res = handle_message(StatsMessage(), app_state, socket)
+    assert res.success and res.truncated
+    assert "counter.0" in res.stats and "counter.199" not in res.stats
+    assert len(res.encode_()) <= MAX_BUFFER_SIZE
+    stats.reset()
@@ -0,0 +1,180 @@
+"""
+Testing the sharded server mode. Two workers are simulated in one process, each with
+its own ShardedAppState and a Router connected to the other worker.
+"""
+import socket
+import time
+from threading import Thread
+
+import pytest
+from testfixtures import compare
+
+from src.app import AppState, InvalidUserError
+from src.protocol import *
+from src.sharding import *
+
+
+def username_for(worker_id, prefix):
+    """Return a username starting with `prefix` that is owned by the worker."""
+    for i in range(1000):
+        if owner_of(f"{prefix}{i}", 2) == worker_id:
+            return f"{prefix}{i}"
+
+
+@pytest.fixture
+def workers():
+    """Returns the ShardedAppState of two connected workers."""
+    channel0, channel1 = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    apps = []
+    for worker_id, channels in enumerate([{1: channel0}, {0: channel1}]):
+        router = Router(worker_id, channels)
+        app = ShardedAppState(AppState(set(), {}, {}), router, 2)
+        router.start(app)
+        apps.append(app)
+    yield apps
+    channel0.close()
+    channel1.close()
+
+
+def wait_until(condition):
+    """Wait for up to a second for the condition to become true."""
+    for _ in range(200):
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_owner_of_is_stable():
+    assert owner_of("John", 4) == owner_of("John", 4)
+    assert {owner_of(f"user{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_routed_user_lookup(workers):
+    app0, app1 = workers
+    remote_user = username_for(1, "Bob")
+    app1.register_user(remote_user)
+
+    # Worker 0 can check and list users owned by worker 1
+    assert app0.is_valid_user(remote_user)
+    assert not app0.is_valid_user(username_for(1, "Jim"))
+    assert remote_user in app0.list_users()
+    # Inactive users have no connection
+    assert app0.get_user_connection(remote_user) is None
+
+
+def test_routed_exception(workers):
+    app0, _ = workers
+    # Exceptions raised by the owner are raised by the caller
+    with pytest.raises(InvalidUserError):
+        app0.get_queued_messages(username_for(1, "Jim"))
+
+
+def test_deliver_to_remote_user(workers):
+    app0, app1 = workers
+    remote_user = username_for(1, "Bob")
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        app1.register_user(remote_user)
+        app1.add_connection(remote_user, sender)
+
+        # The connection of an active remote user forwards to its worker
+        conn = app0.get_user_connection(remote_user)
+        assert isinstance(conn, RemoteConnection)
+        msg = BroadcastMessage(sender="John", direct=remote_user, text="Hi")
+        conn.sendall(msg.encode_())
+        compare(decode_server_buffer(receiver.recv(4096)), [msg])
+
+
+def test_queue_for_remote_user(workers):
+    app0, app1 = workers
+    remote_user = username_for(1, "Bob")
+    app1.register_user(remote_user)
+    msg = BroadcastMessage(sender="John", direct=remote_user, text="Hi")
+    app0.queue_message(remote_user, msg)
+    compare(app1.get_queued_messages(remote_user), [msg])
+
+
+def test_broadcast_to_remote_worker(workers):
+    app0, app1 = workers
+    remote_user = username_for(1, "Bob")
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        app1.register_user(remote_user)
+        app1.add_connection(remote_user, sender)
+
+        remotes = [conn for conn in app0.get_all_connections() if isinstance(conn, RemoteBroadcast)]
+        assert len(remotes) == 1
+        msg = BroadcastMessage(sender="John", text="Hello all!")
+        remotes[0].sendall(msg.encode_(app0.get_wire_format(remotes[0])))
+        compare(decode_server_buffer(receiver.recv(4096)), [msg])
+
+
+def test_room_to_remote_worker(workers):
+    app0, app1 = workers
+    local_user, remote_user = username_for(0, "John"), username_for(1, "Bob")
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        for app, username in [(app0, local_user), (app1, remote_user)]:
+            app.register_user(username)
+            app.join_room(username, "general")
+        app1.add_connection(remote_user, sender)
+        # Members are kept by the worker that owns them
+        assert app0.is_room_member(remote_user, "general")
+        compare(sorted(app0.get_room_members("general")), sorted([local_user, remote_user]))
+
+        # The other worker sends to its own active members of the room
+        remotes = app0.get_room_connections("general")
+        assert len(remotes) == 1 and isinstance(remotes[0], RemoteRoomBroadcast)
+        msg = BroadcastMessage(sender=local_user, direct="#general", text="Hello room!")
+        remotes[0].sendall(msg.encode_(app0.get_wire_format(remotes[0])))
+        compare(decode_server_buffer(receiver.recv(4096)), [msg])
+
+
+def test_handoff_on_register(workers):
+    app0, app1 = workers
+    remote_user = username_for(1, "Bob")
+    server_side, client_side = socket.socketpair()
+    with client_side:
+        # Worker 0 receives a register message for a username owned by worker 1
+        client_side.sendall(RegisterMessage(username=remote_user).encode_())
+        Thread(target=sharded_client_thread, args=(server_side, app0), daemon=True).start()
+
+        # The connection is registered by worker 1, which sends the response
+        decoder = StreamDecoder(deserialize_server_message)
+        res = decoder.recv(client_side)[0]
+        assert res.success
+        assert wait_until(lambda: app1.local.get_user_connection(remote_user) is not None)
+        assert app0.local.get_all_connections() == []
+
+
+def test_failed_register_keeps_connection(workers):
+    app0, _ = workers
+    server_side, client_side = socket.socketpair()
+    with client_side:
+        # An invalid username owned by this worker fails to register, and the client can retry
+        username = username_for(0, "Bad_")
+        client_side.sendall(RegisterMessage(username=username).encode_())
+        Thread(target=sharded_client_thread, args=(server_side, app0), daemon=True).start()
+        decoder = StreamDecoder(deserialize_server_message)
+        assert not decoder.recv(client_side)[0].success
+
+        username = username_for(0, "Good")
+        client_side.sendall(RegisterMessage(username=username).encode_())
+        assert decoder.recv(client_side)[0].success
+
+
+def test_large_routed_results(workers):
+    app0, app1 = workers
+    # Results larger than a packet between workers are split into several packets
+    remote_users = [f"user{i}" for i in range(20000) if owner_of(f"user{i}", 2) == 1]
+    for username in remote_users:
+        app1.local.register_user(username)
+    assert len(app0.list_users()) == len(remote_users)
+    # The limit is applied by the owner
+    assert len(app0.list_users(limit=31)) == 31
+
+    msgs = [BroadcastMessage(sender="John", direct=remote_users[0], text="A" * 280) for _ in range(1000)]
+    for msg in msgs:
+        app1.local.queue_message(remote_users[0], msg)
+    compare(app0.get_queued_messages(remote_users[0]), msgs)
@@ -0,0 +1,58 @@
+"""
+Testing the server's counters.
+"""
+from threading import Thread
+from unittest.mock import patch
+
+from testfixtures import compare
+
+from src.stats import Stats, latency_bucket, NUM_LATENCY_BUCKETS
+
+
+def test_latency_bucket():
+    assert latency_bucket(0) == 0
+    assert latency_bucket(0.5e-6) == 0
+    # Bucket i counts the latencies in [4^(i-1), 4^i) microseconds
+    assert latency_bucket(1e-6) == 1
+    assert latency_bucket(3e-6) == 1
+    assert latency_bucket(4e-6) == 2
+    assert latency_bucket(100e-6) == 4
+    assert latency_bucket(10) == NUM_LATENCY_BUCKETS - 1
+
+
+def test_counts_of_every_thread():
+    stats = Stats()
+    stats.increment("connections")
+
+    def count():
+        for _ in range(100):
+            stats.increment("connections")
+            stats.record_message("MSG", 2e-6)
+    threads = [Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.increment("connections", -1)
+
+    # The counts of the threads that ended are kept
+    assert stats.get("connections") == 400
+    compare(stats.message_counts(), expected={"MSG": 400})
+    compare(stats.latency_histograms(), expected={"MSG": [0, 400] + [0] * (NUM_LATENCY_BUCKETS - 2)})
+
+    stats.reset()
+    compare(stats.snapshot(), expected={})
+    compare(stats.message_counts(), expected={})
+
+
+def test_message_rates():
+    with patch("src.stats.time.monotonic", return_value=10):
+        stats = Stats()
+        for _ in range(20):
+            stats.record_message("LST", 0.001)
+    with patch("src.stats.time.monotonic", return_value=12):
+        compare(stats.message_rates(), expected={"LST": 10.0})
+        stats.record_message("LST", 0.001)
+    # The rates are counted since the previous call
+    with patch("src.stats.time.monotonic", return_value=14):
+        compare(stats.message_rates(), expected={"LST": 0.5})